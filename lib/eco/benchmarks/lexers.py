@@ -0,0 +1,111 @@
+# Copyright (c) 2013--2014 King's College London
+# Created by the Software Development Team <http://soft-dev.org/>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""Compares the two ways of running a lexer's automaton: the dense transition
+table (the default) and the generated if/elif code (`Lexer(..., table=False)`).
+`scan` is the table lexer's `Lexer.scan`, which doesn't create any tokens.
+`no_keywords` is the table lexer with an automaton that has states for all
+keywords instead of classifying them after lexing (`Lexer(..., keywords=False)`).
+
+Usage (from lib/eco): python2.7 -m benchmarks.lexers [options] [TRACE ...]
+
+The input for each language is the setup text of an editing trace (by
+default the Python, Java and PHP traces)."""
+
+from __future__ import print_function
+
+import json, sys
+from optparse import OptionParser
+from timeit import default_timer as clock
+
+from cflexer.lexer import Lexer
+from grammars.grammars import lang_dict
+from benchmarks.run import find_traces
+from benchmarks.replay import load_trace
+
+default_traces = ["python_typing", "java_typing", "php_comments"]
+
+def tokens(lexer, text):
+    return [(t.name, t.source) for t in lexer.tokenize(text)]
+
+def measure(tokenize, text, repeat):
+    best = None
+    for _ in range(repeat):
+        start = clock()
+        tokenize(text)
+        t = clock() - start
+        if best is None or t < best:
+            best = t
+    return best
+
+def compare(trace, repeat):
+    language = lang_dict[trace["language"]]
+    text = u"".join(t * n for t, n in trace["setup"])
+    cached = language.load()[1].lexer
+    result = {"name": trace["name"], "language": language.name, "chars": len(text)}
+    lexers = {}
+    for name, table in [("table", True), ("code", False)]:
+        start = clock()
+        lexer = Lexer(cached.token_regexs, cached.names, list(cached.ignore),
+                      cached.automaton, table)
+        build = clock() - start
+        lexers[name] = lexer
+        t = measure(lexer.tokenize, text, repeat)
+        result[name] = {"build": build, "lex": t, "chars_per_second": len(text) / t}
+    assert tokens(lexers["table"], text) == tokens(lexers["code"], text)
+    t = measure(lexers["table"].scan, text, repeat)
+    result["scan"] = {"lex": t, "chars_per_second": len(text) / t}
+    lexer = Lexer(cached.token_regexs, cached.names, list(cached.ignore), keywords=False)
+    assert tokens(lexer, text) == tokens(lexers["table"], text)
+    t = measure(lexer.tokenize, text, repeat)
+    result["no_keywords"] = {"lex": t, "chars_per_second": len(text) / t,
+                             "states": lexer.automaton.num_states}
+    result["table"]["states"] = cached.automaton.num_states
+    return result
+
+def main():
+    parser = OptionParser(usage="usage: python2.7 -m benchmarks.lexers [options] [TRACE ...]")
+    parser.add_option("-o", "--output", default=None, help="Write the JSON results to this file [default: stdout]")
+    parser.add_option("-r", "--repeat", type="int", default=5, help="Report the best of this many runs [default: 5]")
+    (options, args) = parser.parse_args()
+
+    results = []
+    for filename in find_traces(args or default_traces):
+        result = compare(load_trace(filename), options.repeat)
+        results.append(result)
+        sys.stderr.write("%-14s %6d chars  table %8.0f chars/s (build %.3fs)  code %8.0f chars/s (build %.3fs)  scan %8.0f chars/s"
+                         "  no_keywords %8.0f chars/s (%d states instead of %d)\n" % (
+            result["language"], result["chars"],
+            result["table"]["chars_per_second"], result["table"]["build"],
+            result["code"]["chars_per_second"], result["code"]["build"],
+            result["scan"]["chars_per_second"],
+            result["no_keywords"]["chars_per_second"],
+            result["no_keywords"]["states"], result["table"]["states"]))
+
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=1, sort_keys=True)
+        print()
+
+if __name__ == "__main__":
+    main()
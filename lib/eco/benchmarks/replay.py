@@ -0,0 +1,212 @@
+# Copyright (c) 2013--2014 King's College London
+# Created by the Software Development Team <http://soft-dev.org/>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""Replays recorded editing sessions (traces) through the TreeManager and
+measures the time spent relexing and reparsing after every keystroke.
+
+A trace is a JSON file of the form
+
+    {"name": "java_typing",
+     "language": "Java 1.5",
+     "setup": [["class X {\n", 1], ["    int f() { return 1; }\n", 50], ["}", 1]],
+     "events": [["down", 3], ["end"], ["type", "int x = 1;"], ["backspace", 4]]}
+
+`setup` is a list of (text, repetitions) that is imported before the
+measurement starts. The events are:
+
+    type TEXT            one keystroke per character ("\r" is return)
+    paste TEXT           paste TEXT at the cursor (one keystroke)
+    backspace N, delete N
+    up N, down N, left N, right N, home, end
+    select DIRECTION N   extend the selection, e.g. ["select", "down", 2]
+    delete_selection     delete the selected text (one keystroke)
+    languagebox LANGUAGE insert a language box (one keystroke)
+    leave_languagebox    move the cursor out of the current language box
+"""
+
+from __future__ import print_function
+
+import json, os, sys
+from timeit import default_timer as clock
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from grammars.grammars import lang_dict
+from treemanager import TreeManager
+
+def maxrss():
+    # peak memory of this process in kilobytes, if the platform can tell
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        rss /= 1024 # bytes on OS X
+    return rss
+
+class MeasuringTreeManager(TreeManager):
+    """TreeManager that adds up the time spent in the lexers and parsers, and
+    the number of nodes the parsers visited."""
+
+    def __init__(self):
+        TreeManager.__init__(self)
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.relex_time = 0.0
+        self.parse_time = 0.0
+        self.nodes_visited = 0
+        self.journal_size = 0
+
+    def relex(self, node):
+        start = clock()
+        result = TreeManager.relex(self, node)
+        self.relex_time += clock() - start
+        return result
+
+    def add_parser(self, parser, lexer, language):
+        # edits are reparsed when their transaction is committed, not in
+        # reparse, so measure the parser itself
+        inc_parse = parser.inc_parse
+        def measured_inc_parse(*args, **kwargs):
+            start = clock()
+            result = inc_parse(*args, **kwargs)
+            self.parse_time += clock() - start
+            self.nodes_visited += parser.loopcount
+            if parser.journal_sizes:
+                self.journal_size += parser.journal_sizes[-1]
+            return result
+        parser.inc_parse = measured_inc_parse
+        TreeManager.add_parser(self, parser, lexer, language)
+
+def load_trace(filename):
+    with open(filename) as f:
+        trace = json.load(f)
+    if "name" not in trace:
+        trace["name"] = os.path.splitext(os.path.basename(filename))[0]
+    return trace
+
+class Replay(object):
+
+    def __init__(self, trace):
+        self.trace = trace
+        self.samples = []
+
+    def run(self):
+        language = lang_dict[self.trace["language"]]
+        start = clock()
+        parser, lexer = language.load()
+        self.load_time = clock() - start
+
+        tm = MeasuringTreeManager()
+        tm.add_parser(parser, lexer, language.name)
+        tm.set_font_test(7, 17)
+        self.treemanager = tm
+
+        source = "".join([text * count for text, count in self.trace.get("setup", [])])
+        start = clock()
+        if source:
+            tm.import_file(source)
+        self.setup_time = clock() - start
+        self.setup_nodes = tm.nodes_visited
+
+        for event in self.trace["events"]:
+            self.replay(event[0], event[1:])
+        self.status = all([p[0].last_status for p in tm.parsers])
+        return self.result()
+
+    def replay(self, name, args):
+        tm = self.treemanager
+        if name == "type":
+            for c in args[0]:
+                self.measure(name, c, tm.key_normal, c)
+        elif name == "paste":
+            self.measure(name, args[0], tm.pasteText, args[0])
+        elif name in ("backspace", "delete"):
+            method = getattr(tm, "key_" + name)
+            for i in range(args[0] if args else 1):
+                self.measure(name, None, method)
+        elif name in ("up", "down", "left", "right"):
+            for i in range(args[0] if args else 1):
+                tm.key_cursors(name)
+        elif name == "home":
+            tm.key_home()
+        elif name == "end":
+            tm.key_end()
+        elif name == "select":
+            if not tm.hasSelection():
+                tm.key_shift()
+            for i in range(args[1] if len(args) > 1 else 1):
+                tm.key_cursors(args[0], mod_shift=True)
+        elif name == "delete_selection":
+            self.measure(name, None, tm.key_delete)
+        elif name == "languagebox":
+            self.measure(name, args[0], tm.add_languagebox, lang_dict[args[0]])
+        elif name == "leave_languagebox":
+            tm.leave_languagebox()
+        else:
+            raise ValueError("Unknown trace event: %s" % (name,))
+
+    def measure(self, name, text, method, *args):
+        tm = self.treemanager
+        tm.reset_counters()
+        start = clock()
+        method(*args)
+        total = clock() - start
+        self.samples.append({
+            "event": name,
+            "text": text,
+            "total": total,
+            "relex": tm.relex_time,
+            "parse": tm.parse_time,
+            "nodes": tm.nodes_visited,
+            "journal": tm.journal_size,
+            "status": tm.get_mainparser().last_status,
+            "maxrss": maxrss(),
+        })
+
+    def result(self):
+        summary = {}
+        for key in ("total", "relex", "parse", "nodes"):
+            values = sorted([s[key] for s in self.samples])
+            if not values:
+                continue
+            summary[key] = {
+                "sum": sum(values),
+                "mean": sum(values) / float(len(values)),
+                "median": values[len(values) // 2],
+                "p95": values[min(len(values) - 1, int(len(values) * 0.95))],
+                "max": values[-1],
+            }
+        return {
+            "name": self.trace["name"],
+            "language": self.trace["language"],
+            "keystrokes": len(self.samples),
+            "load_time": self.load_time,
+            "setup_time": self.setup_time,
+            "setup_nodes": self.setup_nodes,
+            "status": self.status,
+            "maxrss": maxrss(),
+            "summary": summary,
+            "samples": self.samples,
+        }
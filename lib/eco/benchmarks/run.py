@@ -0,0 +1,89 @@
+# Copyright (c) 2013--2014 King's College London
+# Created by the Software Development Team <http://soft-dev.org/>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""Runs the editing benchmarks and writes the results as JSON.
+
+Usage (from lib/eco): python2.7 -m benchmarks.run [options] [TRACE ...]
+
+Without arguments all traces in benchmarks/traces are replayed. TRACE is
+either the name of a bundled trace (e.g. java_typing) or a path to a trace
+file."""
+
+from __future__ import print_function
+
+import glob, json, os, platform, subprocess, sys, time
+from optparse import OptionParser
+
+from benchmarks.replay import Replay, load_trace
+
+tracedir = os.path.join(os.path.dirname(__file__), "traces")
+
+def find_traces(names):
+    if not names:
+        return sorted(glob.glob(os.path.join(tracedir, "*.json")))
+    filenames = []
+    for name in names:
+        if not os.path.exists(name):
+            name = os.path.join(tracedir, name + ".json")
+        filenames.append(name)
+    return filenames
+
+def revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = OptionParser(usage="usage: python2.7 -m benchmarks.run [options] [TRACE ...]")
+    parser.add_option("-o", "--output", default=None, help="Write the JSON results to this file [default: stdout]")
+    parser.add_option("-s", "--summary", action="store_true", default=False, help="Leave out the per-keystroke samples")
+    (options, args) = parser.parse_args()
+
+    results = []
+    for filename in find_traces(args):
+        trace = load_trace(filename)
+        result = Replay(trace).run()
+        if options.summary:
+            del result["samples"]
+        results.append(result)
+        summary = result["summary"]
+        sys.stderr.write("%-24s %5d keys  relex %7.2fms  parse %7.2fms  nodes %7.1f  (mean per key)%s\n" % (
+            result["name"], result["keystrokes"],
+            summary["relex"]["mean"] * 1000, summary["parse"]["mean"] * 1000, summary["nodes"]["mean"],
+            "" if result["status"] else "  [ends with syntax error]"))
+
+    output = {
+        "revision": revision(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "traces": results,
+    }
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(output, f, indent=1, sort_keys=True)
+    else:
+        json.dump(output, sys.stdout, indent=1, sort_keys=True)
+        print()
+
+if __name__ == "__main__":
+    main()
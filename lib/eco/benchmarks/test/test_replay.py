@@ -0,0 +1,60 @@
+# Copyright (c) 2013--2014 King's College London
+# Created by the Software Development Team <http://soft-dev.org/>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import json, os
+
+import pytest
+
+from benchmarks.replay import Replay, load_trace
+from benchmarks.run import find_traces
+
+def test_replay_calc():
+    trace = load_trace(os.path.join("benchmarks", "traces", "calc_typing.json"))
+    result = Replay(trace).run()
+    assert result["status"] == True
+    assert result["keystrokes"] == len(result["samples"]) > 0
+    for sample in result["samples"]:
+        assert sample["parse"] >= 0 and sample["relex"] >= 0
+        # keystrokes that only relex a token are not reparsed
+        assert (sample["parse"] > 0) == (sample["nodes"] > 0)
+    assert result["summary"]["nodes"]["sum"] > 0
+    json.dumps(result)
+
+def test_replay_measures_committed_parse():
+    trace = load_trace(os.path.join("benchmarks", "traces", "python_typing.json"))
+    trace["events"] = [["type", "\rd = c"]]
+    result = Replay(trace).run()
+    samples = result["samples"]
+    assert len(samples) == 6
+    for sample in samples:
+        assert sample["parse"] > 0
+        assert 0 < sample["nodes"] < result["setup_nodes"]
+    json.dumps(result)
+
+def test_unknown_event():
+    trace = {"name": "x", "language": "Basic Calculator", "events": [["jump"]]}
+    with pytest.raises(ValueError):
+        Replay(trace).run()
+
+def test_bundled_traces():
+    names = [os.path.basename(f) for f in find_traces([])]
+    assert "java_comments.json" in names
+    assert find_traces(["sql_typing"])[0].endswith(os.path.join("traces", "sql_typing.json"))
@@ -1,5 +1,5 @@
 from __future__ import with_statement
-import py
+from array import array
 
 try:
     set
@@ -71,7 +71,7 @@ class LexerError(Exception):
 
 class DFA(object):
     def __init__(self, num_states=0, transitions=None, final_states=None,
-                 unmergeable_states=None, names=None):
+                 unmergeable_states=None, names=None, keywords=None):
         self.num_states = 0
         if transitions is None:
             transitions = {}
@@ -81,16 +81,22 @@ class DFA(object):
             unmergeable_states = set()
         if names is None:
             names = []
+        if keywords is None:
+            keywords = {}
         self.transitions = transitions
         self.final_states = final_states
         self.unmergeable_states = unmergeable_states
         self.names = names
+        # tokens that end in a state of `keywords` and whose text is in
+        # `keywords[state]` are reported with the state found there instead
+        # (see `cflexer.lexer.Lexer.make_automaton`)
+        self.keywords = keywords
 
     def __repr__(self):
         from pprint import pformat
         return "DFA%s" % (pformat((
             self.num_states, self.transitions, self.final_states,
-            self.unmergeable_states, self.names)), )
+            self.unmergeable_states, self.names, self.keywords)), )
 
     def add_state(self, name=None, final=False, unmergeable=False):
         state = self.num_states
@@ -121,99 +127,116 @@ class DFA(object):
         return all_chars
 
     def optimize(self):
-        all_chars = self.get_all_chars()
-        # find mergeable
-        non_final = frozenset(set(range(self.num_states)) - self.final_states -
-                              self.unmergeable_states)
-        final = frozenset(self.final_states - self.unmergeable_states)
-        state_to_set = {}
-        equivalence_sets = set()
-        if non_final:
-            equivalence_sets.add(non_final)
-        if final:
-            equivalence_sets.add(final)
-        for state in range(self.num_states):
-            if state in final:
-                state_to_set[state] = final
-            elif state in self.unmergeable_states:
-                singleset = frozenset([state])
-                state_to_set[state] = singleset
-                equivalence_sets.add(singleset)
-            else:
-                state_to_set[state] = non_final
-        assert len(equivalence_sets) <= self.num_states
-        while len(equivalence_sets) < self.num_states:
-            new_equivalence_sets = set()
-            changed = False
-            for equivalent in equivalence_sets:
-                #print "checking", equivalent
-                for char in all_chars:
-                    targets = {}
-                    for state in equivalent:
-                        if (state, char) in self:
-                            nextstate = self[state, char]
-                            target = frozenset(state_to_set[nextstate])
-                        else:
-                            nextstate = None
-                            target = None
-                        targets.setdefault(target, set()).add(state)
-                    if len(targets) != 1:
-                        #print "\nsplitting %s with %r\ninto %s" % (equivalent, char, targets.values())
-                        for target, newequivalent in targets.iteritems():
-                            #print "   ", newequivalent
-                            newequivalent = frozenset(newequivalent)
-                            new_equivalence_sets.add(newequivalent)
-                            for state in newequivalent:
-                                state_to_set[state] = newequivalent
-                            #print "   ", new_equivalence_sets
-                        changed = True
-                        break
-                else:
-                    new_equivalence_sets.add(equivalent)
-            if not changed:
-                break
-            #print "end", equivalence_sets
-            #print new_equivalence_sets
-            equivalence_sets = new_equivalence_sets
-        if len(equivalence_sets) == self.num_states:
+        """Merge equivalent states with Hopcroft's partition refinement.
+        Characters that lead from every state to the same next state are
+        refined as one class. Missing transitions go to a sink state that is
+        never merged with a real one, and unmergeable states stay alone.
+        Return whether any states were merged."""
+        num_states = self.num_states
+        sink = num_states
+        # group the characters into classes by their column
+        columns = {}
+        for (state, char), nextstate in self.transitions.iteritems():
+            columns.setdefault(char, []).append((state, nextstate))
+        classes = set()
+        for column in columns.itervalues():
+            column.sort()
+            classes.add(tuple(column))
+        # inverse transitions of every class, including those into the sink
+        inverses = []
+        for column in classes:
+            inverse = {}
+            targets = [sink] * (num_states + 1)
+            for state, nextstate in column:
+                targets[state] = nextstate
+            for state, nextstate in enumerate(targets):
+                inverse.setdefault(nextstate, []).append(state)
+            inverses.append(inverse)
+
+        blocks = []
+        block_of = [0] * (num_states + 1)
+        def add_block(states):
+            index = len(blocks)
+            blocks.append(states)
+            for state in states:
+                block_of[state] = index
+            return index
+        non_final = set(range(num_states)) - self.final_states - self.unmergeable_states
+        final = self.final_states - self.unmergeable_states
+        for states in [non_final, final]:
+            if states:
+                add_block(states)
+        for state in self.unmergeable_states:
+            add_block(set([state]))
+        add_block(set([sink]))
+        if len(blocks) == num_states + 1:
+            return False
+
+        pending = set()
+        worklist = []
+        for block in range(len(blocks)):
+            for cls in range(len(inverses)):
+                pending.add((block, cls))
+                worklist.append((block, cls))
+        while worklist:
+            splitter = worklist.pop()
+            pending.remove(splitter)
+            block, cls = splitter
+            inverse = inverses[cls]
+            predecessors = {}
+            for state in blocks[block]:
+                for prev in inverse.get(state, ()):
+                    predecessors.setdefault(block_of[prev], set()).add(prev)
+            for index, states in predecessors.iteritems():
+                rest = blocks[index]
+                if len(states) == len(rest):
+                    continue
+                rest -= states
+                new = add_block(states)
+                for other in range(len(inverses)):
+                    if (index, other) in pending or len(states) <= len(rest):
+                        pending.add((new, other))
+                        worklist.append((new, other))
+                    else:
+                        pending.add((index, other))
+                        worklist.append((index, other))
+
+        blocks.pop(block_of[sink])
+        if len(blocks) == num_states:
             return False
-        #print equivalence_sets
-        # merging the states
+        # number the new states in the order of their smallest old state, so
+        # that the start state stays 0
+        blocks = sorted([sorted(states) for states in blocks])
         newnames = []
-        newtransitions = {}
-        newnum_states = len(equivalence_sets)
-        newstates = list(equivalence_sets)
-        newstate_to_index = {}
         newfinal_states = set()
         newunmergeable_states = set()
-        for i, newstate in enumerate(newstates):
-            newstate_to_index[newstate] = i
-        # bring startstate into first slot
-        startstateindex = newstate_to_index[state_to_set[0]]
-        newstates[0], newstates[startstateindex] = newstates[startstateindex], newstates[0]
-        newstate_to_index[newstates[0]] = 0
-        newstate_to_index[newstates[startstateindex]] = startstateindex
-        for i, newstate in enumerate(newstates):
-            name = ", ".join([self.names[s] for s in newstate])
-            for state in newstate:
+        for i, states in enumerate(blocks):
+            name = ", ".join([self.names[s] for s in states])
+            for state in states:
+                block_of[state] = i
                 if state in self.unmergeable_states:
                     newunmergeable_states.add(i)
                     name = self.names[state]
                 if state in self.final_states:
                     newfinal_states.add(i)
             newnames.append(name)
+        newtransitions = {}
         for (state, char), nextstate in self.transitions.iteritems():
-            newstate = newstate_to_index[state_to_set[state]]
-            newnextstate = newstate_to_index[state_to_set[nextstate]]
-            newtransitions[newstate, char] = newnextstate
+            newtransitions[block_of[state], char] = block_of[nextstate]
+        newkeywords = {}
+        for state, keywords in self.keywords.iteritems():
+            newkeywords[block_of[state]] = dict([(text, block_of[keyword])
+                                                 for text, keyword in keywords.iteritems()])
+        self.keywords = newkeywords
         self.names = newnames
         self.transitions = newtransitions
-        self.num_states = newnum_states
+        self.num_states = len(blocks)
         self.final_states = newfinal_states
         self.unmergeable_states = newunmergeable_states
         return True
 
     def make_code(self):
+        import py
         from rpython.rlib.parsing.codebuilder import Codebuilder
         result = Codebuilder()
         result.start_block("def recognize(input):")
@@ -287,7 +310,9 @@ class DFA(object):
         exec py.code.Source(result).compile() in d
         return d['recognize']
         
-    def make_lexing_code(self):
+    def make_lexing_source(self):
+        """Return the source of a `recognize(runner, i)` function that runs
+        the automaton with an if/elif chain per state."""
         from cflexer.codebuilder import Codebuilder
         result = Codebuilder()
         result.start_block("def recognize(runner, i):")
@@ -367,8 +392,21 @@ return ~i""")
         while "\n\n" in result:
             result = result.replace("\n\n", "\n")
         #print result
-        exec py.code.Source(result).compile()
-        return recognize
+        return result
+
+    def compile_lexing_code(self):
+        """Compile the source of `make_lexing_source`. The code object can be
+        stored (see `tablefile.write_lexer`) and turned into a matcher by
+        `code_matcher`."""
+        return compile(self.make_lexing_source(), "<lexer>", "exec")
+
+    def make_lexing_code(self):
+        return code_matcher(self.compile_lexing_code())
+
+    def make_table_matcher(self):
+        """Like `make_lexing_code`, but returns a function that looks up the
+        transitions in a `TransitionTable` instead of generating code."""
+        return TransitionTable(self).make_matcher()
 
     def get_runner(self):
         return DFARunner(self)
@@ -408,6 +446,7 @@ return ~i""")
         return "\n".join(result)
 
     def view(self):
+        import py
         from dotviewer import graphclient
         p = py.test.ensuretemp("automaton").join("temp.dot")
         dot = self.dot()
@@ -419,6 +458,108 @@ return ~i""")
             py.process.cmdexec("fdp -Tplain %s > %s" % (p, plainpath))
         graphclient.display_dot_file(str(plainpath))
 
+def code_matcher(code):
+    d = {}
+    exec code in d
+    return d["recognize"]
+
+class TransitionTable(object):
+    """Dense transition table of a DFA. Characters that have the same
+    transitions in all states share a class; `classes` maps the codes of
+    characters below 256 to their class and `other_classes` the rest. Class 0
+    is for characters without any transition. The next state for a state and
+    a class is in `table[state * num_classes + class]`, -1 if there is none.
+    Without a DFA the table is empty (see `tablefile.read_transition_table`)."""
+
+    def __init__(self, dfa=None):
+        if dfa is None:
+            return
+        columns = {}
+        for (state, char), nextstate in dfa.transitions.iteritems():
+            columns.setdefault(ord(char), []).append((state, nextstate))
+        class_ids = {}
+        char_classes = {}
+        for code, column in sorted(columns.iteritems()):
+            column = tuple(sorted(column))
+            if column not in class_ids:
+                class_ids[column] = len(class_ids) + 1
+            char_classes[code] = class_ids[column]
+        self.num_states = dfa.num_states
+        self.num_classes = len(class_ids) + 1
+
+        if self.num_classes <= 256:
+            self.classes = bytearray(256)
+        else:
+            self.classes = array("H", [0] * 256)
+        self.other_classes = {}
+        for code, cls in char_classes.iteritems():
+            if code < 256:
+                self.classes[code] = cls
+            else:
+                self.other_classes[code] = cls
+
+        self.table = array("i", [-1] * (self.num_states * self.num_classes))
+        for column, cls in class_ids.iteritems():
+            for state, nextstate in column:
+                self.table[state * self.num_classes + cls] = nextstate
+        self.final = bytearray(self.num_states)
+        for state in dfa.final_states:
+            self.final[state] = 1
+        # final states without transitions end a token right away
+        self.dead = bytearray(self.num_states)
+        for state in range(self.num_states):
+            self.dead[state] = 1
+        for (state, _) in dfa.transitions:
+            self.dead[state] = 0
+
+    def make_matcher(self):
+        """Return a function with the same interface and results as the one
+        built by `DFA.make_lexing_code`. Unlike the generated code it starts
+        in `runner.state`, so that a runner can resume reading a token from a
+        checkpoint, and calls `runner.checkpoint(i, state)` when it reaches
+        the index `runner.checkpoint_at` (see `cflexer.lexer`)."""
+        classes = self.classes
+        other_classes = self.other_classes
+        table = self.table
+        width = self.num_classes
+        final = self.final
+        dead = self.dead
+
+        def recognize(runner, i):
+            assert i >= 0
+            input = runner.text
+            state = runner.state
+            checkpoint_at = runner.checkpoint_at
+            while 1:
+                if final[state]:
+                    runner.last_matched_index = i - 1
+                    runner.last_matched_state = state
+                    if dead[state]:
+                        runner.state = state
+                        if i == len(input):
+                            return i
+                        return ~i
+                if i == checkpoint_at:
+                    checkpoint_at = runner.checkpoint(i, state)
+                try:
+                    char = input[i]
+                except IndexError:
+                    runner.state = state
+                    if final[state]:
+                        return i
+                    return ~i
+                i += 1
+                code = ord(char)
+                if code < 256:
+                    nextstate = table[state * width + classes[code]]
+                else:
+                    nextstate = table[state * width + other_classes.get(code, 0)]
+                if nextstate < 0:
+                    runner.state = state
+                    return ~i
+                state = nextstate
+        return recognize
+
 class DFARunner(object):
     def __init__(self, automaton):
         self.automaton = automaton
@@ -488,16 +629,28 @@ class NFA(object):
     def make_deterministic(self, name_precedence=None):
         fda = DFA()
         set_to_state = {}
+        # DFA states by the set of NFA states they were reached with, before
+        # taking the epsilon-closure, and closures of single states
+        move_to_state = {}
+        closures = {}
         stack = []
-        def get_dfa_state(states):
-            states = self.epsilon_closure(states)
+        def get_dfa_state(move):
+            try:
+                return move_to_state[move]
+            except KeyError:
+                pass
+            states = set()
+            for state in move:
+                if state not in closures:
+                    closures[state] = self.epsilon_closure([state])
+                states.update(closures[state])
             frozenstates = frozenset(states)
             if frozenstates in set_to_state:
-                return set_to_state[frozenstates]   # already created this state
+                result = move_to_state[move] = set_to_state[frozenstates]
+                return result   # already created this state
             if states == self.start_states:
                 assert not set_to_state
-            final = bool(
-                filter(None, [state in self.final_states for state in states]))
+            final = not self.final_states.isdisjoint(states)
             name = ", ".join([self.names[state] for state in states])
             if name_precedence is not None:
                 name_index = len(name_precedence)
@@ -518,22 +671,25 @@ class NFA(object):
                     else:
                         name = new_name
                     unmergeable = True
-            result = set_to_state[frozenstates] = fda.add_state(
-                name, final, unmergeable)
+            result = set_to_state[frozenstates] = move_to_state[move] = \
+                fda.add_state(name, final, unmergeable)
             stack.append((result, states))
             return result
-        startstate = get_dfa_state(self.start_states)
+        startstate = get_dfa_state(frozenset(self.start_states))
         while stack:
             fdastate, ndastates = stack.pop()
             chars_to_states = {}
             for state in ndastates:
                 sub_transitions = self.transitions.get(state, {})
                 for char, next_states in sub_transitions.iteritems():
-                    chars_to_states.setdefault(char, set()).update(next_states)
+                    if char is None:
+                        continue
+                    if char in chars_to_states:
+                        chars_to_states[char] = chars_to_states[char].union(next_states)
+                    else:
+                        chars_to_states[char] = next_states
             for char, states in chars_to_states.iteritems():
-                if char is None:
-                    continue
-                fda[fdastate, char] = get_dfa_state(states)
+                fda[fdastate, char] = get_dfa_state(frozenset(states))
         return fda
 
     def update(self, other):
@@ -550,6 +706,7 @@ class NFA(object):
         return mapping
 
     def view(self):
+        import py
         from dotviewer import graphclient
         p = py.test.ensuretemp("automaton").join("temp.dot")
         dot = self.dot()
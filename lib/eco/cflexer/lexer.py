@@ -19,7 +19,7 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
 # IN THE SOFTWARE.
 
-import py
+from array import array
 from cflexer import deterministic, regex
 
 class Token(object):
@@ -64,39 +64,121 @@ class SourcePos(object):
     def __repr__(self):
         return "SourcePos(%r, %r, %r)" % (self.i, self.lineno, self.columnno)
 
-import os
-try:
-    import cPickle as pickle
-except:
-    import pickle
+import grammarcache, tablefile
 
 class Lexer(object):
-    def __init__(self, token_regexs, names, ignore=None):
+    # use a dense transition table instead of generated code to run the
+    # automaton (see `deterministic.TransitionTable`)
+    table = True
+    # lex keywords with the other rules where possible and classify them
+    # afterwards (see `make_automaton`)
+    keywords = True
+
+    def __init__(self, token_regexs, names, ignore=None, automaton=None, table=None,
+                 transition_table=None, code=None, keywords=None):
         self.token_regexs = token_regexs
         self.names = names
         self.rex = regex.LexingOrExpression(token_regexs, names)
-        # pickling automaton to increase loading times
-        h = hash(str(token_regexs)) ^ hash(str(names))
-        filename = "".join([os.path.dirname(__file__), "/../pickle/", str(h), ".pcl"])
-        try:
-            f = open(filename, "r")
-            self.automaton = pickle.load(f)
-        except IOError:
-            automaton = self.rex.make_automaton()
-            self.automaton = automaton.make_deterministic(names)
-            self.automaton.optimize() # XXX not sure whether this is a good idea
-            pickle.dump(self.automaton, open(filename, "w"))
         if ignore is None:
             ignore = []
         for ign in ignore:
             assert ign in names
         self.ignore = dict.fromkeys(ignore)
-        self.matcher = self.automaton.make_lexing_code()
+        if keywords is not None:
+            self.keywords = keywords
+        if automaton is None:
+            # caching automaton to increase loading times
+            key = grammarcache.digest("DFA", str(token_regexs), str(names),
+                                      self.keywords, sorted(self.ignore))
+            automaton = grammarcache.cache.get(key, tablefile.load_dfa, tablefile.suffix)
+            if automaton is None:
+                automaton = self.make_automaton()
+                grammarcache.cache.put(key, automaton, tablefile.dump_dfa, tablefile.suffix)
+        self.automaton = automaton
+        if table is not None:
+            self.table = table
+        # the transition table or the compiled code the matcher was made
+        # from. Both can be passed in if they were stored with the automaton
+        self.transition_table = None
+        self.code = None
+        if self.table:
+            if transition_table is None:
+                transition_table = deterministic.TransitionTable(self.automaton)
+            self.transition_table = transition_table
+            self.matcher = transition_table.make_matcher()
+        else:
+            if code is None:
+                code = self.automaton.compile_lexing_code()
+            self.code = code
+            self.matcher = deterministic.code_matcher(code)
+
+    def build_automaton(self, rules):
+        # the automaton of the rules with the given indices
+        names = [self.names[i] for i in rules]
+        rex = regex.LexingOrExpression([self.token_regexs[i] for i in rules], names)
+        automaton = rex.make_automaton().make_deterministic(names)
+        automaton.optimize() # XXX not sure whether this is a good idea
+        return automaton
+
+    def make_automaton(self):
+        """Build the automaton of all rules. A keyword, i.e. a rule that
+        only matches a literal text, is left out if another rule matches its
+        text and the keyword has the higher priority: the text is lexed by
+        the other rule and classified afterwards, using `DFA.keywords`. This
+        keeps the automaton small without changing the tokens."""
+        rules = range(len(self.names))
+        keywords = {}
+        if self.keywords:
+            for i in rules:
+                if isinstance(self.token_regexs[i], regex.StringExpression) and \
+                        self.names[i] not in self.ignore:
+                    keywords[i] = self.token_regexs[i].string
+        if not keywords:
+            return self.build_automaton(rules)
+        automaton = self.build_automaton([i for i in rules if i not in keywords])
+        classified = []
+        texts = set()
+        for i in sorted(keywords):
+            text = keywords[i]
+            if text in texts:
+                # a keyword with the same text comes first
+                continue
+            texts.add(text)
+            state = end_state(automaton, text)
+            if state is None or state not in automaton.final_states:
+                continue
+            winner = automaton.names[state]
+            if winner in self.ignore or self.names.index(winner) < i:
+                continue
+            classified.append(i)
+        if len(classified) < len(keywords):
+            automaton = self.build_automaton([i for i in rules if i not in classified])
+        for i in classified:
+            text = keywords[i]
+            state = end_state(automaton, text)
+            keyword = automaton.add_state(self.names[i], final=True, unmergeable=True)
+            automaton.keywords.setdefault(state, {})[text] = keyword
+        return automaton
 
     def get_runner(self, text, eof=False):
         return LexingDFARunner(self.matcher, self.automaton, text,
                                self.ignore, eof)
 
+    def scan(self, text, ends=None, kinds=None, lookaheads=None):
+        """Tokenize `text` without creating any tokens. Returns three arrays
+        with the end index, the final state (the token's name is
+        `automaton.names[state]`) and the lookahead of every token. Unlike
+        `tokenize` this includes ignored tokens, so the tokens cover the whole
+        text. Arrays can be passed in to be reused."""
+        if ends is None:
+            ends = array("i")
+        if kinds is None:
+            kinds = array("i")
+        if lookaheads is None:
+            lookaheads = array("i")
+        self.get_runner(text).scan(ends, kinds, lookaheads)
+        return ends, kinds, lookaheads
+
     def tokenize(self, text, eof=False):
         """Return a list of Token's from text."""
         r = self.get_runner(text, eof)
@@ -111,12 +193,13 @@ class Lexer(object):
 
     def get_dummy_repr(self):
         return '%s\nlexer = DummyLexer(recognize, %r, %r)' % (
-                py.code.Source(self.matcher),
+                self.automaton.make_lexing_source(),
                 self.automaton,
                 self.ignore)
 
     def __getstate__(self):
-        return (self.token_regexs, self.names, self.ignore)
+        return (self.token_regexs, self.names, self.ignore, self.automaton, self.table,
+                None, None, self.keywords)
 
     def __setstate__(self, args):
         self.__init__(*args)
@@ -125,6 +208,15 @@ class Lexer(object):
         r = self.get_runner(text, eof)
         return r.find_next_token
 
+def end_state(automaton, text):
+    # the state `automaton` is in after reading `text`, None if it gets stuck
+    state = 0
+    for char in text:
+        state = automaton.transitions.get((state, char))
+        if state is None:
+            return None
+    return state
+
 class DummyLexer(Lexer):
     def __init__(self, matcher, automaton, ignore):
         self.token_regexs = None
@@ -134,8 +226,52 @@ class DummyLexer(Lexer):
         self.ignore = ignore
         self.matcher = matcher
 
+class Checkpoints(object):
+    """The states of the automaton while it read a token, recorded every
+    `AbstractLexingDFARunner.checkpoint_interval` characters. `states` holds
+    (offset, state, matched, matched_state) for every checkpoint, where
+    `matched` is the length and `matched_state` the final state of the longest
+    match so far. `text`, `state` and `lookahead` describe the token itself."""
+    __slots__ = ["text", "states", "state", "lookahead"]
+
+    def __init__(self, text, states, state, lookahead):
+        self.text = text
+        self.states = states
+        self.state = state
+        self.lookahead = lookahead
+
+class Synced(Exception):
+    """Raised while resuming a token when the automaton reaches a state that
+    it had at the same position of the unchanged rest of the token before.
+    From there on the new run is the same as the old one."""
+
+def common_prefix(a, b):
+    # compares slices so that the characters are compared in C
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[lo:mid] == b[lo:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+def common_suffix(a, b):
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[len(a) - mid:len(a) - lo] == b[len(b) - mid:len(b) - lo]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
 class AbstractLexingDFARunner(deterministic.DFARunner):
     i = 0
+    # record a checkpoint every this many characters of a token (0: never).
+    # Only the table-driven matcher supports checkpoints
+    checkpoint_interval = 0
+
     def __init__(self, matcher, automaton, text, eof=False):
         self.automaton = automaton
         self.state = 0
@@ -146,6 +282,137 @@ class AbstractLexingDFARunner(deterministic.DFARunner):
         self.matcher = matcher
         self.lineno = 0
         self.columnno = 0
+        # index at which the matcher calls `checkpoint` next
+        self.checkpoint_at = -1
+        # checkpoints of the last token, if any were recorded
+        self.checkpoints = None
+        self.token_start = 0
+        self.recorded = None
+        # set by `resume_at` for the token that is resumed, and while reading it
+        self.resume = None
+        self.resumed = None
+        self.sync = None
+
+    def resume_at(self, start, checkpoints, text):
+        """Start reading the token at index `start` from the last of its
+        `checkpoints` before the first change of its text, and stop reading it
+        as soon as the automaton syncs with a checkpoint in the unchanged end
+        of the text. `checkpoints` were recorded for the previous version of
+        the token, `text` is the token's new text."""
+        old = checkpoints.text
+        states = checkpoints.states
+        prefix = common_prefix(old, text)
+        unchanged_from = len(old) - common_suffix(old, text)
+        delta = len(text) - len(old)
+        j = 0
+        while j < len(states) and states[j] <= prefix:
+            j += 4
+        recorded = states[:j]
+        offset = recorded[-4] if recorded else 0
+        # the checkpoints to sync with (indices into `states`), last one first
+        sync = []
+        for k in range(len(states) - 4, -1, -4):
+            if states[k] < unchanged_from or states[k] + delta <= offset:
+                break
+            sync.append(k)
+        self.resume = (start, checkpoints, delta, recorded, sync)
+
+    def start_token(self, start):
+        # prepare reading the token at `start` and return the index to start
+        # reading from
+        self.token_start = start
+        self.checkpoints = None
+        self.resumed = None
+        self.sync = None
+        index = start
+        if self.checkpoint_interval:
+            self.recorded = array("i")
+        resume = self.resume
+        if resume is not None and resume[0] <= start:
+            self.resume = None
+            if resume[0] == start:
+                _, checkpoints, delta, recorded, self.sync = resume
+                self.resumed = (checkpoints, delta)
+                self.recorded = array("i", recorded)
+                if recorded:
+                    offset, self.state, matched, matched_state = recorded[-4:]
+                    if matched:
+                        self.last_matched_index = start + matched - 1
+                        self.last_matched_state = matched_state
+                    index = start + offset
+        self.checkpoint_at = self.next_checkpoint(index - start)
+        return index
+
+    def next_checkpoint(self, offset):
+        # index of the first checkpoint after `offset`, -1 if there is none
+        interval = self.checkpoint_interval
+        result = -1
+        if interval:
+            result = offset - offset % interval + interval
+        sync = self.sync
+        if sync:
+            checkpoints, delta = self.resumed
+            states = checkpoints.states
+            while sync and states[sync[-1]] + delta <= offset:
+                sync.pop()
+            if sync and (result < 0 or states[sync[-1]] + delta < result):
+                result = states[sync[-1]] + delta
+        if result < 0:
+            return -1
+        return self.token_start + result
+
+    def checkpoint(self, i, state):
+        # called by the matcher when it reaches `checkpoint_at`
+        offset = i - self.token_start
+        sync = self.sync
+        if sync:
+            checkpoints, delta = self.resumed
+            j = sync[-1]
+            if checkpoints.states[j] + delta == offset and checkpoints.states[j + 1] == state:
+                raise Synced(offset)
+        interval = self.checkpoint_interval
+        if interval and offset % interval == 0:
+            self.recorded.extend((offset, state,
+                self.last_matched_index + 1 - self.token_start,
+                self.last_matched_state))
+        return self.next_checkpoint(offset)
+
+    def synced_token(self, start, offset):
+        # the rest of the token is read the same way as before: it ends where
+        # it ended before and keeps the checkpoints that follow `offset`
+        checkpoints, delta = self.resumed
+        states = checkpoints.states
+        matched = self.last_matched_index + 1 - start
+        matched_state = self.last_matched_state
+        recorded = self.recorded
+        for j in range(self.sync[-1], len(states), 4):
+            if states[j + 2] + delta >= offset:
+                recorded.extend((states[j] + delta, states[j + 1],
+                                 states[j + 2] + delta, states[j + 3]))
+            else:
+                # the longest match was found before the changes
+                recorded.extend((states[j] + delta, states[j + 1],
+                                 matched, matched_state))
+        stop = start + len(checkpoints.text) + delta
+        self.last_matched_index = stop - 1
+        self.last_matched_state = checkpoints.state
+        self.state = checkpoints.state
+        return stop, checkpoints.lookahead
+
+    def make_checkpoints(self, source, lookahead):
+        # checkpoints of the token that was just read, if it has any
+        recorded = self.recorded
+        if not recorded:
+            return None
+        if recorded[-4] >= len(source):
+            # drop the checkpoints in the lookahead
+            j = len(recorded)
+            while j > 0 and recorded[j - 4] >= len(source):
+                j -= 4
+            recorded = recorded[:j]
+            if not recorded:
+                return None
+        return Checkpoints(source, recorded, self.last_matched_state, lookahead)
 
     def find_next_token(self):
         while 1:
@@ -160,7 +427,17 @@ class AbstractLexingDFARunner(deterministic.DFARunner):
             elif start >= len(self.text):
                 raise StopIteration
 
-            i = self.inner_loop(start)
+            try:
+                i = self.inner_loop(self.start_token(start))
+            except Synced, e:
+                stop, lookahead = self.synced_token(start, e.args[0])
+                source = self.text[start:stop]
+                result = self.make_token(start, self.last_matched_state, source, lookahead = lookahead)
+                self.checkpoints = Checkpoints(source, self.recorded, self.last_matched_state, lookahead)
+                self.adjust_position(source)
+                if self.ignore_token(self.last_matched_state):
+                    continue
+                return result
             if i < 0:
                 # normal token eating
                 i = ~i
@@ -177,6 +454,7 @@ class AbstractLexingDFARunner(deterministic.DFARunner):
                 source = self.text[start:stop]
                 #print self.text, i, self.last_matched_state
                 result = self.make_token(start, self.last_matched_state, source, lookahead = i - stop)
+                self.checkpoints = self.make_checkpoints(source, i - stop)
                 self.adjust_position(source)
                 if self.ignore_token(self.last_matched_state):
                     continue
@@ -202,6 +480,59 @@ class AbstractLexingDFARunner(deterministic.DFARunner):
             source_pos = SourcePos(i - 1, self.lineno, self.columnno)
             raise deterministic.LexerError(self.text, self.state, source_pos)
 
+    def scan(self, ends, kinds, lookaheads):
+        """Read the rest of the text like `find_next_token` does, but append
+        the end index, the final state and the lookahead of every token to
+        the given arrays instead of creating tokens. Ignored tokens are
+        included, so every token starts where the previous one ended."""
+        text = self.text
+        length = len(text)
+        matcher = self.matcher
+        keywords = self.automaton.keywords
+        self.checkpoint_at = -1
+        while 1:
+            start = self.last_matched_index + 1
+            if start >= length:
+                return
+            self.state = 0
+            i = matcher(self, start)
+            if i < 0:
+                i = ~i
+                stop = self.last_matched_index + 1
+                if start == stop:
+                    # the rest of the text (see `find_next_token`)
+                    ends.append(length)
+                    kinds.append(self.last_matched_state)
+                    lookaheads.append(i - stop)
+                    self.last_matched_index = length
+                    return
+                state = self.last_matched_state
+                if state in keywords:
+                    state = keywords[state].get(text[start:stop], state)
+                ends.append(stop)
+                kinds.append(state)
+                lookaheads.append(i - stop)
+                continue
+            if self.last_matched_index == i - 1:
+                # no progress (loop)
+                lookahead = 0
+                for from_, to in self.automaton.transitions.iterkeys():
+                    if from_ == self.state:
+                        lookahead = 1
+                        break
+                state = self.last_matched_state
+                if state in keywords:
+                    state = keywords[state].get(text[start:], state)
+                ends.append(length)
+                kinds.append(state)
+                lookaheads.append(lookahead)
+                self.last_matched_index = length
+                return
+            lineno = text.count("\n", 0, start)
+            columnno = start - text.rfind("\n", 0, start) - 1
+            source_pos = SourcePos(i - 1, lineno, columnno)
+            raise deterministic.LexerError(text, self.state, source_pos)
+
     def adjust_position(self, token):
         """Update the line# and col# as a result of this token."""
         newlines = token.count("\n")
@@ -249,5 +580,8 @@ class LexingDFARunner(AbstractLexingDFARunner):
         source_pos = SourcePos(index, self.lineno, self.columnno)
         if eof:
             return Token("EOF", "EOF", source_pos, lookahead)
-        return Token(self.automaton.names[self.last_matched_state],
-                     text, source_pos, lookahead)
+        state = self.last_matched_state
+        keywords = self.automaton.keywords
+        if state in keywords:
+            state = keywords[state].get(text, state)
+        return Token(self.automaton.names[state], text, source_pos, lookahead)
@@ -1,5 +1,4 @@
 from __future__ import with_statement
-import py
 import sys
 from cflexer.tree import Nonterminal, Symbol, RPythonVisitor
 from cflexer.codebuilder import Codebuilder
@@ -313,6 +312,7 @@ class ParserBuilder(RPythonVisitor, Codebuilder):
         m = {'Status': Status,
              'Nonterminal': Nonterminal,
              'Symbol': Symbol,}
+        import py
         exec py.code.Source(self.get_code()).compile() in m
         return m['Parser']
 
@@ -612,6 +612,7 @@ class ParserBuilder(RPythonVisitor, Codebuilder):
         automaton = regex.make_automaton().make_deterministic()
         automaton.optimize()
         matcher = automaton.make_lexing_code()
+        import py
         self.matchers[r] = py.code.Source(matcher)
         return matcher
 
@@ -723,6 +724,7 @@ class PackratParser(object):
 
 
 def test_generate():
+    import py
     f = py.path.local(__file__).dirpath().join("pypackrat.py")
     from pypackrat import PyPackratSyntaxParser
     p = PyPackratSyntaxParser(syntax)
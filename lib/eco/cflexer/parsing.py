@@ -1,4 +1,3 @@
-import py
 from cflexer.lexer import SourcePos
 from cflexer.tree import Node, Symbol, Nonterminal
 
@@ -184,7 +183,7 @@ class PackratParser(object):
         """NOT_RPYTHON"""
         follows = {}
         for rule in self.rules:
-            follow = py.builtin.set()
+            follow = set()
             follows[rule.nonterminal] = follow
             for expansion in rule.expansions:
                 if expansion and self.is_nonterminal(expansion[0]):
@@ -226,6 +225,7 @@ class ParserCompiler(object):
         miniglobals = globals().copy()
         miniglobals["baseclass"] = self.parser.__class__
         #print "\n".join(self.allcode)
+        import py
         exec py.code.Source("\n".join(self.allcode)).compile() in miniglobals
         kls = miniglobals["CompileableParser"]
         # XXX
@@ -1,9 +1,6 @@
-import py
 import string
 from cflexer.deterministic import NFA
 
-set = py.builtin.set
-
 class RegularExpression(object):
     def __init__(self):
         raise NotImplementedError("abstract base class")
@@ -185,6 +182,8 @@ class NotExpression(RegularExpression):
     def __invert__(self):
         return self.reg
 
+    def __repr__(self):
+        return "NotExpression(%r)" % (self.reg, )
 
 class LexingOrExpression(RegularExpression):
     def __init__(self, regs, names):
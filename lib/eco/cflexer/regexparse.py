@@ -1,4 +1,3 @@
-import py
 from cflexer.parsing import PackratParser, Rule
 from cflexer.tree import Nonterminal
 from cflexer.regex import StringExpression, RangeExpression
@@ -6,8 +5,6 @@ from cflexer.lexer import Lexer, DummyLexer
 from cflexer.deterministic import compress_char_set, DFA
 import string
 
-set = py.builtin.set
-
 ESCAPES = {
     "a": "\a",
     "b": "\b",
@@ -1966,6 +1963,7 @@ RegexParser.init_parser = Parser.__init__.im_func
 
 
 def test_generate():
+    import py
     f = py.path.local(__file__)
     oldcontent = f.read()
     s = "# GENERATED CODE BETWEEN THIS LINE AND ITS OTHER OCCURENCE\n".lower()
@@ -1,3 +1,4 @@
+import py
 from cflexer.deterministic import *
 #from rpython.translator.c.test.test_genc import compile
 
@@ -143,6 +144,47 @@ def test_simplify():
     assert not r.recognize("111111011111111")
 
 
+def test_optimize_merges_states():
+    a = DFA()
+    start = a.add_state("start")
+    ab = a.add_state("ab")
+    cd = a.add_state("cd")
+    end = a.add_state("end", final=True)
+    for char in "ab":
+        a[start, char] = ab
+        a[ab, "x"] = end
+    for char in "cd":
+        a[start, char] = cd
+        a[cd, "x"] = end
+    assert a.optimize()
+    assert a.num_states == 3
+    assert a.names[0] == "start"
+    assert a.names[1] == "ab, cd"
+    assert a.final_states == set([2])
+    r = a.get_runner()
+    for s in ["ax", "bx", "cx", "dx"]:
+        assert r.recognize(s)
+    assert not r.recognize("a")
+    assert not r.recognize("ex")
+    assert not a.optimize()
+
+def test_optimize_keeps_unmergeable_states():
+    a = DFA()
+    a.add_state("start")
+    a.add_state("IF", final=True, unmergeable=True)
+    a.add_state("NAME", final=True, unmergeable=True)
+    a.add_state("NAME2", final=True)
+    a.add_state("NAME3", final=True)
+    a[0, "i"] = 1
+    a[0, "j"] = 3
+    a[0, "k"] = 4
+    a[1, "f"] = 2
+    assert a.optimize()
+    assert a.num_states == 4
+    assert a.unmergeable_states == set([1, 2])
+    assert a.names == ["start", "IF", "NAME", "NAME2, NAME3"]
+    assert a.transitions == {(0, "i"): 1, (0, "j"): 3, (0, "k"): 3, (1, "f"): 2}
+
 def test_something():
     a = NFA()
     z0 = a.add_state("z0", start=True, final=True)
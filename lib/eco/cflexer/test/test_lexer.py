@@ -219,6 +219,205 @@ class TestDirectLexer(object):
         assert tok.name == "if"
         assert tok.source == "if"
 
+class TestTableMatcher(object):
+    def get_lexers(self):
+        digits = RangeExpression("0", "9")
+        lower = RangeExpression("a", "z")
+        keywords = StringExpression("if") | StringExpression("else")
+        rexs = [keywords,
+                AddExpression(lower, KleeneClosure(lower | digits)),
+                AddExpression(digits, KleeneClosure(digits)),
+                StringExpression("=="), StringExpression("="),
+                StringExpression(" ") | StringExpression("\n")]
+        names = ["KEYWORD", "NAME", "NUMBER", "EQ", "ASSIGN", "WHITE"]
+        return (Lexer(rexs, names, ["WHITE"], table=True),
+                Lexer(rexs, names, ["WHITE"], table=False))
+
+    def tokens(self, lexer, s):
+        runner = lexer.get_runner(s, eof=True)
+        result = []
+        while True:
+            try:
+                tok = runner.find_next_token()
+            except StopIteration:
+                return result
+            except deterministic.LexerError, e:
+                result.append(("error", e.source_pos.i))
+                return result
+            result.append((tok.name, tok.source, tok.source_pos.i,
+                           tok.lookahead))
+
+    def test_same_tokens_as_generated_code(self):
+        import random
+        table, code = self.get_lexers()
+        rand = random.Random(11)
+        alphabet = u"ifelsx09= \n+\xe4"
+        for _ in range(300):
+            s = u"".join(rand.choice(alphabet)
+                         for _ in range(rand.randint(0, 12)))
+            assert self.tokens(table, s) == self.tokens(code, s)
+
+    def test_selectable(self):
+        table, code = self.get_lexers()
+        assert table.table and not code.table
+        assert [t.name for t in table.tokenize("if x1 == 12")] == \
+               [t.name for t in code.tokenize("if x1 == 12")] == \
+               ["KEYWORD", "NAME", "EQ", "NUMBER"]
+
+class TestScan(object):
+    def get_lexers(self):
+        # without ignored tokens, which `scan` includes
+        return [Lexer(l.token_regexs, l.names, None, l.automaton, l.table)
+                for l in TestTableMatcher().get_lexers()]
+
+    def scanned(self, lexer, s):
+        try:
+            ends, kinds, lookaheads = lexer.scan(s)
+        except deterministic.LexerError, e:
+            return ("error", e.source_pos.i)
+        result = []
+        start = 0
+        for end, kind, lookahead in zip(ends, kinds, lookaheads):
+            name = lexer.automaton.names[kind]
+            result.append((name, s[start:end], start, lookahead))
+            start = end
+        return result
+
+    def tokenized(self, lexer, s):
+        try:
+            return [(t.name, t.source, t.source_pos.i, t.lookahead)
+                    for t in lexer.tokenize(s)]
+        except deterministic.LexerError, e:
+            return ("error", e.source_pos.i)
+
+    def test_same_as_tokenize(self):
+        import random
+        rand = random.Random(5)
+        alphabet = u"ifelsx09= \n+\xe4"
+        for lexer in self.get_lexers():
+            for _ in range(300):
+                s = u"".join(rand.choice(alphabet)
+                             for _ in range(rand.randint(0, 12)))
+                assert self.scanned(lexer, s) == self.tokenized(lexer, s)
+
+    def test_reuse_arrays(self):
+        from array import array
+        lexer = self.get_lexers()[0]
+        ends, kinds, lookaheads = array("i"), array("i"), array("i")
+        assert lexer.scan("if x", ends, kinds, lookaheads)[0] is ends
+        assert list(ends) == [2, 3, 4]
+        names = lexer.automaton.names
+        assert [names[kind] for kind in kinds] == ["KEYWORD", "WHITE", "NAME"]
+        assert list(lookaheads) == [1, 0, 1]
+
+class TestKeywords(object):
+    def get_lexers(self):
+        lower = RangeExpression("a", "z")
+        rexs = [StringExpression("if"), StringExpression("else"),
+                StringExpression("=="), StringExpression("in"),
+                AddExpression(lower, KleeneClosure(lower)),
+                StringExpression("int"), StringExpression(" ")]
+        names = ["IF", "ELSE", "EQ", "IN", "NAME", "INT", "WHITE"]
+        return (Lexer(rexs, names, ["WHITE"], keywords=True),
+                Lexer(rexs, names, ["WHITE"], keywords=False))
+
+    def test_classified(self):
+        classified, plain = self.get_lexers()
+        automaton = classified.automaton
+        keywords = sorted([automaton.names[keyword]
+                           for texts in automaton.keywords.values()
+                           for keyword in texts.values()])
+        # no other rule matches "==", and "int" never wins over NAME
+        assert keywords == ["ELSE", "IF", "IN"]
+        assert automaton.num_states < plain.automaton.num_states
+        assert [t.name for t in classified.tokenize("if iff in int else")] == \
+               ["IF", "NAME", "IN", "NAME", "ELSE"]
+
+    def test_same_tokens(self):
+        import random
+        classified, plain = self.get_lexers()
+        scan = TestScan()
+        rand = random.Random(3)
+        alphabet = ["if", "else", "in", "int", "==", "i", "n", "x", " "]
+        for _ in range(300):
+            s = "".join(rand.choice(alphabet) for _ in range(rand.randint(0, 6)))
+            assert scan.scanned(classified, s) == scan.scanned(plain, s)
+            assert scan.tokenized(classified, s) == scan.tokenized(plain, s)
+
+class CountingText(object):
+    # text that counts how often the lexer reads a character
+    def __init__(self, text):
+        self.text = text
+        self.reads = 0
+
+    def __len__(self):
+        return len(self.text)
+
+    def __getitem__(self, i):
+        self.reads += 1
+        return self.text[i]
+
+    def __getslice__(self, start, stop):
+        return self.text[start:stop]
+
+class TestCheckpoints(object):
+    def get_lexer(self):
+        from cflexer.regexparse import parse_regex
+        regexs = [r'"[^"]*"', r'[a-z]+', r' +', r'=']
+        return Lexer([parse_regex(r) for r in regexs], ["STRING", "NAME", "WS", "EQ"])
+
+    def tokens(self, runner):
+        result = []
+        for tok in runner:
+            result.append((tok.name, tok.source, tok.source_pos.i, tok.lookahead))
+        return result
+
+    def read_string(self, lexer, text, interval=4):
+        runner = lexer.get_runner(text)
+        runner.checkpoint_interval = interval
+        for tok in runner:
+            if tok.name == "STRING":
+                return tok, runner.checkpoints
+
+    def test_record(self):
+        lexer = self.get_lexer()
+        tok, checkpoints = self.read_string(lexer, 'x = "abcdefghij" y')
+        assert checkpoints.text == tok.source
+        assert checkpoints.lookahead == tok.lookahead
+        assert list(checkpoints.states[::4]) == [4, 8]
+        tok, checkpoints = self.read_string(lexer, 'x = "ab"', 4)
+        assert checkpoints is None
+
+    def test_resume(self):
+        lexer = self.get_lexer()
+        old = 'x = "' + "abcdefgh" * 10 + '" y'
+        tok, checkpoints = self.read_string(lexer, old)
+        for new in ['x = "' + "abcdefgh" * 5 + "X" + "abcdefgh" * 5 + '" y',
+                    'x = "' + "abcdefgh" * 5 + '" abc "' + "abcdefgh" * 5 + '" y',
+                    'x = "' + "abcdefgh" * 10 + ' y',
+                    'x = "' + "abcdefgh" * 10 + '"" y']:
+            string = new[4:len(tok.source) + len(new) - len(old) + 4]
+            text = CountingText(new)
+            runner = lexer.get_runner(text)
+            runner.checkpoint_interval = 4
+            runner.resume_at(4, checkpoints, string)
+            assert self.tokens(runner) == self.tokens(lexer.get_runner(new))
+
+    def test_sync(self):
+        lexer = self.get_lexer()
+        old = 'x = "' + "abcdefgh" * 100 + '" y'
+        tok, checkpoints = self.read_string(lexer, old)
+        new = old[:400] + "XY" + old[400:]
+        text = CountingText(new)
+        runner = lexer.get_runner(text)
+        runner.checkpoint_interval = 4
+        runner.resume_at(4, checkpoints, new[4:-2])
+        assert self.tokens(runner) == self.tokens(lexer.get_runner(new))
+        # only the characters around the change and the rest of the line
+        # were read again
+        assert text.reads < 20
+        assert runner.checkpoints is None # the last token is "y"
+
 class TestSourcePos(object):
     def test_copy(self):
         base = SourcePos(1, 2, 3)
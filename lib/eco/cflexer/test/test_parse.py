@@ -1,3 +1,4 @@
+import py
 from cflexer.lexer import Token, SourcePos
 from cflexer.parsing import *
 
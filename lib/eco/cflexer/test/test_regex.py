@@ -1,3 +1,4 @@
+import py
 from cflexer.regex import *
 #from rpython.translator.c.test.test_genc import compile
 
@@ -1,3 +1,4 @@
+import py
 from cflexer.lexer import *
 # Unused, but needed for some obscure reason
 from cflexer.makepackrat import BacktrackException, Status
@@ -1,7 +1,6 @@
-import py
-
 class Node(object):
     def view(self):
+        import py
         from dotviewer import graphclient
         content = ["digraph G{"]
         content.extend(self.dot())
@@ -56,7 +56,7 @@ from grammar_parser.gparser import Terminal, MagicTerminal, IndentationTerminal,
 
 from incparser.astree import TextNode, BOS, EOS, ImageNode, FinishSymbol
 
-from grammars.grammars import languages, newfile_langs, submenu_langs, lang_dict, Language, EcoGrammar
+from grammars.grammars import languages, newfile_langs, submenu_langs, lang_dict, Language, EcoGrammar, preload
 
 from time import time
 import os
@@ -472,14 +472,15 @@ class Window(QtGui.QMainWindow):
     def parse_options(self):
         # parse options
         parser = OptionParser(usage="usage: python2.7 %prog FILE [options]")
-        parser.add_option("-p", "--preload", action="store_true", default=False, help="Preload grammars")
+        parser.add_option("-p", "--preload", action="store_true", default=False, help="Preload grammars in the background")
+        parser.add_option("--preload-processes", type="int", default=0, metavar="N", help="Build grammars that aren't cached yet in N processes when preloading, 0 to build them in the background thread [default: %default]")
         parser.add_option("-v", "--verbose", action="store_true", default=False, help="Show output")
         parser.add_option("-l", "--log", default="WARNING", help="Log level: INFO, WARNING, ERROR [default: %default]")
         parser.add_option("-e", "--export", action="store_true", default=False, help="Fast export files. Usage: --export [SOURCE] [DESTINATION]")
         parser.add_option("-f", "--fullexport", action="store_true", default=False, help="Export files. Usage: --fullexport [SOURCE] [DESTINATION]")
         (options, args) = parser.parse_args()
         if options.preload:
-            self.preload()
+            self.preload(options.preload_processes)
         if options.fullexport:
             source = args[0]
             dest = args[1]
@@ -498,13 +499,10 @@ class Window(QtGui.QMainWindow):
             loglevel=logging.WARNING
         logging.basicConfig(format='%(levelname)s: %(message)s', filemode='w', level=loglevel)
 
-    def preload(self):
-        for l in newfile_langs + submenu_langs:
-            try:
-                print("Preloading %s" % (l.name))
-                l.load()
-            except AttributeError:
-                pass
+    def preload(self, processes=0):
+        def done(grammars):
+            print("Preloaded %s grammars" % (len(grammars)))
+        preload(newfile_langs + submenu_langs, done, processes)
 
     def cli_export(self, source, dest, fast):
         print("Exporting...")
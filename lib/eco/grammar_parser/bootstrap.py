@@ -356,7 +356,7 @@ class BootstrapParser(object):
         # add so far undefined terminals
         undefined_terminals = self.terminals.difference(set(names))
         import re
-        for t in undefined_terminals:
+        for t in sorted(undefined_terminals): # stable order for grammarcache
             names.insert(0, t)
             regexs.insert(0,re.escape(t))
         self.inclexer = IncrementalLexerCF()
@@ -0,0 +1,209 @@
+# Copyright (c) 2013--2014 King's College London
+# Created by the Software Development Team <http://soft-dev.org/>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""Persistent cache for the syntax tables, state graphs and lexer automata
+built from grammars.
+
+Entries are stored in files named after a SHA-1 digest of everything that
+went into building them (grammar text, alternatives, options) and of the
+source code that builds them, so a changed grammar or a changed table format
+never hits a stale entry. Files are written atomically, so concurrent editor
+and export processes never see half written entries, and the least recently
+used entries are evicted once the cache exceeds its size limit. Entries are
+pickled, unless a reader and writer for another format are given (see
+tablefile.py for the binary format of syntax tables and lexers).
+
+The location defaults to lib/eco/pickle and can be changed with the
+ECO_CACHE_DIR environment variable or `cache.set_directory`. The size limit
+(in MB) can be set with ECO_CACHE_SIZE."""
+
+import hashlib, logging, os, tempfile, time
+
+try:
+    import cPickle as pickle
+except:
+    import pickle
+
+# files containing the classes that end up in the cache. Any change to them
+# invalidates all entries
+code_files = [
+    "incparser/syntaxtable.py",
+    "incparser/stategraph.py",
+    "incparser/helpers.py",
+    "incparser/production.py",
+    "incparser/state.py",
+    "grammar_parser/gparser.py",
+    "grammar_parser/bootstrap.py",
+    "cflexer/lexer.py",
+    "cflexer/deterministic.py",
+    "cflexer/regex.py",
+    "inclexer/inclexer.py",
+    "grammarcache.py",
+    "tablefile.py",
+]
+
+_code_version = None
+def code_version():
+    global _code_version
+    if _code_version is None:
+        h = hashlib.sha1()
+        base = os.path.dirname(os.path.abspath(__file__))
+        for name in code_files:
+            with open(os.path.join(base, name), "rb") as f:
+                h.update(f.read())
+        _code_version = h.hexdigest()
+    return _code_version
+
+def digest(*parts):
+    """Return a stable key for the given strings (or objects with a stable
+    repr), including the current code version."""
+    h = hashlib.sha1(code_version())
+    for part in parts:
+        if isinstance(part, unicode):
+            part = part.encode("utf-8")
+        elif not isinstance(part, str):
+            part = repr(part)
+        h.update(str(len(part)))
+        h.update(":")
+        h.update(part)
+    return h.hexdigest()
+
+_file_digests = {}
+def file_digest(filename):
+    """Return the SHA-1 of a file's content, which is only read again if the
+    file's size or modification time changed."""
+    filename = os.path.abspath(filename)
+    st = os.stat(filename)
+    stamp = (st.st_mtime, st.st_size)
+    if filename in _file_digests and _file_digests[filename][0] == stamp:
+        return _file_digests[filename][1]
+    with open(filename, "rb") as f:
+        value = hashlib.sha1(f.read()).hexdigest()
+    _file_digests[filename] = (stamp, value)
+    return value
+
+class GrammarCache(object):
+
+    suffixes = (".pcl", ".tbl")
+
+    def __init__(self, directory=None, max_size=None):
+        if directory is None:
+            directory = os.environ.get("ECO_CACHE_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "pickle")
+        if max_size is None:
+            max_size = int(os.environ.get("ECO_CACHE_SIZE", 256)) * 1024 * 1024
+        self.directory = directory
+        self.max_size = max_size
+
+    def set_directory(self, directory):
+        self.directory = directory
+
+    def filename(self, key, suffix=".pcl"):
+        return os.path.join(self.directory, key + suffix)
+
+    def get(self, key, load=None, suffix=".pcl"):
+        """Return the entry for key, read from an open file by `load(f)`, or
+        None if there is no (readable) entry."""
+        filename = self.filename(key, suffix)
+        try:
+            f = open(filename, "rb")
+        except IOError:
+            return None
+        try:
+            start = time.time()
+            if load is None:
+                obj = pickle.load(f)
+            else:
+                obj = load(f)
+            logging.debug("loaded %s from cache in %s", key, time.time() - start)
+        except Exception:
+            logging.warning("removing broken cache entry %s", filename)
+            f.close()
+            self.remove(filename)
+            return None
+        f.close()
+        try:
+            os.utime(filename, None) # mark as recently used
+        except OSError:
+            pass
+        return obj
+
+    def put(self, key, obj, dump=None, suffix=".pcl"):
+        """Store obj under key, written to an open file by `dump(obj, f)`."""
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            fd, tmpname = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    if dump is None:
+                        pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
+                    else:
+                        dump(obj, f)
+            except:
+                self.remove(tmpname)
+                raise
+            filename = self.filename(key, suffix)
+            if os.name == "nt" and os.path.exists(filename):
+                os.remove(filename)
+            os.rename(tmpname, filename)
+        except (IOError, OSError) as e:
+            logging.warning("could not write cache entry %s: %s", key, e)
+            return
+        self.evict()
+
+    def entries(self):
+        # [(last use, size, filename)] of all entries
+        result = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return result
+        for name in names:
+            if not name.endswith(self.suffixes):
+                continue
+            filename = os.path.join(self.directory, name)
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            result.append((st.st_mtime, st.st_size, filename))
+        return result
+
+    def evict(self):
+        entries = self.entries()
+        size = sum([e[1] for e in entries])
+        for mtime, filesize, filename in sorted(entries):
+            if size <= self.max_size:
+                break
+            self.remove(filename)
+            size -= filesize
+
+    def remove(self, filename):
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+    def clear(self):
+        for _, _, filename in self.entries():
+            self.remove(filename)
+
+cache = GrammarCache()
@@ -19,6 +19,9 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
 # IN THE SOFTWARE.
 
+import logging, multiprocessing, os, threading
+import grammarcache, tablefile
+
 class Language(object):
 
     def __init__(self, name, grammar, priorities, base=""):
@@ -42,50 +45,96 @@ class EcoGrammar(object):
 
 _cache = {}
 class EcoFile(object):
+    # processes that build a grammar that isn't in the grammar cache together
+    # with the grammars of its language boxes when it is loaded. 0 builds it
+    # in this process: don't fork the editor (it may be loading a grammar in
+    # the preload thread), only set this for command line tools
+    processes = 0
+
     def __init__(self, name, filename, base=""):
         self.name = name
         self.filename = filename
         self.base = base
         self.alts = {}
         self.extract = None
+        self.lock = threading.Lock() # see `preload`
 
     def load(self):
+        from incparser.incparser import IncParser
+
+        entry = self.load_entry()
+        incparser = IncParser()
+        incparser.from_syntaxtable(entry["syntaxtable"], entry["whitespaces"])
+        incparser.init_ast()
+        return (incparser, entry["lexer"])
+
+    def load_entry(self):
+        with self.lock:
+            if not _cache.has_key(self.name):
+                # the syntax table and the lexer are stored together in the
+                # grammar cache, so a hit doesn't need to read the grammar at all
+                key = self.digest()
+                entry = grammarcache.cache.get(key, tablefile.load_grammar, tablefile.suffix)
+                if entry is None and self.processes > 1:
+                    # build the grammars of the language boxes at the same time
+                    missing = missing_grammars([self])
+                    if len(missing) > 1:
+                        try:
+                            build_grammars(missing, self.processes)
+                        except Exception:
+                            logging.exception("could not build grammars in parallel")
+                        entry = grammarcache.cache.get(key, tablefile.load_grammar, tablefile.suffix)
+                if entry is None:
+                    entry = self.build()
+                    grammarcache.cache.put(key, entry, tablefile.dump_grammar, tablefile.suffix)
+                _cache[self.name] = entry
+            return _cache[self.name]
+
+    def is_loaded(self):
+        return _cache.has_key(self.name)
+
+    def is_cached(self):
+        return os.path.exists(grammarcache.cache.filename(self.digest(), tablefile.suffix))
+
+    def dependencies(self):
+        """Return the grammars of the language boxes that can be used in this
+        grammar, including those that can be used in them, and so on."""
+        result = []
+        stack = [self]
+        while stack:
+            grammar = stack.pop()
+            for alternatives in grammar.alts.itervalues():
+                for name in alternatives:
+                    other = lang_dict.get(name[1:-1])
+                    if isinstance(other, EcoFile) and other is not self and other not in result:
+                        result.append(other)
+                        stack.append(other)
+        return result
+
+    def build(self):
         from grammar_parser.bootstrap import BootstrapParser
         from jsonmanager import JsonManager
 
-        if _cache.has_key(self.name + "::parser"):
-
-            root, language, whitespaces = _cache[self.name + "::json"]
-
-            pickle_id, whitespace = _cache[self.name + "::parser"]
-            from incparser.incparser import IncParser
-            incparser = IncParser()
-            incparser.from_dict(None, None, None, whitespace, pickle_id, None)
-            incparser.init_ast()
-
-            inclexer = _cache[self.name + "::lexer"]
-
-            return (incparser, inclexer)
-        else:
-            manager = JsonManager(unescape=True)
-            root, language, whitespaces = manager.load(self.filename)[0]
-
-            pickle_id = hash(self)
-            bootstrap = BootstrapParser(lr_type=1, whitespaces=whitespaces)
-            bootstrap.ast = root
-            bootstrap.extra_alternatives = self.alts
-            bootstrap.change_startrule = self.extract
-            bootstrap.read_options()
+        manager = JsonManager(unescape=True)
+        root, language, whitespaces = manager.load(self.filename)[0]
 
-            bootstrap.create_parser(pickle_id)
-            whitespace = bootstrap.implicit_ws()
+        bootstrap = BootstrapParser(lr_type=1, whitespaces=whitespaces)
+        bootstrap.ast = root
+        bootstrap.extra_alternatives = self.alts
+        bootstrap.change_startrule = self.extract
+        bootstrap.read_options()
 
-            bootstrap.create_lexer()
+        bootstrap.create_parser()
+        bootstrap.create_lexer()
+        return {"syntaxtable": bootstrap.incparser.syntaxtable,
+                "whitespaces": bootstrap.implicit_ws(),
+                "lexer": bootstrap.inclexer}
 
-            _cache[self.name + "::lexer"] = bootstrap.inclexer
-            _cache[self.name + "::json"] = (root, language, whitespaces)
-            _cache[self.name + "::parser"] = (pickle_id, whitespace)
-            return (bootstrap.incparser, bootstrap.inclexer)
+    def digest(self):
+        # stable key for the grammar cache (unlike `hash`, which differs
+        # between processes if hash randomisation is enabled)
+        return grammarcache.digest("EcoFile", grammarcache.file_digest(self.filename),
+                                   sorted(self.alts.items()), self.extract)
 
     def add_alternative(self, nonterminal, language):
         if nonterminal not in self.alts:
@@ -99,10 +148,71 @@ class EcoFile(object):
         return self.name
 
     def __hash__(self):
-        h1 = hash(file(self.filename, "r").read())
-        h2 = hash(repr(self.alts))
-        h3 = hash(str(self.extract))
-        return h1 ^ h2 ^ h3
+        return hash(self.digest())
+
+def build_cache_entry(name):
+    """Build the tables of a grammar into the grammar cache, unless they are
+    already there. Runs in the worker processes of `build_grammars`."""
+    grammar = lang_dict[name]
+    if not grammar.is_cached():
+        grammarcache.cache.put(grammar.digest(), grammar.build(), tablefile.dump_grammar, tablefile.suffix)
+    return name
+
+def missing_grammars(grammars):
+    """Return the names of the grammars and of the grammars of their language
+    boxes that are neither loaded nor in the grammar cache."""
+    missing = []
+    digests = set()
+    for grammar in grammars:
+        for g in [grammar] + grammar.dependencies():
+            # e.g. "IPython" uses the same tables as "Python 2.7.5"
+            digest = g.digest()
+            if digest not in digests and not g.is_loaded() and not g.is_cached():
+                digests.add(digest)
+                missing.append(g.name)
+    return missing
+
+def build_grammars(names, processes):
+    """Build the named grammars into the grammar cache in a pool of
+    processes. The grammars don't depend on each other, so each process
+    builds the lexer and the syntax table of one grammar at a time."""
+    pool = multiprocessing.Pool(min(processes, len(names)))
+    try:
+        pool.map(build_cache_entry, names, 1)
+    finally:
+        pool.close()
+        pool.join()
+
+def preload(grammars, callback=None, processes=0):
+    """Load grammars in a background thread, so they are ready by the time
+    they are used. With processes > 0, grammars that aren't in the grammar
+    cache yet are first built by a pool of processes, so building them doesn't
+    compete with the editor for the interpreter. Calls callback with the
+    loaded grammars (from the background thread) when done."""
+    grammars = [g for g in grammars if isinstance(g, EcoFile)]
+    grammars = [g for i, g in enumerate(grammars) if g not in grammars[:i]]
+
+    def run():
+        missing = missing_grammars(grammars)
+        if processes > 0 and missing:
+            try:
+                build_grammars(missing, processes)
+            except Exception:
+                logging.exception("could not build grammars in the background")
+        loaded = []
+        for g in grammars:
+            try:
+                g.load_entry()
+                loaded.append(g)
+            except Exception:
+                logging.exception("could not preload %s", g.name)
+        if callback:
+            callback(loaded)
+
+    thread = threading.Thread(target=run, name="preload")
+    thread.daemon = True
+    thread.start()
+    return thread
 
 from eco_grammar import eco_grammar # needed to edit EcoGrammar
 
@@ -0,0 +1,204 @@
+# Copyright (c) 2013--2014 King's College London
+# Created by the Software Development Team <http://soft-dev.org/>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+"""Records changes to the document, so that previous versions of it can be
+restored directly, without lexing or parsing anything again.
+
+Code that changes the document calls `save` before changing an attribute of
+a node, symbol, line or parser, and `save_item` and `save_list` before
+changing a dict or list in place. While a Journal is recording, the first of
+these calls for an object saves its old state. Objects created while
+recording (see `created`) aren't saved, since they aren't part of the
+previous version. The size of a journal thus only depends on how many objects
+an edit changed. Restoring a journal swaps the saved states with the current
+ones, so restoring it again redoes the edit.
+
+Only changes made by the thread that started recording are recorded, so
+grammars that are loaded in the background aren't affected."""
+
+from thread import get_ident
+from itertools import compress, repeat
+from operator import is_not
+
+MISSING = object() # attribute or item that wasn't set
+
+journal = None  # the journal that is currently recording
+
+def save(obj, name=None):
+    """Must be called before changing an attribute of `obj`. If `name` is
+    given only that attribute is saved, which is cheaper for changes that
+    are made to many objects (e.g. the lengths of all parents of a node)."""
+    j = journal
+    if j is not None:
+        if name is None:
+            j.save(obj)
+        else:
+            j.save_attr(obj, name)
+
+def save_item(d, key):
+    """Must be called before changing or deleting `d[key]`."""
+    j = journal
+    if j is not None:
+        j.save_item(d, key)
+
+def save_list(l):
+    """Must be called before changing the list `l` in place."""
+    j = journal
+    if j is not None:
+        j.save_list(l)
+
+def created(obj):
+    """Must be called by the constructors of objects that are saved."""
+    j = journal
+    if j is not None and j.thread == get_ident():
+        j.created.add(id(obj))
+
+_slots = {} # class -> (names of the slots of its instances, MISSING for each)
+
+def get_slots(cls):
+    slots = _slots.get(cls)
+    if slots is None:
+        names = []
+        for c in reversed(cls.__mro__):
+            for name in c.__dict__.get("__slots__", ()):
+                if name not in ("__dict__", "__weakref__") and name not in names:
+                    names.append(name)
+        slots = _slots[cls] = (tuple(names), (MISSING,) * len(names))
+    return slots
+
+def get_state(obj):
+    names, missing = get_slots(type(obj))
+    values = map(getattr, repeat(obj, len(names)), names, missing)
+    d = getattr(obj, "__dict__", None)
+    if d is not None:
+        d = d.copy()
+    return values, d
+
+def swap_state(obj, state):
+    """Restore the saved `state` of `obj` and return its current one."""
+    current = get_state(obj)
+    values, d = state
+    names = get_slots(type(obj))[0]
+    for name, value in compress(zip(names, values), map(is_not, values, current[0])):
+        if value is not MISSING:
+            setattr(obj, name, value)
+        else:
+            delattr(obj, name)
+    if d is not None:
+        obj.__dict__.clear()
+        obj.__dict__.update(d)
+    return current
+
+class Journal(object):
+
+    def __init__(self):
+        self.objects = {}       # id(obj) -> (obj, old state)
+        self.attrs = {}         # id(obj) -> (obj, {attribute: old value})
+        self.items = {}         # id(dict) -> (dict, {key: old value})
+        self.lists = {}         # id(list) -> (list, old items)
+        self.created = set()    # ids of objects created while recording
+        self.thread = None
+
+    def start(self):
+        global journal
+        assert journal is None
+        self.thread = get_ident()
+        journal = self
+
+    def stop(self):
+        global journal
+        journal = None
+        self.created = set()
+
+    def save(self, obj):
+        key = id(obj)
+        if key in self.objects or key in self.created or self.thread != get_ident():
+            return
+        self.objects[key] = (obj, get_state(obj))
+
+    def save_attr(self, obj, name):
+        key = id(obj)
+        if key in self.objects or key in self.created or self.thread != get_ident():
+            return
+        entry = self.attrs.get(key)
+        if entry is None:
+            entry = self.attrs[key] = (obj, {})
+        if name not in entry[1]:
+            entry[1][name] = getattr(obj, name)
+
+    def save_item(self, d, key):
+        if self.thread != get_ident():
+            return
+        entry = self.items.get(id(d))
+        if entry is None:
+            entry = self.items[id(d)] = (d, {})
+        if key not in entry[1]:
+            entry[1][key] = d.get(key, MISSING)
+
+    def save_list(self, l):
+        if id(l) not in self.lists and self.thread == get_ident():
+            self.lists[id(l)] = (l, l[:])
+
+    def restore(self):
+        """Restore the recorded states and save the current ones instead."""
+        # attributes can be saved before the whole object is, so they are
+        # restored last
+        attrs = []
+        for obj, saved in self.attrs.itervalues():
+            for name, old in saved.items():
+                saved[name] = getattr(obj, name)
+                attrs.append((obj, name, old))
+        for key, (obj, old) in self.objects.items():
+            self.objects[key] = (obj, swap_state(obj, old))
+        for obj, name, old in attrs:
+            setattr(obj, name, old)
+        for d, saved in self.items.itervalues():
+            for key, old in saved.items():
+                saved[key] = d.get(key, MISSING)
+                if old is not MISSING:
+                    d[key] = old
+                elif saved[key] is not MISSING:
+                    del d[key]
+        for key, (l, old) in self.lists.items():
+            self.lists[key] = (l, l[:])
+            l[:] = old
+
+    def merge(self, other):
+        """Add the changes of the later journal `other` to this one."""
+        for key, (obj, saved) in other.attrs.iteritems():
+            if key in self.objects:
+                # the whole object was saved before
+                continue
+            entry = self.attrs.setdefault(key, (obj, {}))
+            for name, old in saved.iteritems():
+                entry[1].setdefault(name, old)
+        for key, value in other.objects.iteritems():
+            self.objects.setdefault(key, value)
+        for key, (d, saved) in other.items.iteritems():
+            entry = self.items.setdefault(key, (d, {}))
+            for k, old in saved.iteritems():
+                entry[1].setdefault(k, old)
+        for key, value in other.lists.iteritems():
+            self.lists.setdefault(key, value)
+
+    def __len__(self):
+        return len(self.objects) + len(self.attrs) + len(self.items) + len(self.lists)
@@ -20,10 +20,16 @@
 # IN THE SOFTWARE.
 
 from grammar_parser.plexer import PriorityLexer
-from grammar_parser.gparser import MagicTerminal, Terminal, IndentationTerminal
+from grammar_parser.gparser import MagicTerminal, Terminal, IndentationTerminal, Nonterminal
 from incparser.astree import BOS, EOS, TextNode, ImageNode
 from PyQt4.QtGui import QImage
 import re, os
+import history
+
+# number of children of the nodes built by `relex_import`
+IMPORT_GROUP_SIZE = 32
+# characters between the lexer checkpoints of a token
+CHECKPOINT_INTERVAL = 64
 
 class IncrementalLexer(object):
     # XXX needs to be replaced by a lexing automaton to avoid uneccessary
@@ -185,7 +191,7 @@ class IncrementalLexer(object):
                 new_x  += len(match[0])
                 debug_old.append(old_node.symbol.name)
                 debug_new.append(match[0])
-                old_node.symbol.name = match[0]
+                old_node.set_text(match[0])
                 old_node.lookup = match[1]
 
                 if self.language == "Chemicals":
@@ -305,7 +311,7 @@ class IncrementalLexer(object):
                 new_x  += len(match[0])
                 debug_old.append(old_node.symbol.name)
                 debug_new.append(match[0])
-                old_node.symbol.name = match[0]
+                old_node.set_text(match[0])
                 old_node.lookup = match[1]
 
                 if self.language == "Chemicals":
@@ -356,12 +362,15 @@ class IncrementalLexer(object):
         last_node.next_term = eos
         eos.left = last_node
         eos.prev_term = last_node
+        parent.set_children(parent.children) # renumber children, update lengths
 
+from itertools import izip
 from cflexer.regexparse import parse_regex
 from cflexer.lexer import Lexer
 class IncrementalLexerCF(object):
     def __init__(self, rules=None, language=""):
         self.indentation_based = False
+        self.lookup_ids = {}
         if rules:
             if rules.startswith("%"):
                 config_line = rules.splitlines()[0]     # get first line
@@ -402,9 +411,21 @@ class IncrementalLexerCF(object):
     def is_indentation_based(self):
         return self.indentation_based
 
+    def set_lookup_ids(self, terminal_ids):
+        # the parser's ids for the token names, which are stored on the nodes
+        # together with the token name so the parser doesn't have to look
+        # them up for every token
+        self.lookup_ids = terminal_ids
+
     def lex(self, text):
-        tokens = self.lexer.tokenize(text)
-        return self.reformat_tokens(tokens)
+        ends, kinds, _ = self.lexer.scan(text)
+        names = self.lexer.automaton.names
+        l = []
+        start = 0
+        for end, kind in izip(ends, kinds):
+            l.append((text[start:end], names[kind]))
+            start = end
+        return l
 
     def reformat_tokens(self, tokens):
         l = []
@@ -413,28 +434,63 @@ class IncrementalLexerCF(object):
         return l
 
     def relex_import(self, startnode):
-        success = self.lex(startnode.symbol.name)
+        """Replaces `startnode` by the tokens of its text. The tokens are
+        grouped into a balanced tree of changed `~IMPORT~` nodes while they
+        are lexed, which the parser breaks down again on the first parse.
+        This way no node ends up with all the tokens as its children, which
+        would make inserting and removing nodes (e.g. indentation tokens)
+        quadratic before the first successful parse."""
+        text = startnode.symbol.name
         bos = startnode.prev_term # bos
         startnode.parent.remove_child(startnode)
         parent = bos.parent
+        history.save_list(parent.children)
         eos = parent.children.pop()
+        history.save(bos)
+        history.save(eos)
         last_node = bos
-        for match in success:
-            node = TextNode(Terminal(match[0]))
-            node.lookup = match[1]
-            parent.children.append(node)
+        names = self.lexer.automaton.names
+        lookup_ids = [self.lookup_ids.get(name) for name in names]
+        ends, kinds, _ = self.lexer.scan(text)
+        groups = [[]] # unfinished groups of nodes, one per tree level
+        start = 0
+        for end, kind in izip(ends, kinds):
+            node = TextNode(Terminal(text[start:end]))
+            start = end
+            node.lookup = names[kind]
+            node.lookup_id = lookup_ids[kind]
             last_node.next_term = node
-            last_node.right = node
-            node.left = last_node
             node.prev_term = last_node
-            node.parent = parent
             last_node = node
-        parent.children.append(eos)
-        last_node.right = eos # link to eos
+            level = 0
+            while True:
+                group = groups[level]
+                group.append(node)
+                if len(group) < IMPORT_GROUP_SIZE:
+                    break
+                node = self.import_group(group)
+                groups[level] = []
+                level += 1
+                if level == len(groups):
+                    groups.append([])
+        # add what is left of each level to the level above
+        top = []
+        for group in groups:
+            if len(top) > 1:
+                group.append(self.import_group(top))
+            elif top:
+                group.append(top[0])
+            top = group
+        parent.set_children(parent.children + top + [eos])
         last_node.next_term = eos
-        eos.left = last_node
         eos.prev_term = last_node
 
+    def import_group(self, children):
+        node = TextNode(Nonterminal("~IMPORT~"))
+        node.set_children(children)
+        node.changed = True
+        return node
+
     def relex(self, node):
         # find farthest node that has lookahead into node
         # start munching tokens and spit out nodes
@@ -458,10 +514,20 @@ class IncrementalLexerCF(object):
         # relex
         read_nodes = []
         generated_tokens = []
+        checkpoints = []
         pos = 0
         read = 0
         current_node = node
-        next_token = self.lexer.get_token_iter(StringWrapper(node))
+        runner = self.lexer.get_runner(StringWrapper(node))
+        if self.lexer.table:
+            # long tokens remember the lexer's state every few characters, so
+            # that they don't have to be read again from the beginning after
+            # they were edited
+            runner.checkpoint_interval = CHECKPOINT_INTERVAL
+            if startnode.checkpoints is not None:
+                start = sum(len(n.symbol.name) for n in nodes)
+                runner.resume_at(start, startnode.checkpoints, startnode.symbol.name)
+        next_token = runner.find_next_token
         while True:
             token = next_token()
             if token.source == "":
@@ -479,8 +545,10 @@ class IncrementalLexerCF(object):
                     if e is not l[-1]:
                         newline = self.lexer.tokenize("\r")
                         generated_tokens.extend(newline)
+                checkpoints.extend([None] * (len(generated_tokens) - len(checkpoints)))
             else:
                 generated_tokens.append(token)
+                checkpoints.append(runner.checkpoints)
             while read > pos + len(current_node.symbol.name):
                 pos += len(current_node.symbol.name)
                 read_nodes.append(current_node)
@@ -494,7 +562,7 @@ class IncrementalLexerCF(object):
         any_changes = False
         # insert new nodes into tree
         it = iter(read_nodes)
-        for t in generated_tokens:
+        for t, cp in zip(generated_tokens, checkpoints):
             try:
                 node = it.next()
             except StopIteration:
@@ -502,11 +570,16 @@ class IncrementalLexerCF(object):
                 last_node.insert_after(node)
                 any_changes = True
             last_node = node
-            node.symbol.name = t.source
+            node.set_text(t.source)
+            history.save(node)
             if node.lookup != t.name:
                 any_changes = True
+                # invalidates the first terminals cached on the parents
+                node.mark_changed()
             node.lookup = t.name
+            node.lookup_id = self.lookup_ids.get(t.name)
             node.lookahead = t.lookahead
+            node.checkpoints = cp
         # delete left over nodes
         while True:
             try:
@@ -532,30 +605,55 @@ class IncrementalLexerCF(object):
         return nodes
 
 IncrementalLexer = IncrementalLexerCF
+
 import sys
 
+def is_line_boundary(node):
+    return (isinstance(node, EOS) or isinstance(node.symbol, IndentationTerminal)
+            or node.symbol.name == "\r" or isinstance(node.symbol, MagicTerminal))
+
 class StringWrapper(object):
-    # XXX This is just a temprary solution. To do this right we have to alter
-    # the lexer to work on (node, index)-tuples
+    """Presents the text of the nodes following `startnode` to the lexer.
+
+    Indices are absolute offsets from the beginning of `startnode`. The
+    wrapper remembers the last node it read from (and that node's offset),
+    so that reading the text character by character only steps from one node
+    to the next instead of walking the chain from `startnode` every time."""
 
     def __init__(self, startnode):
         self.node = startnode
         self.length = sys.maxint
+        # cursor: the last node read and its offset
+        self.current = startnode
+        self.offset = 0
+        # end of the text up to the first line boundary, once it has been seen
+        self.line_end = None
 
     def __len__(self):
         return self.length
 
-    def __getitem__(self, index):
-        startindex = index
-        node = self.node
-        while index > len(node.symbol.name) - 1:
-            index -= len(node.symbol.name)
+    def seek(self, index):
+        node = self.current
+        offset = self.offset
+        while index < offset:
+            node = node.prev_term
+            offset -= len(node.symbol.name)
+        while index >= offset + len(node.symbol.name):
+            offset += len(node.symbol.name)
             node = node.next_term
             if node is None:
                 raise IndexError
-        if node.next_term and (isinstance(node.next_term, EOS) or isinstance(node.next_term.symbol, IndentationTerminal) or node.next_term.symbol.name == "\r" or isinstance(node.next_term.symbol, MagicTerminal)):
-            self.length = startindex + len(node.symbol.name[index:])
-        return node.symbol.name[index]
+            if self.line_end is None and is_line_boundary(node):
+                self.line_end = offset
+        self.current = node
+        self.offset = offset
+        return node, offset
+
+    def __getitem__(self, index):
+        node, offset = self.seek(index)
+        if node.next_term and is_line_boundary(node.next_term):
+            self.length = offset + len(node.symbol.name)
+        return node.symbol.name[index - offset]
 
     def __getslice__(self, start, stop):
         if stop <= start:
@@ -565,20 +663,19 @@ class StringWrapper(object):
         if start < len(name) and stop < len(name):
             return name[start: stop]
 
+        # slices never reach beyond the first line boundary
+        try:
+            node, offset = self.seek(start)
+        except IndexError:
+            return ""
+        if self.line_end is not None:
+            stop = min(stop, self.line_end)
         text = []
-        node = self.node
-        i = 0
-        while i < stop:
+        end = offset
+        while end < stop:
             text.append(node.symbol.name)
-            i += len(node.symbol.name)
+            end += len(node.symbol.name)
             node = node.next_term
-            if isinstance(node, EOS):
-                break
-            if isinstance(node.symbol, IndentationTerminal):
+            if is_line_boundary(node):
                 break
-            if node.symbol.name == "\r":
-                break
-            if isinstance(node.symbol, MagicTerminal):
-                break
-
-        return "".join(text)[start:stop]
+        return "".join(text)[start - offset:stop - offset]
@@ -20,8 +20,9 @@
 # IN THE SOFTWARE.
 
 import re
-from grammar_parser.gparser import Nonterminal, Terminal, IndentationTerminal
+from grammar_parser.gparser import Nonterminal, Terminal, MagicTerminal, IndentationTerminal
 from syntaxtable import FinishSymbol
+import history
 
 class AST(object):
     def __init__(self, parent=None):
@@ -43,28 +44,19 @@ class AST(object):
     def get_nodes_at_position(self, pos, a=None, b=None):
         """
         Searches all nodes that match the current cursor position in the TextField.
-        As a side effect all passed nodes are updated with their position in the document.
+        As a side effect the found nodes are updated with their position in the document.
         """
-        print("================== get nodes at pos ================== ")
-        progress = 0
-        node = self.parent.children[0]
-        while node is not None:
-            node.position = progress
-            progress += len(node.symbol.name)
-
-            print("node", node)
-            if pos < progress:
-                return [node, None]
-
-            if pos == progress:
-                print("pos == progress")
-                other = node.next_terminal()
-                print("other", other)
-                other.position = progress
-                return [node, other]
-
-            node = node.next_terminal()
-        print ("================ end get nodes at pos ================ ")
+        node, start = self.parent.find_offset(pos)
+        if node is None:
+            if pos > self.parent.textlen:
+                return None
+            node = self.parent.children[-1]
+        node.position = start
+        if pos > start:
+            return [node, None]
+        previous = node.prev_term
+        previous.position = start - previous.textlen
+        return [previous, node]
 
 
     def get_nodes_at_position_old(self, pos, node=None, bla=0):
@@ -89,18 +81,13 @@ class AST(object):
             self.progress += len(node.symbol.name)
             return nodes
 
-    def find_node_at_pos(self, pos, node=None): #recursive
+    def find_node_at_pos(self, pos, node=None):
         if node is None:
-           node = self.parent.children[1]
-
-        if isinstance(node.symbol, Nonterminal):
-            for child in node.children:
-                result = self.find_node_at_pos(pos, child)
-                if result:
-                    return result
-
-        if node.pos + len(node.symbol.name) >= pos:
-            return node
+            node = self.parent
+        result, _ = node.find_offset(pos)
+        if result is None:
+            return node.children[-1]
+        return result
 
 
     def find_node_at_pos_iterative(self, pos): #not working
@@ -153,8 +140,9 @@ class AST(object):
         return "\n".join(output)
 
 class Node(object):
-    __slots__ = ["symbol", "state", "parent", "left", "right", "prev_term", "next_term", "magic_parent", "children"]
+    __slots__ = ["symbol", "state", "parent", "left", "right", "prev_term", "next_term", "magic_parent", "children", "child_index", "textlen", "newlines"]
     def __init__(self, symbol, state, children):
+        history.created(self)
         self.symbol = symbol
         self.state = state
         self.parent = None
@@ -163,6 +151,9 @@ class Node(object):
         self.prev_term = None
         self.next_term = None
         self.magic_parent = None
+        self.child_index = 0    # last known position in the parent's children
+        self.textlen = 0    # length of the text in this subtree
+        self.newlines = 0   # number of linebreak tokens in this subtree
         self.set_children(children)
 
     def mark_changed(self):
@@ -170,61 +161,219 @@ class Node(object):
         #node.changed = True
         while node.parent and node.parent.changed is False:
             node = node.parent
+            history.save(node, "changed")
             node.changed = True
 
     def set_children(self, children):
+        history.save(self)
         self.children = children
         last = None
+        i = 0
         for c in children:
+            history.save(c)
             c.parent = self
+            c.child_index = i
             c.left = last
             if last is not None:
                 last.right = c
             last = c
+            i += 1
         if last is not None:
             last.right = None # last child has no right sibling
+        self.update_length()
+
+    def get_length(self):
+        """Return the length and the number of linebreaks of this node's own
+        text. Language boxes count the text inside of them, indentation
+        tokens and the ends of the tree don't count at all. Like the editor,
+        only "\\r" tokens count as linebreaks, not the ones inside of
+        multiline strings or comments."""
+        symbol = self.symbol
+        if isinstance(symbol, MagicTerminal):
+            ast = getattr(symbol, "ast", None)
+            if ast is None:
+                return 0, 0
+            return ast.textlen, ast.newlines
+        if isinstance(symbol, IndentationTerminal) or not isinstance(symbol, Terminal):
+            return 0, 0
+        return len(symbol.name), int(symbol.name == "\r")
+
+    def update_length(self):
+        """Recompute the cached text length and linebreaks of this node from
+        its children (or its own text) and update its ancestors."""
+        if self.children:
+            textlen = 0
+            newlines = 0
+            for c in self.children:
+                textlen += c.textlen
+                newlines += c.newlines
+        else:
+            textlen, newlines = self.get_length()
+        self.add_length(textlen - self.textlen, newlines - self.newlines)
 
-    def remove_child(self, child):
-        for i in xrange(len(self.children)):
-            if self.children[i] is child:
-                removed_child = self.children.pop(i)
-                removed_child.deleted = True
-                # update siblings
-                if removed_child.left:
-                    removed_child.left.right = removed_child.right
-                if removed_child.right:
-                    removed_child.right.left = removed_child.left
-                # update terminal pointers
-                child.prev_term.next_term = child.next_term
-                child.next_term.prev_term = child.prev_term
-                self.mark_changed()
-                self.changed = True
+    def add_length(self, textlen, newlines):
+        if textlen == 0 and newlines == 0:
+            return
+        node = self
+        while node is not None:
+            history.save(node, "textlen")
+            node.textlen += textlen
+            if newlines:
+                history.save(node, "newlines")
+                node.newlines += newlines
+            if getattr(node, "deleted", False):
+                # not part of the tree anymore
                 return
+            parent = node.parent
+            if parent is None:
+                # continue outside of language boxes
+                parent = getattr(node, "magic_backpointer", None)
+            node = parent
+
+    def find_offset(self, offset):
+        """Return the terminal that contains the character at `offset` in
+        this subtree's text, together with the offset the terminal starts at.
+        Returns (None, self.textlen) if `offset` is past the end."""
+        if offset < 0 or offset >= self.textlen:
+            return None, self.textlen
+        node = self
+        start = 0
+        while True:
+            if node.children:
+                for c in node.children:
+                    if offset < start + c.textlen:
+                        node = c
+                        break
+                    start += c.textlen
+                else:
+                    raise AssertionError("text length of %s is out of date" % (node,))
+            elif isinstance(node.symbol, MagicTerminal):
+                node = node.symbol.ast
+            else:
+                return node, start
+
+    def find_line(self, line):
+        """Return the offset at which line `line` (counted from 0) of this
+        subtree's text starts."""
+        if line < 0 or line > self.newlines:
+            raise IndexError("line %s out of range" % (line,))
+        if line == 0:
+            return 0
+        node = self
+        start = 0
+        while True:
+            if node.children:
+                for c in node.children:
+                    if line <= c.newlines:
+                        node = c
+                        break
+                    line -= c.newlines
+                    start += c.textlen
+                else:
+                    raise AssertionError("text length of %s is out of date" % (node,))
+            elif isinstance(node.symbol, MagicTerminal):
+                node = node.symbol.ast
+            else:
+                return start + node.textlen
+
+    def get_offset(self):
+        """Return the offset and line at which this node starts in the text
+        of the whole document."""
+        offset = 0
+        line = 0
+        node = self
+        while True:
+            left = node.left
+            while left is not None:
+                offset += left.textlen
+                line += left.newlines
+                left = left.left
+            parent = node.parent
+            if parent is None:
+                parent = getattr(node, "magic_backpointer", None)
+                if parent is None:
+                    return offset, line
+            node = parent
+
+    def find_child(self, child):
+        """Return the position of `child` in this node's children, or -1.
+        Inserting or removing a child only moves the children behind it, so
+        the search starts at the position the child was last seen at."""
+        children = self.children
+        n = len(children)
+        i = min(max(child.child_index, 0), n - 1)
+        if n and children[i] is child:
+            return i
+        for d in xrange(1, n):
+            j = i + d
+            if j < n and children[j] is child:
+                history.save(child, "child_index")
+                child.child_index = j
+                return j
+            j = i - d
+            if j >= 0 and children[j] is child:
+                history.save(child, "child_index")
+                child.child_index = j
+                return j
+            if i + d >= n and i - d < 0:
+                break
+        return -1
+
+    def remove_child(self, child):
+        i = self.find_child(child)
+        if i == -1:
+            return
+        history.save_list(self.children)
+        removed_child = self.children.pop(i)
+        history.save(removed_child)
+        removed_child.deleted = True
+        # update siblings
+        if removed_child.left:
+            history.save(removed_child.left)
+            removed_child.left.right = removed_child.right
+        if removed_child.right:
+            history.save(removed_child.right)
+            removed_child.right.left = removed_child.left
+        # update terminal pointers
+        history.save(child.prev_term)
+        history.save(child.next_term)
+        child.prev_term.next_term = child.next_term
+        child.next_term.prev_term = child.prev_term
+        self.add_length(-child.textlen, -child.newlines)
+        self.mark_changed()
+        history.save(self, "changed")
+        self.changed = True
 
     def insert_after(self, node):
         self.parent.insert_after_node(self, node)
 
     def insert_after_node(self, node, newnode):
-        i = 0
-        for c in self.children:
-            if c is node:
-                self.children.insert(i+1, newnode)
-                newnode.parent = self
-                newnode.mark_changed()
-                # update siblings
-                newnode.left = c
-                newnode.right = c.right
-                c.right = newnode
-                if newnode.right:
-                    newnode.right.left = newnode
-                # update terminal pointers
-                newnode.prev_term = node
-                node.next_term.prev_term = newnode
-                newnode.next_term = node.next_term
-                node.next_term = newnode
-                newnode.magic_parent = node.magic_parent
-                return
-            i += 1
+        i = self.find_child(node)
+        if i == -1:
+            return
+        history.save_list(self.children)
+        self.children.insert(i+1, newnode)
+        history.save(newnode)
+        history.save(node)
+        history.save(node.next_term)
+        if node.right:
+            history.save(node.right)
+        newnode.parent = self
+        newnode.child_index = i+1
+        newnode.mark_changed()
+        # update siblings
+        newnode.left = node
+        newnode.right = node.right
+        node.right = newnode
+        if newnode.right:
+            newnode.right.left = newnode
+        # update terminal pointers
+        newnode.prev_term = node
+        node.next_term.prev_term = newnode
+        newnode.next_term = node.next_term
+        node.next_term = newnode
+        newnode.magic_parent = node.magic_parent
+        self.add_length(newnode.textlen, newnode.newlines)
 
     def right_sibling(self):
         return self.right
@@ -251,13 +400,7 @@ class Node(object):
                 last = siblings[i]
 
     def left_sibling(self):
-        siblings = self.parent.children
-        last = None
-        for i in range(len(siblings)):
-            if siblings[i] is self:
-                return last
-            else:
-                last = siblings[i]
+        return self.left
 
     def find_first_terminal(self):
         node = self
@@ -355,7 +498,7 @@ uppercase = set(list(string.ascii_uppercase))
 digits = set(list(string.digits))
 
 class TextNode(Node):
-    __slots__ = ["pos", "position", "changed", "seen", "deleted", "image", "image_src", "plain_mode", "alternate", "lookahead", "regex", "text", "lookup", "priority", "parent_lbox", "magic_backpointer"]
+    __slots__ = ["pos", "position", "changed", "seen", "deleted", "image", "image_src", "plain_mode", "alternate", "lookahead", "regex", "text", "lookup", "lookup_id", "first_lookup_id", "priority", "parent_lbox", "magic_backpointer", "checkpoints"]
     def __init__(self, symbol, state=-1, children=[], pos=-1, lookahead=0):
         Node.__init__(self, symbol, state, children)
         self.pos = pos
@@ -372,7 +515,10 @@ class TextNode(Node):
         self.regex = ""
         self.text = ""
         self.lookup = ""
+        self.lookup_id = None # id of the lookup symbol in the parser's syntax table
+        self.first_lookup_id = None # id of the first terminal in this subtree (see IncParser.reduce)
         self.priority = 999999 # XXX change to maxint later or reverse priority
+        self.checkpoints = None # lexer states within the token (see IncrementalLexerCF.relex)
 
     def get_magicterminal(self):
         try:
@@ -415,13 +561,21 @@ class TextNode(Node):
         return False
 
     def change_pos(self, i):
+        history.save(self)
         self.pos += i
 
     def change_text(self, text):
         _cls = self.symbol.__class__
+        history.save(self)
         self.symbol = _cls(text)
+        self.update_length()
         self.mark_changed()
 
+    def set_text(self, text):
+        history.save(self.symbol)
+        self.symbol.name = text
+        self.update_length()
+
     def insert(self, char, pos):
         l = list(self.symbol.name)
         l.insert(int(pos), str(char))
@@ -21,23 +21,66 @@
 
 from __future__ import print_function
 
-try:
-    import cPickle as pickle
-except:
-    import pickle
-
-import time, os
+from array import array
 
 from grammar_parser.gparser import Parser, Nonterminal, Terminal,MagicTerminal, Epsilon, IndentationTerminal
 from syntaxtable import SyntaxTable, FinishSymbol, Reduce, Goto, Accept, Shift
+from syntaxtable import ERROR, SHIFT, REDUCE, ACCEPT, ACTION_BITS, ACTION_MASK
+from syntaxtable import BREAKDOWN, FIRST_TERMINAL
 from stategraph import StateGraph
 from constants import LR0, LR1, LALR
 from astree import AST, TextNode, BOS, EOS
+import history
+import grammarcache, tablefile
 
 import logging
 
 Node = TextNode
 
+class UndoJournal(object):
+    """Records the tree links of nodes before the parser changes them, so the
+    previous tree can be restored when a parse fails. Only the first change
+    of every node is recorded, and nodes that were created during the parse
+    aren't recorded at all, since they are thrown away anyway."""
+
+    def __init__(self):
+        self.nodes = []
+        self.parents = []
+        self.lefts = []
+        self.rights = []
+        self.unchanged = [] # nodes whose changed flag was reset
+        self.saved = set()
+
+    def save_links(self, node):
+        if node.parent is None:
+            # not part of the previous tree
+            return
+        key = id(node)
+        if key in self.saved:
+            return
+        self.saved.add(key)
+        self.nodes.append(node)
+        self.parents.append(node.parent)
+        self.lefts.append(node.left)
+        self.rights.append(node.right)
+
+    def save_changed(self, node):
+        self.unchanged.append(node)
+
+    def restore(self):
+        for i in xrange(len(self.nodes)):
+            node = self.nodes[i]
+            history.save(node)
+            node.parent = self.parents[i]
+            node.left = self.lefts[i]
+            node.right = self.rights[i]
+        for node in self.unchanged:
+            history.save(node, "changed")
+            node.changed = True
+
+    def __len__(self):
+        return len(self.nodes) + len(self.unchanged)
+
 class IncParser(object):
 
     def __init__(self, grammar=None, lr_type=LR0, whitespaces=False, startsymbol=None):
@@ -47,22 +90,17 @@ class IncParser(object):
             parser = Parser(grammar, whitespaces)
             parser.parse()
 
-            filename = "".join([os.path.dirname(__file__), "/../pickle/", str(hash(grammar) ^ hash(whitespaces)), ".pcl"])
-            try:
-                logging.debug("Try to unpickle former stategraph")
-                f = open(filename, "r")
-                start = time.time()
-                self.graph = pickle.load(f)
-                end = time.time()
-                logging.debug("unpickling done in %s", end-start)
-            except IOError:
+            key = grammarcache.digest("StateGraph", grammar, whitespaces, lr_type)
+            logging.debug("Try to unpickle former stategraph")
+            self.graph = grammarcache.cache.get(key)
+            if self.graph is None:
                 logging.debug("could not unpickle old graph")
                 logging.debug("Creating Stategraph")
                 self.graph = StateGraph(parser.start_symbol, parser.rules, lr_type)
                 logging.debug("Building Stategraph")
                 self.graph.build()
                 logging.debug("Pickling")
-                pickle.dump(self.graph, open(filename, "w"))
+                grammarcache.cache.put(key, self.graph)
 
             if lr_type == LALR:
                 self.graph.convert_lalr()
@@ -72,9 +110,11 @@ class IncParser(object):
             self.syntaxtable.build(self.graph)
 
         self.stack = []
+        self.state_stack = array("i")
         self.ast_stack = []
         self.all_changes = []
-        self.undo = []
+        self.undo = UndoJournal()
+        self.journal_sizes = [] # size of the undo journal of recent parses
         self.last_shift_state = 0
         self.validating = False
         self.last_status = False
@@ -85,26 +125,31 @@ class IncParser(object):
         logging.debug("Incemental parser done")
 
     def from_dict(self, rules, startsymbol, lr_type, whitespaces, pickle_id, precedences):
+        # pickle_id: stable key of the grammar (see grammarcache.digest)
         self.graph = None
         self.syntaxtable = None
         if pickle_id:
-            filename = "".join([os.path.dirname(__file__), "/../pickle/", str(pickle_id ^ hash(whitespaces)), ".pcl"])
-            try:
-                f = open(filename, "r")
-                self.syntaxtable = pickle.load(f)
-            except IOError:
-                pass
+            key = grammarcache.digest("SyntaxTable", pickle_id, whitespaces)
+            self.syntaxtable = grammarcache.cache.get(key, tablefile.load_syntaxtable, tablefile.suffix)
         if self.syntaxtable is None:
             self.graph = StateGraph(startsymbol, rules, lr_type)
             self.graph.build()
             self.syntaxtable = SyntaxTable(lr_type)
             self.syntaxtable.build(self.graph, precedences)
             if pickle_id:
-                pickle.dump(self.syntaxtable, open(filename, "w"))
+                grammarcache.cache.put(key, self.syntaxtable, tablefile.dump_syntaxtable, tablefile.suffix)
+
+        self.whitespaces = whitespaces
 
+    def from_syntaxtable(self, syntaxtable, whitespaces):
+        # syntax tables don't change after they are built, so parsers of the
+        # same language can share them
+        self.graph = None
+        self.syntaxtable = syntaxtable
         self.whitespaces = whitespaces
 
     def init_ast(self, magic_parent=None):
+        history.save(self)
         bos = BOS(Terminal(""), 0, [])
         eos = EOS(FinishSymbol(), 0, [])
         bos.magic_parent = magic_parent
@@ -119,11 +164,16 @@ class IncParser(object):
 
     def inc_parse(self, line_indents=[], reparse=False):
         logging.debug("============ NEW INCREMENTAL PARSE ================= ")
+        history.save(self)
         self.error_node = None
         self.stack = []
-        self.undo = []
+        # the parser states belonging to the elements in `stack`
+        self.state_stack = array("i")
+        self.undo = UndoJournal()
         self.current_state = 0
+        self.validating = False
         self.stack.append(Node(FinishSymbol(), 0, []))
+        self.state_stack.append(0)
         bos = self.previous_version.parent.children[0]
         la = self.pop_lookahead(bos)
         self.loopcount = 0
@@ -147,12 +197,11 @@ class IncParser(object):
                     comment_stack.append(la)
                     CMT = Node(Nonterminal("~COMMENT~"))
                     for c in comment_stack:
-                        self.undo.append((c, 'parent', c.parent))
-                        self.undo.append((c, 'left', c.left))
-                        self.undo.append((c, 'right', c.right))
+                        self.undo.save_links(c)
                     CMT.set_children(comment_stack)
                     CMT.state = self.current_state
                     self.stack.append(CMT)
+                    self.state_stack.append(self.current_state)
                     la = next_la
                     continue
                 if isinstance(la, EOS):
@@ -186,12 +235,7 @@ class IncParser(object):
                                 break
                         la = self.pop_lookahead(la)
                         continue
-                    if la.lookup != "":
-                        lookup_symbol = Terminal(la.lookup)
-                    else:
-                        lookup_symbol = la.symbol
-
-                    result = self.parse_terminal(la, lookup_symbol)
+                    result = self.parse_terminal(la, self.get_lookup_id(la))
                     if result == "Accept":
                         self.last_status = True
                         return True
@@ -203,30 +247,27 @@ class IncParser(object):
 
             else: # Nonterminal
                 if la.changed or reparse:
+                    history.save(la, "changed")
                     la.changed = False
-                    self.undo.append((la, 'changed', True))
+                    self.undo.save_changed(la)
                     la = self.left_breakdown(la)
                 else:
                     if USE_OPT:
-                        goto = self.syntaxtable.lookup(self.current_state, la.symbol)
-                        if goto: # can we shift this Nonterminal in the current state?
-                            follow_id = goto.action
+                        goto = self.syntaxtable.lookup_id(self.current_state, self.get_lookup_id(la))
+                        if goto != ERROR: # can we shift this Nonterminal in the current state?
+                            follow_id = goto >> ACTION_BITS
                             self.stack.append(la)
-                            la.state = follow_id #XXX this fixed goto error (i should think about storing the states on the stack instead of inside the elements)
+                            self.state_stack.append(follow_id)
                             self.current_state = follow_id
                             la = self.pop_lookahead(la)
                             self.validating = True
                             continue
                         else:
-                            #XXX can be made faster by providing more information in syntax tables
-                            first_term = la.find_first_terminal()
-                            if first_term.lookup != "":
-                                lookup_symbol = Terminal(first_term.lookup)
-                            else:
-                                lookup_symbol = first_term.symbol
-                            element = self.syntaxtable.lookup(self.current_state, lookup_symbol)
-                            if isinstance(element, Reduce):
-                                self.reduce(element)
+                            element = self.syntaxtable.lookup_hint(self.current_state, self.get_lookup_id(la))
+                            if element == FIRST_TERMINAL:
+                                element = self.syntaxtable.lookup_id(self.current_state, self.get_first_lookup_id(la))
+                            if element & ACTION_MASK == REDUCE:
+                                self.reduce(element >> ACTION_BITS)
                             else:
                                 la = self.left_breakdown(la)
                     else:
@@ -266,37 +307,61 @@ class IncParser(object):
                 la = self.pop_lookahead(la)
                 continue
 
-    def parse_terminal(self, la, lookup_symbol):
-        if isinstance(lookup_symbol, IndentationTerminal):
+    def get_lookup_id(self, la):
+        # id of the node's symbol in the compiled syntax table. The lexer and
+        # `reduce` already store it on the nodes they create, so this only
+        # needs to look it up for nodes that come from elsewhere (e.g. files
+        # loaded from disk or indentation tokens)
+        if la.lookup_id is not None:
+            return la.lookup_id
+        if la.lookup != "":
+            return self.syntaxtable.terminal_ids.get(la.lookup)
+        if isinstance(la.symbol, IndentationTerminal):
             #XXX hack: change parsing table to accept IndentationTerminals
-            lookup_symbol = Terminal(lookup_symbol.name)
-        element = self.syntaxtable.lookup(self.current_state, lookup_symbol)
-        if isinstance(element, Accept):
+            return self.syntaxtable.terminal_ids.get(la.symbol.name)
+        return self.syntaxtable.symbol_ids.get(la.symbol)
+
+    def get_first_lookup_id(self, la):
+        # id of the first terminal in the subtree `la`. `reduce` caches it on
+        # the nodes it creates if it is known from their first child
+        if la.first_lookup_id is not None:
+            return la.first_lookup_id
+        return self.get_lookup_id(la.find_first_terminal())
+
+    def parse_terminal(self, la, lookup_id):
+        element = self.syntaxtable.lookup_id(self.current_state, lookup_id)
+        while element & ACTION_MASK == REDUCE:
+            self.reduce(element >> ACTION_BITS)
+            element = self.syntaxtable.lookup_id(self.current_state, lookup_id)
+        action = element & ACTION_MASK
+        if action == ACCEPT:
             #XXX change parse so that stack is [bos, startsymbol, eos]
             bos = self.previous_version.parent.children[0]
             eos = self.previous_version.parent.children[-1]
             self.previous_version.parent.set_children([bos, self.stack[1], eos])
+            self.log_journal_size()
             logging.debug("loopcount: %s", self.loopcount)
             logging.debug ("Accept")
             return "Accept"
-        elif isinstance(element, Shift):
+        elif action == SHIFT:
             logging.debug("Shift: %s", la)
             # removing this makes "Valid tokens" correct, should not be needed
             # for incremental parser
             #self.undo.append((la, "state", la.state))
-            la.state = element.action
+            state = element >> ACTION_BITS
+            if la.state != state:
+                # only used by the editor to show the expected symbols
+                history.save(la)
+                la.state = state
             self.stack.append(la)
-            self.current_state = element.action
+            self.state_stack.append(state)
+            self.current_state = state
             if not la.lookup == "<ws>":
                 # last_shift_state is used to predict next symbol
                 # whitespace destroys correct behaviour
-                self.last_shift_state = element.action
+                self.last_shift_state = state
             return self.pop_lookahead(la)
-
-        elif isinstance(element, Reduce):
-            self.reduce(element)
-            return self.parse_terminal(la, lookup_symbol)
-        elif element is None:
+        elif element == ERROR:
             if self.validating:
                 self.right_breakdown()
                 self.validating = False
@@ -304,54 +369,70 @@ class IncParser(object):
                 return self.do_undo(la)
 
     def do_undo(self, la):
-        while len(self.undo) > 0:
-            node, attribute, value = self.undo.pop(-1)
-            setattr(node, attribute, value)
+        self.log_journal_size()
+        self.undo.restore()
+        self.undo = UndoJournal()
         self.error_node = la
         logging.debug ("Error: %s %s %s", la, la.prev_term, la.next_term)
         logging.debug("loopcount: %s", self.loopcount)
         return "Error"
 
-    def reduce(self, element):
+    def reduce(self, production_id):
         # Reduces elements from the stack to a Nonterminal subtree.  special:
         # COMMENT subtrees that are found on the stack during reduction are
         # added "silently" to the subtree (they don't count to the amount of
         # symbols of the reduction)
+        production = self.syntaxtable.productions[production_id]
+        amount = self.syntaxtable.reduce_amount[production_id]
         children = []
         i = 0
-        while i < element.amount():
+        while i < amount:
             c = self.stack.pop()
+            self.state_stack.pop()
             # apply folding information from grammar to tree nodes
-            fold = element.action.right[element.amount()-i-1].folding
-            c.symbol.folding = fold
+            fold = production.right[amount-i-1].folding
+            if c.symbol.folding != fold:
+                history.save(c.symbol)
+                c.symbol.folding = fold
             children.insert(0, c)
             if c.symbol.name != "~COMMENT~":
                 i += 1
         if self.stack[-1].symbol.name == "~COMMENT~":
             c = self.stack.pop()
+            self.state_stack.pop()
             children.insert(0, c)
-        self.current_state = self.stack[-1].state #XXX don't store on nodes, but on stack
+        self.current_state = self.state_stack[-1]
 
-        goto = self.syntaxtable.lookup(self.current_state, element.action.left)
-        if goto is None:
-            raise Exception("Reduction error on %s in state %s: goto is None" % (element, self.current_state))
-        assert goto != None
+        goto = self.syntaxtable.lookup_id(self.current_state, self.syntaxtable.reduce_left[production_id])
+        if goto == ERROR:
+            raise Exception("Reduction error on %s in state %s: goto is None" % (production, self.current_state))
 
         # save childrens parents state
         for c in children:
-            self.undo.append((c, 'parent', c.parent))
-            self.undo.append((c, 'left', c.left))
-            self.undo.append((c, 'right', c.right))
+            self.undo.save_links(c)
 
-        new_node = Node(element.action.left.copy(), goto.action, children)
+        new_node = Node(production.left.copy(), goto >> ACTION_BITS, children)
+        new_node.lookup_id = self.syntaxtable.reduce_left[production_id]
+        if children:
+            if isinstance(children[0].symbol, Nonterminal):
+                new_node.first_lookup_id = children[0].first_lookup_id
+            else:
+                new_node.first_lookup_id = self.get_lookup_id(children[0])
         self.stack.append(new_node)
+        self.state_stack.append(new_node.state)
         self.current_state = new_node.state # = goto.action
-        if getattr(element.action.annotation, "interpret", None):
+        if getattr(production.annotation, "interpret", None):
             # eco grammar annotations
-            self.interpret_annotation(new_node, element.action)
+            self.interpret_annotation(new_node, production)
         else:
             # johnstone annotations
-            self.add_alternate_version(new_node, element.action)
+            self.add_alternate_version(new_node, production)
+
+    def log_journal_size(self):
+        self.journal_sizes.append(len(self.undo))
+        if len(self.journal_sizes) > 100:
+            del self.journal_sizes[0]
+        logging.debug("undo journal: %s entries", len(self.undo))
 
     def interpret_annotation(self, node, production):
         annotation = production.annotation
@@ -373,6 +454,7 @@ class IncParser(object):
                         alternate.children.append(t)
             c = node.children[i]
             if c.symbol.folding == "^^^":
+                history.save(c.symbol)
                 c.symbol.folding = None
                 teared.append(c)
                 continue
@@ -398,16 +480,38 @@ class IncParser(object):
             return self.pop_lookahead(la)
 
     def right_breakdown(self):
-        node = self.stack.pop()
+        if len(self.stack) == 1:
+            # only the bottom of the stack is left
+            return
+        node = self.pop_stack()
         while(isinstance(node.symbol, Nonterminal)):
             for c in node.children:
                 self.shift(c)
-            node = self.stack.pop()
+            if len(self.stack) == 1:
+                return
+            node = self.pop_stack()
         self.shift(node)
 
+    def pop_stack(self):
+        # the bottom of the stack is never popped
+        assert len(self.stack) > 1
+        node = self.stack.pop()
+        self.state_stack.pop()
+        self.current_state = self.state_stack[-1]
+        return node
+
     def shift(self, la):
+        # push an element that has already been parsed before back onto the
+        # stack. Its state is taken from the syntax table instead of the node,
+        # so that nodes don't need to be updated whenever they are reused.
+        # Comments don't change the state
+        if la.symbol.name != "~COMMENT~":
+            element = self.syntaxtable.lookup_id(self.current_state, self.get_lookup_id(la))
+            if element == ERROR:
+                raise Exception("Breakdown error on %s in state %s" % (la, self.current_state))
+            self.current_state = element >> ACTION_BITS
         self.stack.append(la)
-        self.current_state = la.state
+        self.state_stack.append(self.current_state)
 
     def pop_lookahead(self, la):
         while(la.right_sibling() is None):
@@ -438,11 +542,7 @@ class IncParser(object):
         return AST(root)
 
     def get_next_possible_symbols(self, state_id):
-        l = set()
-        for (state, symbol) in self.syntaxtable.table.keys():
-            if state == state_id:
-                l.add(symbol)
-        return l
+        return self.syntaxtable.get_symbols(state_id)
 
     def get_next_symbols_list(self, state = -1):
         if state == -1:
@@ -469,10 +569,13 @@ class IncParser(object):
 
 
     def reset(self):
+        history.save(self)
         self.stack = []
+        self.state_stack = array("i")
         self.ast_stack = []
         self.all_changes = []
-        self.undo = []
+        self.undo = UndoJournal()
+        self.journal_sizes = []
         self.last_shift_state = 0
         self.validating = False
         self.last_status = False
@@ -21,231 +21,281 @@
 
 from __future__ import print_function
 
-from state import StateSet, State, LR1Element, LR0Element
+from state import StateSet, LR0Element
 from production import Production
-from helpers import closure_0, goto_0, Helper
+from helpers import Helper
+from grammar_parser.gparser import Nonterminal, Epsilon
 from syntaxtable import FinishSymbol
 from constants import LR0, LR1, LALR
 from time import time
 import logging
 
-class StateGraph(object):
+class LRItems(object):
+    """Numbers the terminals, productions and LR(0) items of a grammar, so
+    that the state graph can be built from integers: an item is an index into
+    the arrays below and a lookahead set is an int with one bit per
+    terminal.
 
-    def __init__(self, start_symbol, grammar, lr_type=0):
+    For every nonterminal, the closure of its productions is computed once,
+    together with the lookaheads each item gets no matter where the closure
+    happens (`generated`) and whether it inherits the lookahead of the item
+    that caused the closure (`propagated`)."""
+
+    def __init__(self, start_symbol, grammar, helper):
         self.grammar = grammar
-        self.start_symbol = start_symbol
-        self.state_sets = []
-        self.edges = {}
-        self.ids = {}
-        self.todo = []
-        self.done = set()
-        self.maybe_compatible = {}
+        epsilon = Epsilon()
 
-        self.goto_time = 0
-        self.add_time = 0
-        self.closure_time = 0
-        self.closure_count = 0
-        self.addcount = 0
-        self.weakly = 0
-        self.weakly_count = 0
-        self.mergetime = 0
+        # productions, start production first
+        self.productions = [Production(None, [start_symbol])]
+        for symbol in sorted(grammar, key=lambda s: s.name):
+            rule = grammar[symbol]
+            for i, a in enumerate(rule.alternatives):
+                if a == []:
+                    a = [Epsilon()]
+                p = Production(symbol, a, rule.annotations[i], rule.precs[i])
+                if rule.inserts.has_key(i):
+                    insert = rule.inserts[i]
+                    p.inserts[insert[0]] = insert[1]
+                self.productions.append(p)
 
-        helper = Helper(grammar)
-        self.helper = helper
-        if lr_type == LR0:
-            self.closure = helper.closure_0
-            self.goto = helper.goto_0
-            self.start_set = StateSet([LR0Element(Production(None, [self.start_symbol]), 0)])
-        elif lr_type == LR1 or lr_type == LALR:
-            self.closure = helper.closure_1
-            self.goto = helper.goto_1
-            self.start_set = StateSet()
-            self.start_set.add(LR0Element(Production(None, [self.start_symbol]), 0), set([FinishSymbol()]))
+        # terminals in order of appearance
+        self.terminals = [FinishSymbol()]
+        self.terminal_bits = {FinishSymbol(): 1}
+        self.nonterminals = {}
+        for p in self.productions:
+            for symbol in p.right:
+                if isinstance(symbol, Nonterminal):
+                    self.nonterminals.setdefault(symbol, len(self.nonterminals))
+                elif symbol != epsilon and symbol not in self.terminal_bits:
+                    self.terminal_bits[symbol] = 1 << len(self.terminals)
+                    self.terminals.append(symbol)
+        # marks the lookahead of the item that caused a closure
+        self.propagate_bit = 1 << len(self.terminals)
 
-    def build(self):
-        State._hashtime = 0
-        start = time()
-        start_set = self.start_set
-        closure = start_set
-        #closure = self.closure(start_set)
-        self.state_sets.append(closure)
-        self.ids[closure] = 0
-        _id = 0
-        self.todo.append(_id)
-        while self.todo:
-            self.addcount += 1
-            _id = self.todo.pop()
-            self.done.add(_id)
-            #print("id:", _id)
-            closure_start = time()
-            state_set = self.closure(self.state_sets[_id])
-            self.closure_count += 1
-            closure_end = time()
-            self.closure_time += closure_end - closure_start
-            #state_set = self.state_sets[_id]
-            new_gotos = {}
-            goto_start = time()
-            # create new sets first, then calculate closure
-            for lrelement in state_set.elements:
-                symbol = lrelement.next_symbol()
-                if not symbol: # state is final
-                    continue
-                #XXX optimisation: create all configurations before building
-                new_element = lrelement.clone()
-                new_element.d += 1
-                new_element_la = state_set.get_lookahead(lrelement)
-                stateset = new_gotos.setdefault(symbol, StateSet())
-                stateset.add(new_element, new_element_la)
+        self.first = {}
+        self.nullable = {}
+        for symbol in self.nonterminals:
+            first = helper.first(symbol)
+            self.first[symbol] = self.bits(first)
+            self.nullable[symbol] = epsilon in first
 
-            # now calculate closure and add result to state_sets
-            goto_end = time()
-            self.goto_time += goto_end - goto_start
+        # items
+        self.item_production = []
+        self.item_dot = []
+        self.item_symbol = []       # symbol after the dot, or None
+        self.item_nonterminal = []  # its number if it's a nonterminal, or -1
+        self.item_first = []        # first set of the symbols after that one
+        self.item_nullable = []     # whether they are nullable
+        self.start_items = {}       # nonterminal number -> [item]
+        for production_id, p in enumerate(self.productions):
+            if p.right == [epsilon]:
+                start = 1
+            else:
+                start = 0
+            if p.left is not None:
+                self.start_items.setdefault(self.nonterminals.get(p.left), []).append(len(self.item_dot) + start)
+            for d in range(len(p.right) + 1):
+                self.item_production.append(production_id)
+                self.item_dot.append(d)
+                if d < len(p.right) and p.right[d] != epsilon:
+                    symbol = p.right[d]
+                    self.item_symbol.append(symbol)
+                    self.item_nonterminal.append(self.nonterminals.get(symbol, -1))
+                    first, nullable = self.first_of(p.right[d+1:])
+                    self.item_first.append(first)
+                    self.item_nullable.append(nullable)
+                else:
+                    self.item_symbol.append(None)
+                    self.item_nonterminal.append(-1)
+                    self.item_first.append(0)
+                    self.item_nullable.append(True)
 
-            for ss in new_gotos:
-                new_state_set = new_gotos[ss]
-                #new_state_set = self.closure(new_gotos[ss])
-                add_start = time()
-                self.add(_id, ss, new_state_set)
-                add_end = time()
-                self.add_time += add_end - add_start
+        # closures of all nonterminals: [(item, generated, propagated)]
+        self.closures = {}
+        for symbol, nt in self.nonterminals.items():
+            if symbol not in grammar:
+                raise KeyError(symbol)
+            lookaheads = {}
+            todo = []
+            self.close(self.start_items.get(nt, []), self.propagate_bit, lookaheads, todo)
+            while todo:
+                i = todo.pop()
+                next_nt = self.item_nonterminal[i]
+                if next_nt >= 0:
+                    f = self.item_first[i]
+                    if self.item_nullable[i]:
+                        f |= lookaheads[i]
+                    self.close(self.start_items.get(next_nt, []), f, lookaheads, todo)
+            self.closures[nt] = [(i, la & ~self.propagate_bit, bool(la & self.propagate_bit))
+                                                        for i, la in sorted(lookaheads.items())]
 
-        end = time()
-        logging.info("add time %s", self.add_time)
-        logging.info("closure time %s", self.closure_time)
-        logging.info("closure time helper %s", self.helper.closure_time)
-        logging.info("goto time %s", self.goto_time)
-        logging.info("hashtime %s", StateSet._hashtime)
-        logging.info("addcount %s", self.addcount)
-        logging.info("states %s", len(self.state_sets))
-        logging.info("weakly %s", self.weakly)
-        logging.info("weakly count %s", self.weakly_count)
-        logging.info("mergetime %s", self.mergetime)
-        #print("maybe", self.maybe_compatible)
-        #for key in self.maybe_compatible:
-        #    print(key, len(self.maybe_compatible[key]))
+    def close(self, items, lookahead, lookaheads, todo):
+        for i in items:
+            old = lookaheads.get(i, 0)
+            if lookahead & ~old or i not in lookaheads:
+                lookaheads[i] = old | lookahead
+                todo.append(i)
 
+    def bits(self, symbols):
+        result = 0
+        for symbol in symbols:
+            result |= self.terminal_bits.get(symbol, 0)
+        return result
 
-        # apply closure
-        logging.info("Apply closure to states")
-        clstart = time()
-        new_state_sets = []
-        new_ids = {}
-        for state in self.state_sets:
-            _id = self.ids[state]
-            new_state = self.closure(state)
-            new_state_sets.append(new_state)
-            new_ids[new_state] = new_state
-        self.state_sets = new_state_sets
-        logging.info("after closure %s", len(new_state_sets))
-        logging.info("edges %s", len(set(self.edges.values())))
-        self.ids = new_ids
-        logging.info(time() - clstart)
+    def symbols(self, bits):
+        result = set()
+        i = 0
+        while bits:
+            if bits & 1:
+                result.add(self.terminals[i])
+            bits >>= 1
+            i += 1
+        return result
 
-        logging.info("Finished building Stategraph in %s", end-start)
-        self.closure = None
-        self.goto = None
+    def first_of(self, symbols):
+        """Return the first set of a sequence of symbols (as bits) and whether
+        it is nullable."""
+        result = 0
+        for symbol in symbols:
+            if symbol in self.nonterminals:
+                result |= self.first[symbol]
+                if not self.nullable[symbol]:
+                    return result, False
+            else:
+                result |= self.terminal_bits[symbol]
+                return result, False
+        return result, True
 
-    def weakly_compatible(self, s1, s2):
-        self.weakly_count += 1
-        core = s1.elements
-        if core != s2.elements:
-            return False
-        if len(core) == 1:
-            return True
-        self.weakly -= time()
-        core = list(core)
-        for i in range(0, len(core)-1):
-            I = core[i]
-            for j in range(i+1, len(core)):
-                J = core[j]
-                if ((s1.lookaheads[I] & s2.lookaheads[J] or s1.lookaheads[J] & s2.lookaheads[I])
-                    and not s1.lookaheads[I] & s1.lookaheads[J]
-                    and not s2.lookaheads[I] & s2.lookaheads[J]):
-                    self.weakly += time()
-                    return False
-        self.weakly += time()
-        return True
+    def closure(self, kernel, lookaheads):
+        """Return the closure of the kernel items with the given lookaheads as
+        a dict item -> lookahead."""
+        result = dict(zip(kernel, lookaheads))
+        for i, la in zip(kernel, lookaheads):
+            nt = self.item_nonterminal[i]
+            if nt < 0:
+                continue
+            f = self.item_first[i]
+            if self.item_nullable[i]:
+                f |= la
+            for j, generated, propagated in self.closures[nt]:
+                if propagated:
+                    result[j] = result.get(j, 0) | generated | f
+                else:
+                    result[j] = result.get(j, 0) | generated
+        return result
 
-    def find_stateset_without_lookahead(self, state_set):
-        for ss in self.state_sets:
-            if state_set.equals(ss, True):
-                return ss
-        return None
+class StateGraph(object):
 
-    def merge_lookahead(self, old, new):
-        self.mergetime -= time()
-        changed = False
-       #for e1 in new.elements:
-       #    for e2 in old.elements:
-       #        if e1 == e2: # compare without lookahead
-       #            #print("merging", e1, "and", e2)
-       #            if e1.lookahead - e2.lookahead:
-       #                changed = True
-       #            e2.lookahead |= e1.lookahead
-        for element in new.elements:
-            la1 = new.get_lookahead(element)
-            la2 = old.get_lookahead(element)
-            if la1 - la2:
-                changed = True
-                new_la = la2 | la1
-                old.lookaheads[element] = new_la
+    def __init__(self, start_symbol, grammar, lr_type=0):
+        self.grammar = grammar
+        self.start_symbol = start_symbol
+        self.lr_type = lr_type
+        self.state_sets = []
+        self.edges = {}
 
-        self.mergetime += time()
-        return changed
+        self.helper = Helper(grammar)
 
-    def add(self, from_id, symbol, state_set):
-        merged = False
-        #for candidate in self.state_sets: # only check states that can be reached by symbol
-        for _id in self.maybe_compatible.setdefault(symbol,set()):
-            candidate = self.state_sets[_id]
-            if self.weakly_compatible(state_set, candidate):
-                # merge them
-                merged = True
-                changed = self.merge_lookahead(candidate, state_set)
-                self.edges[(from_id, symbol)] = _id
-                if changed and _id in self.done:
-                    # move state to todo list
-                    self.todo.append(_id) #XXX only need to to that if this state is already done (moving not necessary if it hasn't been looked at anyway (e.g. state at the end of list)
-                    self.done.remove(_id)
+    def build(self):
+        """Build the LR(1) state graph, merging states whose kernels only
+        differ in lookaheads if that doesn't cause new conflicts (weak
+        compatibility, see Pager: A practical general method for constructing
+        LR(k) parsers). The states are built from integer items (see
+        `LRItems`), and converted into `StateSet`s at the end.
 
-        if not merged:
-            # add normally and put on todo list
-            self.state_sets.append(state_set)
-            _id = len(self.state_sets)-1
-            self.edges[(from_id, symbol)] = _id
-            self.ids[state_set] = _id
-            self.todo.append(_id)
+        For LR(0), states with the same kernel are always merged."""
+        start = time()
+        items = LRItems(self.start_symbol, self.grammar, self.helper)
+        if self.lr_type == LR0:
+            start_lookahead = 0
+        else:
+            start_lookahead = items.terminal_bits[FinishSymbol()]
 
-            # add to maybe compatible
-            mc = self.maybe_compatible.setdefault(symbol, set())
-            mc.add(_id)
+        kernels = [(0,)]
+        lookaheads = [[start_lookahead]]
+        cores = {(0,): [0]}
+        todo = [0]
+        done = set()
+        successors = [{}]
+        while todo:
+            state_id = todo.pop()
+            done.add(state_id)
+            kernel = kernels[state_id]
+            closure = items.closure(kernel, lookaheads[state_id])
 
-    def oldadd(self, from_id, symbol, state_set):
-        # LALR way
-       #ss = self.find_stateset_without_lookahead(state_set)
-       #if ss:
-       #    #print("found existing stateset -> merging")
-       #    #print(ss)
-       #    #print(state_set)
-       #    self.merge_lookahead(ss, state_set)
-       #    _id = self.state_sets.index(ss)
-       #else:
-       #    self.state_sets.append(state_set)
-       #    _id = len(self.state_sets)-1
-       #self.edges[(from_id, symbol)] = _id
+            # kernels of the successors, ordered by the items they come from
+            # (kernel items first), so that states are numbered the same way
+            # in every run
+            gotos = {}
+            symbols = []
+            for i in list(kernel) + sorted(set(closure).difference(kernel)):
+                symbol = items.item_symbol[i]
+                if symbol is None:
+                    continue
+                if symbol not in gotos:
+                    gotos[symbol] = {}
+                    symbols.append(symbol)
+                kernel = gotos[symbol]
+                kernel[i + 1] = kernel.get(i + 1, 0) | closure[i]
 
-        # normal LR(1) way
-        add_start = time()
-        _id = self.ids.get(state_set)
-        if _id is None: # new state
-            self.addcount += 1
+            for symbol in symbols:
+                kernel = gotos[symbol]
+                core = tuple(sorted(kernel))
+                la = [kernel[i] for i in core]
+                for candidate in cores.setdefault(core, []):
+                    if self.lr_type == LR0 or self.weakly_compatible(la, lookaheads[candidate]):
+                        merged = [a | b for a, b in zip(la, lookaheads[candidate])]
+                        if merged != lookaheads[candidate]:
+                            lookaheads[candidate] = merged
+                            if candidate in done:
+                                done.remove(candidate)
+                                todo.append(candidate)
+                        target = candidate
+                        break
+                else:
+                    target = len(kernels)
+                    kernels.append(core)
+                    lookaheads.append(la)
+                    cores[core].append(target)
+                    successors.append({})
+                    todo.append(target)
+                successors[state_id][symbol] = target
+                self.edges[(state_id, symbol)] = target
+        self.successors = successors
+        logging.info("states %s", len(kernels))
+
+        # apply closure
+        elements = {}
+        la_sets = {}
+        for kernel, la in zip(kernels, lookaheads):
+            state_set = StateSet()
+            for i, bits in sorted(items.closure(kernel, la).items()):
+                element = elements.get(i)
+                if element is None:
+                    p = items.productions[items.item_production[i]]
+                    element = elements[i] = LR0Element(p, items.item_dot[i])
+                if bits not in la_sets:
+                    la_sets[bits] = items.symbols(bits)
+                state_set.add(element, set(la_sets[bits]))
             self.state_sets.append(state_set)
-            _id = len(self.state_sets)-1
-            self.ids[state_set] = _id
-            self.todo.append(_id)
-        self.edges[(from_id, symbol)] = _id
-        add_end = time()
-        self.add_time += add_end - add_start
+        logging.info("Finished building Stategraph in %s", time() - start)
+
+    def weakly_compatible(self, la1, la2):
+        """Whether merging two states with the same core and the given
+        lookaheads doesn't introduce new reduce/reduce conflicts."""
+        if all([b & ~a == 0 for a, b in zip(la1, la2)]):
+            return True # la2 already contains la1, or the other way round
+        if all([a & ~b == 0 for a, b in zip(la1, la2)]):
+            return True
+        n = len(la1)
+        for i in range(n - 1):
+            a1 = la1[i]
+            b1 = la2[i]
+            for j in range(i + 1, n):
+                a2 = la1[j]
+                b2 = la2[j]
+                if (a1 & b2 or a2 & b1) and not a1 & a2 and not b1 & b2:
+                    return False
+        return True
 
     def follow(self, from_id, symbol):
         try:
@@ -254,6 +304,9 @@ class StateGraph(object):
         except KeyError:
             return None
 
+    def get_edges(self, from_id):
+        return self.successors[from_id].items()
+
     def get_symbols(self):
         s = set()
         for _, symbol in self.edges.keys():
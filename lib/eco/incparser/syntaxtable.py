@@ -19,10 +19,27 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
 # IN THE SOFTWARE.
 
+import re
+from array import array
 from production import Production
 from grammar_parser.gparser import Terminal, Nonterminal, Epsilon
 from constants import LR0, LR1, LALR
 
+# Actions in the compiled table are packed into a single integer: the lower
+# bits hold the action type, the remaining bits its argument (the target state
+# for shifts and gotos, the production index for reductions). A packed value of
+# 0 means "no action", i.e. a syntax error.
+ERROR = 0
+SHIFT = 1
+REDUCE = 2
+GOTO = 3
+ACCEPT = 4
+ACTION_BITS = 3
+ACTION_MASK = (1 << ACTION_BITS) - 1
+# Hints for reused subtrees whose nonterminal can't be shifted (see `lookup_hint`)
+BREAKDOWN = 5
+FIRST_TERMINAL = 6
+
 class SyntaxTableElement(object):
 
     def __init__(self, action):
@@ -61,12 +78,131 @@ class Accept(SyntaxTableElement):
     def __init__(self, action=None):
         self.action = None
 
+def compact_array(values):
+    """Return an array of the smallest integer type that can hold values."""
+    for typecode in "bhi":
+        try:
+            return array(typecode, values)
+        except OverflowError:
+            pass
+    return array("l", values)
+
+class CombVector(object):
+    """Row displacement encoding of a sparse two-dimensional table of packed
+    actions. Identical rows are only stored once: `rows` maps a state to its
+    row, `base` maps a row to its offset into `check` and `value`, and `check`
+    records which row owns a slot."""
+
+    def __init__(self, rows=[], width=0):
+        distinct = {}
+        rowids = []
+        for row in rows:
+            key = tuple(sorted(row.items()))
+            if key not in distinct:
+                distinct[key] = len(distinct)
+            rowids.append(distinct[key])
+
+        # first fit: place the densest rows first, each at the lowest offset
+        # where none of its entries collide with an already placed entry. Used
+        # slots are marked in a bytearray, so that the next fitting offset can
+        # be found by matching the row's layout with a regular expression.
+        base = [0] * len(distinct)
+        check = []
+        value = []
+        used = bytearray(width)
+        first_free = 0
+        for entries in sorted(distinct, key=len, reverse=True):
+            if not entries:
+                continue
+            columns = [column for column, _ in entries]
+            layout = [r"\x00"]
+            for last, column in zip(columns, columns[1:]):
+                if column - last > 1:
+                    layout.append(".{%s}" % (column - last - 1))
+                layout.append(r"\x00")
+            match = re.compile("".join(layout), re.DOTALL).search(used, max(first_free, columns[0]))
+            offset = match.start() - columns[0]
+            end = offset + width
+            if end > len(check):
+                check.extend([-1] * (end - len(check)))
+                value.extend([ERROR] * (end - len(value)))
+                used.extend("\x00" * (end + width - len(used)))
+            row = distinct[entries]
+            for column, packed in entries:
+                check[offset + column] = row
+                value[offset + column] = packed
+                used[offset + column] = 1
+            base[row] = offset
+            while used[first_free]:
+                first_free += 1
+        # rows without entries keep offset 0 and must not read past the end
+        check.extend([-1] * (width - len(check)))
+        value.extend([ERROR] * (width - len(value)))
+        self.rows = compact_array(rowids)
+        self.base = compact_array(base)
+        self.check = compact_array(check)
+        self.value = compact_array(value)
+
+    def __getstate__(self):
+        # arrays pickle as lists of ints, their raw bytes are much smaller
+        state = {}
+        for name in ("rows", "base", "check", "value"):
+            a = getattr(self, name)
+            state[name] = (a.typecode, a.tostring())
+        return state
+
+    def __setstate__(self, state):
+        for name, (typecode, data) in state.iteritems():
+            a = array(typecode)
+            a.fromstring(data)
+            setattr(self, name, a)
+
 class SyntaxTable(object):
 
     def __init__(self, lr_type=LR0):
-        self.table = {}
+        self._table = {}
         self.lr_type = lr_type
 
+        # compiled table (see `compile`)
+        self.symbols = []
+        self.symbol_ids = {}
+        self.terminal_ids = {}
+        self.num_terminals = 0
+        self.num_states = 0
+        self.productions = []
+        self.reduce_amount = array("i")
+        self.reduce_left = array("i")
+        self.action = CombVector()
+        self.goto = CombVector()
+        self.hints = None
+        self.hint_defaults = None
+        self._decoded = {}
+
+    @property
+    def table(self):
+        if self._table is None:
+            self._table = self.decompile()
+        return self._table
+
+    def __getstate__(self):
+        # the object table can always be restored from the compiled one, so
+        # only the latter is pickled
+        state = self.__dict__.copy()
+        state["_table"] = None
+        state["_decoded"] = {}
+        state["productions"] = list(self.productions)
+        return state
+
+    def __setstate__(self, state):
+        self.hints = None
+        self.hint_defaults = None
+        self.__dict__.update(state)
+        if "table" in state:
+            # table pickled before compiled tables existed
+            self._table = self.__dict__.pop("table")
+            self._decoded = {}
+            self.compile()
+
     def build(self, graph, precedences=[]):
         start_production = Production(None, [graph.start_symbol])
         symbols = graph.get_symbols()
@@ -93,8 +229,7 @@ class SyntaxTable(object):
                             else:
                                 del self.table[(i,s)]
             # shift, goto
-            for s in symbols:
-                dest = graph.follow(i, s)
+            for s, dest in graph.get_edges(i):
                 if dest:
                     if isinstance(s, Terminal):
                         action = Shift(dest)
@@ -106,6 +241,194 @@ class SyntaxTable(object):
                         self.table[(i, s)] = action
                     else:
                         del self.table[(i,s)]
+        first_sets = {}
+        for s in symbols:
+            if isinstance(s, Nonterminal):
+                first_sets[s] = graph.helper.first(s)
+        self.compile(first_sets)
+
+    def compile(self, first_sets=None):
+        """Intern all symbols and productions to integers and pack the table
+        into two row displacement (comb-vector) arrays, one for the actions on
+        terminals and one for the gotos on nonterminals. `lookup_id` is then a
+        few array reads instead of hashing (state, Symbol) tuples.
+
+        If the first sets of the nonterminals are given, also compile the hints
+        returned by `lookup_hint`."""
+        table = self.table
+        self.productions = []
+        production_ids = {}
+        for element in table.itervalues():
+            if isinstance(element, Reduce) and element.action not in production_ids:
+                production_ids[element.action] = len(self.productions)
+                self.productions.append(element.action)
+
+        # terminals are numbered before nonterminals, so that the id of a
+        # symbol tells which of the two compiled tables it belongs to
+        symbols = set([symbol for (_, symbol) in table])
+        symbols.update([p.left for p in self.productions])
+        terminals = sorted([s for s in symbols if not isinstance(s, Nonterminal)], key=repr)
+        nonterminals = sorted([s for s in symbols if isinstance(s, Nonterminal)], key=repr)
+        self.set_symbols(terminals + nonterminals, len(terminals))
+
+        self.num_states = max([state for (state, _) in table]) + 1 if table else 0
+        action_rows = [{} for _ in xrange(self.num_states)]
+        goto_rows = [{} for _ in xrange(self.num_states)]
+        for (state, symbol), element in table.iteritems():
+            symbol_id = self.symbol_ids[symbol]
+            if isinstance(element, Reduce):
+                packed = (production_ids[element.action] << ACTION_BITS) | REDUCE
+            elif isinstance(element, Shift):
+                packed = (element.action << ACTION_BITS) | SHIFT
+            elif isinstance(element, Goto):
+                packed = (element.action << ACTION_BITS) | GOTO
+            else:
+                packed = ACCEPT
+            if symbol_id < self.num_terminals:
+                action_rows[state][symbol_id] = packed
+            else:
+                goto_rows[state][symbol_id - self.num_terminals] = packed
+        self.action = CombVector(action_rows, self.num_terminals)
+        self.goto = CombVector(goto_rows, len(nonterminals))
+        if first_sets is None:
+            self.hints = None
+            self.hint_defaults = None
+        else:
+            self.hints = CombVector(self.compile_hints(first_sets, action_rows, goto_rows), len(nonterminals))
+
+        self.reduce_amount = array("i", [Reduce(p).amount() for p in self.productions])
+        self.reduce_left = array("i", [self.symbol_ids[p.left] for p in self.productions])
+        self._decoded = {}
+
+    def set_symbols(self, symbols, num_terminals):
+        self.symbols = symbols
+        self.num_terminals = num_terminals
+        self.symbol_ids = {}
+        self.terminal_ids = {}
+        for symbol_id, symbol in enumerate(symbols):
+            self.symbol_ids[symbol] = symbol_id
+            if type(symbol) is Terminal:
+                self.terminal_ids[symbol.name] = symbol_id
+
+    def compile_hints(self, first_sets, action_rows, goto_rows):
+        # When the incremental parser reuses a subtree whose nonterminal can't
+        # be shifted in the current state, it either has to reduce first or
+        # break the subtree down, depending on the action for the subtree's
+        # first terminal. For most states and nonterminals that action is the
+        # same for every terminal the nonterminal can start with, so the
+        # decision can be made without looking into the subtree. Each
+        # nonterminal gets a default (BREAKDOWN or FIRST_TERMINAL, whatever is
+        # more common) and only the other hints are stored in the table.
+        first_ids = {}
+        for symbol, first in first_sets.iteritems():
+            if symbol not in self.symbol_ids:
+                continue
+            column = self.symbol_ids[symbol] - self.num_terminals
+            if Epsilon() in first:
+                # empty subtrees don't contain their first terminal
+                first_ids[column] = None
+            else:
+                first_ids[column] = frozenset([self.symbol_ids.get(t, -1) for t in first])
+        hint_rows = []
+        counts = {}
+        for state in xrange(self.num_states):
+            reductions = {}
+            for symbol_id, packed in action_rows[state].iteritems():
+                if packed & ACTION_MASK == REDUCE:
+                    reductions.setdefault(packed, set()).add(symbol_id)
+            row = {}
+            for column, first in first_ids.iteritems():
+                if column in goto_rows[state]:
+                    continue
+                hint = BREAKDOWN
+                if reductions:
+                    hint = FIRST_TERMINAL
+                    if first is not None:
+                        for packed, terminals in reductions.iteritems():
+                            if first <= terminals:
+                                hint = packed
+                                break
+                            if not first.isdisjoint(terminals):
+                                break
+                        else:
+                            hint = BREAKDOWN
+                row[column] = hint
+                if hint == FIRST_TERMINAL:
+                    counts[column] = counts.get(column, 0) + 1
+                elif hint == BREAKDOWN:
+                    counts[column] = counts.get(column, 0) - 1
+            hint_rows.append(row)
+        self.hint_defaults = array("b", [BREAKDOWN] * (len(self.symbols) - self.num_terminals))
+        for column, count in counts.iteritems():
+            if count > 0:
+                self.hint_defaults[column] = FIRST_TERMINAL
+        for row in hint_rows:
+            for column, hint in row.items():
+                if hint == self.hint_defaults[column]:
+                    del row[column]
+        return hint_rows
+
+    def decompile(self):
+        table = {}
+        for state in xrange(self.num_states):
+            for symbol_id in xrange(len(self.symbols)):
+                element = self.decode(self.lookup_id(state, symbol_id))
+                if element is not None:
+                    table[(state, self.symbols[symbol_id])] = element
+        return table
+
+    def decode(self, packed):
+        """Convert a packed action back into a (shared) table element."""
+        if packed == ERROR:
+            return None
+        try:
+            return self._decoded[packed]
+        except KeyError:
+            kind = packed & ACTION_MASK
+            arg = packed >> ACTION_BITS
+            if kind == SHIFT:
+                element = Shift(arg)
+            elif kind == GOTO:
+                element = Goto(arg)
+            elif kind == REDUCE:
+                element = Reduce(self.productions[arg])
+            else:
+                element = Accept()
+            self._decoded[packed] = element
+            return element
+
+    def lookup_id(self, state_id, symbol_id):
+        """Return the packed action for a state and an interned symbol."""
+        if symbol_id is None or not 0 <= state_id < self.num_states:
+            return ERROR
+        if symbol_id < self.num_terminals:
+            table = self.action
+        else:
+            table = self.goto
+            symbol_id -= self.num_terminals
+        row = table.rows[state_id]
+        i = table.base[row] + symbol_id
+        if table.check[i] == row:
+            return table.value[i]
+        return ERROR
+
+    def lookup_hint(self, state_id, symbol_id):
+        """Return what to do with a reused subtree of a nonterminal that has no
+        goto in the given state: a packed reduction that has to be applied
+        first, BREAKDOWN, or FIRST_TERMINAL if that depends on the action for
+        the subtree's first terminal."""
+        if self.hints is None or symbol_id is None or not 0 <= state_id < self.num_states:
+            return FIRST_TERMINAL
+        row = self.hints.rows[state_id]
+        i = self.hints.base[row] + symbol_id - self.num_terminals
+        if self.hints.check[i] == row:
+            return self.hints.value[i]
+        return self.hint_defaults[symbol_id - self.num_terminals]
+
+    def get_symbols(self, state_id):
+        """Return all symbols that have an action in the given state."""
+        return set([symbol for symbol_id, symbol in enumerate(self.symbols)
+                    if self.lookup_id(state_id, symbol_id) != ERROR])
 
     def resolve_conflict(self, state, symbol, oldaction, newaction, precedences):
         # input: old_action, lookup_symbol, new_action
@@ -187,7 +510,4 @@ class SyntaxTable(object):
         return None
 
     def lookup(self, state_id, symbol):
-        try:
-            return self.table[(state_id, symbol)]
-        except KeyError:
-            return None
+        return self.decode(self.lookup_id(state_id, self.symbol_ids.get(symbol)))
@@ -22,7 +22,8 @@
 from incparser.lrparser import LRParser
 from incparser.incparser import IncParser
 from incparser.constants import LR0, LR1, LALR
-from incparser.astree import AST, Node
+from incparser.astree import AST, Node, TextNode, BOS, EOS
+from incparser.syntaxtable import FinishSymbol
 from grammar_parser.gparser import Parser, Nonterminal, Terminal, Epsilon
 
 import pytest
@@ -53,6 +54,40 @@ def test_node():
     assert i1.right_sibling() is plus
     assert plus.right_sibling() is i2
     assert i2.right_sibling() is None
+    assert i2.left_sibling() is plus
+    assert i1.left_sibling() is None
+
+def test_insert_remove_child():
+    bos = BOS(Terminal(""), 0, [])
+    eos = EOS(FinishSymbol(), 0, [])
+    bos.next_term = eos
+    eos.prev_term = bos
+    root = TextNode(Nonterminal("Root"), 0, [bos, eos])
+    expected = [bos, eos]
+    def insert_after(node, text):
+        new = TextNode(Terminal(text))
+        node.insert_after(new)
+        expected.insert(expected.index(node) + 1, new)
+        return new
+    last = bos
+    for i in range(20):
+        last = insert_after(last, str(i))
+    nodes = expected[1:-1]
+    # insert in front of the other nodes, so that they move
+    for i in range(5):
+        insert_after(bos, "x")
+    for node in nodes[::3]:
+        root.remove_child(node)
+        expected.remove(node)
+    insert_after(nodes[4], "y")
+    insert_after(nodes[17], "y")
+    assert root.children == expected
+    for i, c in enumerate(expected):
+        assert root.find_child(c) == i
+        assert c.left is (expected[i-1] if i > 0 else None)
+        assert c.right is (expected[i+1] if i+1 < len(expected) else None)
+    assert root.find_child(nodes[0]) == -1
+    assert root.textlen == len("".join(c.symbol.name for c in expected[1:-1]))
 
 def notest_ast():
     lrp = LRParser(grammar)
@@ -24,6 +24,8 @@ from incparser.constants import LR0, LR1, LALR
 from grammar_parser.gparser import Terminal, Nonterminal
 from incparser.astree import Node
 from viewer import Viewer
+from grammars.grammars import python
+from treemanager import TreeManager
 
 import pytest
 
@@ -150,3 +152,19 @@ def test_multiple_changes_3():
     lrp.stack[1].pprint()
     Viewer().show_tree(lrp.stack[1])
     assert False
+
+def test_error_after_failed_validation():
+    # a reused parser must not keep validating from its previous parse
+    parser, lexer = python.load()
+    for c in ")=:;}'\"/*$":
+        parser.reset()
+        treemanager = TreeManager()
+        treemanager.add_parser(parser, lexer, python.name)
+        treemanager.set_font_test(7, 17)
+        treemanager.import_file("x = 1\r")
+        treemanager.key_normal("+")
+        treemanager.key_backspace()
+        treemanager.key_normal(c)
+        assert parser.last_status == False
+        treemanager.key_backspace()
+        assert parser.last_status == True
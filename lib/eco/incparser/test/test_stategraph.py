@@ -123,3 +123,43 @@ def test_edges():
 
 def test_get_symbols():
     assert graph.get_symbols() == set([a, b, c, S, A])
+
+def states_with(graph, element):
+    return [s for s in graph.state_sets if element in s]
+
+def test_merge_weakly_compatible():
+    # the states after "a c" and "b c" only differ in their lookahead and
+    # are merged
+    p = Parser("""
+        S ::= "a" X "d"
+            | "b" X "e"
+        X ::= "c"
+    """)
+    p.parse()
+    graph = StateGraph(p.start_symbol, p.rules, 1)
+    graph.build()
+    X_c = State(Production(Nonterminal("X"), [c]), 1)
+    [s] = states_with(graph, X_c)
+    assert s.get_lookahead(X_c) == set([Terminal("d"), Terminal("e")])
+
+def test_no_merge_with_conflicts():
+    # LR(1), but not LALR(1): merging the states after "a c" and "b c" would
+    # cause a reduce/reduce conflict
+    p = Parser("""
+        S ::= "a" A "d"
+            | "b" B "d"
+            | "a" B "e"
+            | "b" A "e"
+        A ::= "c"
+        B ::= "c"
+    """)
+    p.parse()
+    graph = StateGraph(p.start_symbol, p.rules, 1)
+    graph.build()
+    A_c = State(Production(A, [c]), 1)
+    B_c = State(Production(Nonterminal("B"), [c]), 1)
+    states = states_with(graph, A_c)
+    assert len(states) == 2
+    for s in states:
+        assert B_c in s
+        assert not s.get_lookahead(A_c) & s.get_lookahead(B_c)
@@ -20,6 +20,7 @@
 # IN THE SOFTWARE.
 
 from incparser.syntaxtable import SyntaxTable, Goto, Shift, Reduce, Accept, FinishSymbol
+from incparser.syntaxtable import BREAKDOWN, FIRST_TERMINAL
 from incparser.stategraph import StateGraph
 from grammar_parser.gparser import Parser, Terminal, Nonterminal, Epsilon
 from incparser.production import Production
@@ -68,3 +69,57 @@ def test_build():
     st.build(graph)
     for key in syntaxtable.keys():
         assert st.table[key] == syntaxtable[key]
+
+def test_compiled_table():
+    graph = StateGraph(p.start_symbol, p.rules, 1)
+    graph.build()
+    st = SyntaxTable(1)
+    st.build(graph)
+    for (state, symbol), element in st.table.items():
+        packed = st.lookup_id(state, st.symbol_ids[symbol])
+        assert st.decode(packed) == element
+    assert st.lookup(0, d) is None
+    assert st.lookup_id(0, st.symbol_ids[d]) == 0
+    assert st.lookup(99, b) is None
+
+def test_pickle_compiled_table():
+    import pickle
+    graph = StateGraph(p.start_symbol, p.rules, 1)
+    graph.build()
+    st = SyntaxTable(1)
+    st.build(graph)
+    st2 = pickle.loads(pickle.dumps(st, pickle.HIGHEST_PROTOCOL))
+    for key in syntaxtable.keys():
+        assert st2.lookup(*key) == syntaxtable[key]
+    assert st2.table == st.table
+
+def test_reuse_hints():
+    p = Parser("""
+        S ::= A B
+        A ::= "a"
+        B ::= "b"
+    """)
+    p.parse()
+    graph = StateGraph(p.start_symbol, p.rules, 1)
+    graph.build()
+    st = SyntaxTable(1)
+    st.build(graph)
+    state = st.lookup(0, Terminal("a")).action
+    A_a = Production(Nonterminal("A"), [Terminal("a")])
+    # every B starts with "b", on which A ::= "a" is reduced
+    hint = st.lookup_hint(state, st.symbol_ids[Nonterminal("B")])
+    assert st.decode(hint) == Reduce(A_a)
+    # no S can start with a terminal that is reduced on
+    assert st.lookup_hint(state, st.symbol_ids[Nonterminal("S")]) == BREAKDOWN
+
+def test_reuse_hints_nullable():
+    graph = StateGraph(p.start_symbol, p.rules, 1)
+    graph.build()
+    st = SyntaxTable(1)
+    st.build(graph)
+    # A can be empty, so its first terminal may be outside of the subtree
+    assert st.lookup_hint(4, st.symbol_ids[A]) == FIRST_TERMINAL
+    assert st.lookup_hint(4, st.symbol_ids[S]) == BREAKDOWN
+    import pickle
+    st2 = pickle.loads(pickle.dumps(st, pickle.HIGHEST_PROTOCOL))
+    assert st2.lookup_hint(4, st.symbol_ids[A]) == FIRST_TERMINAL
@@ -21,6 +21,7 @@
 
 from grammar_parser.gparser import IndentationTerminal
 from incparser.astree import TextNode
+import history
 
 class IndentationManager:
 
@@ -68,9 +69,9 @@ class IndentationManager:
                 continue
             old = self.get_indentation(bol)
             if ws > current_ws:
-                self.indentation[bol] = current_indent + 1
+                self.set_indentation(bol, current_indent + 1)
             if ws == current_ws:
-                self.indentation[bol] = current_indent
+                self.set_indentation(bol, current_indent)
             if ws < current_ws:
                 self.calculate_indentation(bol)
 
@@ -87,6 +88,7 @@ class IndentationManager:
         return self.changed
 
     def repair_full(self):
+        history.save(self)
         self.whitespaces = {}
         self.indentation = {}
         bol = self.bos
@@ -100,6 +102,10 @@ class IndentationManager:
         line given by bol accordingly."""
         # calculate indentation by scanning previous lines
         ws = self.count_whitespace(bol)
+        if ws is None:
+            # lines that aren't logical have no indentation. Don't scan all
+            # previous lines for them (which makes importing quadratic)
+            return
         temp = bol
         found_smaller = False
         while bol is not self.bos:
@@ -111,11 +117,11 @@ class IndentationManager:
                 found_smaller = True
                 continue
             if ws == prev_ws:
-                self.indentation[temp] = self.get_indentation(bol)
+                self.set_indentation(temp, self.get_indentation(bol))
                 return
             if ws > prev_ws:
                 if not found_smaller:
-                    self.indentation[temp] = self.get_indentation(bol) + 1
+                    self.set_indentation(temp, self.get_indentation(bol) + 1)
                 return
 
     def fix_tokens(self, bol):#XXX redundant (remove and add import method that fixes each line)
@@ -123,20 +129,20 @@ class IndentationManager:
         new_tokens = []
         temp = bol
         if bol is self.bos:
-            self.indentation[bol] = 0
+            self.set_indentation(bol, 0)
         elif self.is_logical_line(bol):
             this_ws = self.count_whitespace(bol)
-            self.whitespaces[bol] = this_ws
+            self.set_whitespace(bol, this_ws)
             bol = self.prev_line(bol)
             while bol is not self.bos and not self.is_logical_line(bol):
                 bol = self.prev_line(bol)
             prev_ws = self.count_whitespace(bol)
 
             if prev_ws == this_ws:
-                self.indentation[temp] = self.get_indentation(bol) # this is only needed when calling fix_tokens separately (e.g. import)
+                self.set_indentation(temp, self.get_indentation(bol)) # this is only needed when calling fix_tokens separately (e.g. import)
                 new_tokens.append(self.create_token("newline"))
             elif prev_ws < this_ws:
-                self.indentation[temp] = self.get_indentation(bol) + 1
+                self.set_indentation(temp, self.get_indentation(bol) + 1)
                 new_tokens.append(self.create_token("indent"))
                 new_tokens.append(self.create_token("newline"))
             elif prev_ws > this_ws:
@@ -144,7 +150,7 @@ class IndentationManager:
                 if this_indent is None:
                     new_tokens.append(self.create_token("unbalanced"))
                 else:
-                    self.indentation[temp] = this_indent
+                    self.set_indentation(temp, this_indent)
                     prev_indent = self.get_indentation(bol)
                     indent_diff = prev_indent - this_indent
                     for i in range(indent_diff):
@@ -270,6 +276,14 @@ class IndentationManager:
         except KeyError:
             return 0
 
+    def set_whitespace(self, bol, ws):
+        history.save_item(self.whitespaces, bol)
+        self.whitespaces[bol] = ws
+
+    def set_indentation(self, bol, indent):
+        history.save_item(self.indentation, bol)
+        self.indentation[bol] = indent
+
     def prev_line(self, node):
         node = node.prev_term
         while True:
@@ -113,19 +113,13 @@ class JsonManager(object):
             lbox_root.magic_backpointer = node
             node.symbol.ast = lbox_root
             node.symbol.parser = lbox_root
+            node.update_length()
             self.last_terminal = temp
             self.language_boxes.append((lbox_root, jsnode["language"], jsnode["whitespaces"]))
 
         children = []
-        last_child = None
         for c in jsnode["children"]:
-            cnode = self.json_to_node(c)
-            cnode.parent = node
-            cnode.left = last_child
-            if last_child:
-                last_child.right = cnode
-            children.append(cnode)
-            last_child = cnode
-        node.children = children
+            children.append(self.json_to_node(c))
+        node.set_children(children)
 
         return node
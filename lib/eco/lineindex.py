@@ -0,0 +1,330 @@
+# Copyright (c) 2013--2014 King's College London
+# Created by the Software Development Team <http://soft-dev.org/>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""Ordered index of the lines of a document.
+
+The lines are kept in a treap (a randomly balanced binary tree) ordered by
+line number. Every line caches the number of lines, the sum of the heights
+and the largest width of its subtree, so looking up a line by number, the
+number of a line, the line containing a visual row and inserting or removing
+a line all take O(log n)."""
+
+import random
+import history
+
+# own generator for the priorities, so that creating lines doesn't change or
+# depend on the state of the global one
+_random = random.Random()
+
+class Line(object):
+    __slots__ = ["node", "_height", "_width", "indent", "ws",
+                 "left", "right", "parent", "priority",
+                 "size", "total_height", "max_width"]
+
+    def __init__(self, node, height=1):
+        history.created(self)
+        self.node = node        # this lines newline node
+        self._height = height   # line height
+        self._width = 0         # line width
+        self.indent = 0         # line indentation
+        self.ws = 0
+        self.reset()
+
+    def reset(self):
+        history.save(self)
+        self.left = None
+        self.right = None
+        self.parent = None
+        self.priority = _random.random()
+        self.size = 1
+        self.total_height = self._height
+        self.max_width = self._width
+
+    def get_height(self):
+        return self._height
+
+    def set_height(self, height):
+        if height != self._height:
+            history.save(self)
+            self._height = height
+            self.propagate()
+
+    height = property(get_height, set_height)
+
+    def get_width(self):
+        return self._width
+
+    def set_width(self, width):
+        if width != self._width:
+            history.save(self)
+            self._width = width
+            self.propagate()
+
+    width = property(get_width, set_width)
+
+    def update(self):
+        size = 1
+        total_height = self._height
+        max_width = self._width
+        left = self.left
+        if left is not None:
+            size += left.size
+            total_height += left.total_height
+            if left.max_width > max_width:
+                max_width = left.max_width
+        right = self.right
+        if right is not None:
+            size += right.size
+            total_height += right.total_height
+            if right.max_width > max_width:
+                max_width = right.max_width
+        history.save(self)
+        self.size = size
+        self.total_height = total_height
+        self.max_width = max_width
+
+    def propagate(self):
+        node = self
+        while node is not None:
+            node.update()
+            node = node.parent
+
+    def __repr__(self):
+        return "Line(%s, width=%s, height=%s)" % (self.node, self.width, self.height)
+
+class LineIndex(object):
+    """List of Line objects that also maps newline nodes and visual rows to
+    line numbers."""
+
+    def __init__(self, lines=[]):
+        self.root = None
+        self.nodes = {}     # id(newline node) -> Line
+        for line in lines:
+            self.append(line)
+
+    def __len__(self):
+        if self.root is None:
+            return 0
+        return self.root.size
+
+    def __iter__(self):
+        stack = []
+        node = self.root
+        while stack or node is not None:
+            while node is not None:
+                stack.append(node)
+                node = node.left
+            node = stack.pop()
+            yield node
+            node = node.right
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.get(j) for j in range(*i.indices(len(self)))]
+        return self.get(i)
+
+    def __delitem__(self, i):
+        if isinstance(i, slice):
+            for j in reversed(range(*i.indices(len(self)))):
+                self.remove(self.get(j))
+        else:
+            self.remove(self.get(i))
+
+    def get(self, i):
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("line index out of range")
+        node = self.root
+        while True:
+            left = node.left
+            lsize = 0 if left is None else left.size
+            if i < lsize:
+                node = left
+            elif i == lsize:
+                return node
+            else:
+                i -= lsize + 1
+                node = node.right
+
+    def append(self, line):
+        self.insert(len(self), line)
+
+    def insert(self, i, line):
+        size = len(self)
+        if i < 0:
+            i = max(0, i + size)
+        i = min(i, size)
+        line.reset()
+        history.save_item(self.nodes, id(line.node))
+        self.nodes[id(line.node)] = line
+        if self.root is None:
+            history.save(self)
+            self.root = line
+            return
+        node = self.root
+        while True:
+            left = node.left
+            lsize = 0 if left is None else left.size
+            if i <= lsize:
+                if left is None:
+                    history.save(node)
+                    node.left = line
+                    break
+                node = left
+            else:
+                i -= lsize + 1
+                if node.right is None:
+                    history.save(node)
+                    node.right = line
+                    break
+                node = node.right
+        line.parent = node
+        node.propagate()
+        while line.parent is not None and line.priority > line.parent.priority:
+            self._rotate_up(line)
+
+    def remove(self, line):
+        while line.left is not None or line.right is not None:
+            if line.right is None or (line.left is not None and
+                                      line.left.priority > line.right.priority):
+                self._rotate_up(line.left)
+            else:
+                self._rotate_up(line.right)
+        parent = line.parent
+        if parent is None:
+            history.save(self)
+            self.root = None
+        else:
+            history.save(parent)
+            if parent.left is line:
+                parent.left = None
+            else:
+                parent.right = None
+            parent.propagate()
+        if self.nodes.get(id(line.node)) is line:
+            history.save_item(self.nodes, id(line.node))
+            del self.nodes[id(line.node)]
+        line.reset()
+
+    def _rotate_up(self, node):
+        parent = node.parent
+        grandparent = parent.parent
+        history.save(node)
+        history.save(parent)
+        history.save(grandparent if grandparent is not None else self)
+        if parent.left is node:
+            parent.left = node.right
+            if node.right is not None:
+                history.save(node.right)
+                node.right.parent = parent
+            node.right = parent
+        else:
+            parent.right = node.left
+            if node.left is not None:
+                history.save(node.left)
+                node.left.parent = parent
+            node.left = parent
+        parent.parent = node
+        node.parent = grandparent
+        if grandparent is None:
+            self.root = node
+        elif grandparent.left is parent:
+            grandparent.left = node
+        else:
+            grandparent.right = node
+        parent.update()
+        node.update()
+
+    def index(self, line):
+        """Return the number of `line`."""
+        i = 0 if line.left is None else line.left.size
+        node = line
+        while node.parent is not None:
+            parent = node.parent
+            if parent.right is node:
+                i += 1 if parent.left is None else parent.left.size + 1
+            node = parent
+        if node is not self.root:
+            raise ValueError("%r is not in index" % (line,))
+        return i
+
+    def find(self, node):
+        """Return the number of the line starting with the newline `node`, or
+        -1 if there is no such line."""
+        line = self.nodes.get(id(node))
+        if line is None or line.node is not node:
+            return -1
+        return self.index(line)
+
+    def height_before(self, i):
+        """Sum of the heights of the lines before line `i`."""
+        height = 0
+        node = self.root
+        while node is not None:
+            left = node.left
+            lsize = 0 if left is None else left.size
+            if i < lsize:
+                node = left
+            else:
+                if left is not None:
+                    height += left.total_height
+                if i == lsize:
+                    break
+                height += node._height
+                i -= lsize + 1
+                node = node.right
+        return height
+
+    def line_at_height(self, y):
+        """Return the number of the line that contains visual row `y` and the
+        row the line starts at. Rows past the end map to the last line."""
+        if self.root is None:
+            raise IndexError("line index out of range")
+        y = max(y, 0)
+        if y >= self.root.total_height:
+            last = len(self) - 1
+            return last, self.height_before(last)
+        i = 0
+        top = 0
+        node = self.root
+        while True:
+            left = node.left
+            lsize, lheight = (0, 0) if left is None else (left.size, left.total_height)
+            if y < lheight:
+                node = left
+            elif y < lheight + node._height:
+                return i + lsize, top + lheight
+            else:
+                y -= lheight + node._height
+                top += lheight + node._height
+                i += lsize + 1
+                node = node.right
+
+    def total_height(self):
+        if self.root is None:
+            return 0
+        return self.root.total_height
+
+    def max_width(self):
+        if self.root is None:
+            return 0
+        return self.root.max_width
@@ -138,11 +138,8 @@ class NodeEditor(QFrame):
         self.update()
 
     def getScrollSizes(self):
-        total_lines = 0
-        max_width = 0
-        for l in self.lines:
-            total_lines += l.height
-            max_width = max(max_width, l.width)
+        total_lines = self.lines.total_height()
+        max_width = self.lines.max_width()
         max_visible_lines = self.geometry().height() / self.fontht
         self.scroll_height = max(0, total_lines - max_visible_lines)
 
@@ -175,11 +172,8 @@ class NodeEditor(QFrame):
 
         paint.end()
 
-        total_lines = 0
-        max_width = 0
-        for l in self.lines:
-            total_lines += l.height
-            max_width = max(max_width, l.width)
+        total_lines = self.lines.total_height()
+        max_width = self.lines.max_width()
         max_visible_lines = self.geometry().height() / self.fontht
         self.scroll_height = max(0, total_lines - max_visible_lines)
 
@@ -193,13 +187,7 @@ class NodeEditor(QFrame):
     def paintLines(self, paint, startline):
 
         # find internal line corresponding to visual line
-        visual_line = 0
-        internal_line = 0
-        for l in self.tm.lines:
-            if visual_line + l.height > startline:
-                break
-            visual_line += l.height
-            internal_line += 1
+        internal_line, visual_line = self.tm.lines.line_at_height(startline)
 
         x = 0
         y = visual_line - startline # start drawing outside of viewport to display partial images
@@ -514,9 +502,7 @@ class NodeEditor(QFrame):
             self.update()
 
     def cursor_to_coordinate(self):
-        y = 0
-        for l in self.tm.lines[:self.cursor.line]:
-            y += l.height * self.fontht
+        y = self.tm.lines.height_before(self.cursor.line) * self.fontht
         x = self.tm.cursor.get_x() * self.fontwt
         y = y - self.getScrollArea().verticalScrollBar().value() * self.fontht
         return (x,y)
@@ -0,0 +1,488 @@
+# Copyright (c) 2013--2014 King's College London
+# Created by the Software Development Team <http://soft-dev.org/>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""Compact binary format for the tables built from grammars: syntax tables,
+lexer automata, and both of them together for `EcoFile.load`.
+
+A file starts with a header and a directory of named sections, followed by
+the sections themselves, each aligned to 8 bytes. A section is either an
+integer array, stored as raw machine words together with its typecode, item
+size and the byte order of the writer, a byte string, or a pickled object.
+Strings are stored in pools: their UTF-8 encodings back to back plus an
+array of offsets.
+
+Files are mapped read-only, so each integer table is loaded with a single
+copy out of the page cache instead of constructing an object per entry. The
+semantic annotations of productions are the only pickled part of a syntax
+table and are decoded the first time the parser reduces a production."""
+
+import imp, marshal, mmap, struct, sys
+from array import array
+from itertools import izip
+
+try:
+    import cPickle as pickle
+except:
+    import pickle
+
+from grammar_parser.gparser import Terminal, MagicTerminal, IndentationTerminal, Nonterminal, Epsilon
+from incparser.syntaxtable import SyntaxTable, CombVector, FinishSymbol, compact_array
+from incparser.production import Production
+from cflexer.deterministic import DFA
+
+MAGIC = "ECOTBL\x00"
+VERSION = 1
+suffix = ".tbl"
+
+# magic, version, byte order, number of sections
+_header = struct.Struct("<7sBcI")
+# name, typecode, item size, offset, size
+_section = struct.Struct("<64scBQQ")
+
+BYTES = "s"
+PICKLE = "p"
+
+# kinds of strings in a string pool
+STR = 0
+UNICODE = 1
+NONE = 2
+
+symbol_kinds = [Terminal, Nonterminal, FinishSymbol, MagicTerminal, IndentationTerminal, Epsilon]
+
+class FormatError(Exception):
+    pass
+
+def align(offset):
+    return (offset + 7) & ~7
+
+class TableWriter(object):
+
+    def __init__(self):
+        self.sections = []
+        self.names = set()
+
+    def add(self, name, typecode, itemsize, data):
+        assert len(name) <= 64 and name not in self.names
+        self.names.add(name)
+        self.sections.append((name, typecode, itemsize, data))
+
+    def add_array(self, name, a):
+        self.add(name, a.typecode, a.itemsize, a.tostring())
+
+    def add_ints(self, name, values):
+        self.add_array(name, compact_array(values))
+
+    def add_bytes(self, name, data):
+        self.add(name, BYTES, 1, data)
+
+    def add_object(self, name, obj):
+        self.add(name, PICKLE, 1, pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+
+    def add_pool(self, name, items):
+        offsets = [0]
+        for item in items:
+            offsets.append(offsets[-1] + len(item))
+        self.add_ints(name + ".offsets", offsets)
+        self.add_bytes(name, "".join(items))
+
+    def add_strings(self, name, strings):
+        kinds = []
+        items = []
+        for s in strings:
+            if s is None:
+                kinds.append(NONE)
+                items.append("")
+            elif isinstance(s, unicode):
+                kinds.append(UNICODE)
+                items.append(s.encode("utf-8"))
+            else:
+                kinds.append(STR)
+                items.append(s)
+        self.add_array(name + ".kinds", array("b", kinds))
+        self.add_pool(name, items)
+
+    def write(self, f):
+        byteorder = "<" if sys.byteorder == "little" else ">"
+        f.write(_header.pack(MAGIC, VERSION, byteorder, len(self.sections)))
+        position = _header.size + _section.size * len(self.sections)
+        offset = align(position)
+        for name, typecode, itemsize, data in self.sections:
+            f.write(_section.pack(name, typecode, itemsize, offset, len(data)))
+            offset = align(offset + len(data))
+        for name, typecode, itemsize, data in self.sections:
+            f.write("\x00" * (align(position) - position))
+            f.write(data)
+            position = align(position) + len(data)
+
+class TableFile(object):
+    """Read-only view of a file written by `TableWriter`."""
+
+    def __init__(self, f):
+        try:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError), e:
+            # e.g. empty files can't be mapped
+            raise FormatError(str(e))
+        if len(self.map) < _header.size:
+            raise FormatError("truncated header")
+        magic, version, byteorder, count = _header.unpack_from(self.map)
+        if magic != MAGIC or version != VERSION:
+            raise FormatError("not a table file of version %s" % (VERSION,))
+        self.swap = byteorder != ("<" if sys.byteorder == "little" else ">")
+        self.sections = {}
+        for i in range(count):
+            position = _header.size + i * _section.size
+            if position + _section.size > len(self.map):
+                raise FormatError("truncated directory")
+            name, typecode, itemsize, offset, size = _section.unpack_from(self.map, position)
+            if offset + size > len(self.map):
+                raise FormatError("truncated section %s" % (name,))
+            self.sections[name.rstrip("\x00")] = (typecode, itemsize, offset, size)
+
+    def section(self, name, kind):
+        try:
+            typecode, itemsize, offset, size = self.sections[name]
+        except KeyError:
+            raise FormatError("missing section %s" % (name,))
+        if kind is None:
+            wrong = typecode in (BYTES, PICKLE)
+        else:
+            wrong = typecode != kind
+        if wrong:
+            raise FormatError("section %s has the wrong type" % (name,))
+        return typecode, itemsize, offset, size
+
+    def array(self, name):
+        typecode, itemsize, offset, size = self.section(name, None)
+        a = array(typecode)
+        if a.itemsize != itemsize:
+            raise FormatError("section %s: platform has a different item size" % (name,))
+        a.fromstring(buffer(self.map, offset, size))
+        if self.swap:
+            a.byteswap()
+        return a
+
+    def bytes(self, name):
+        _, _, offset, size = self.section(name, BYTES)
+        return self.map[offset:offset + size]
+
+    def object(self, name):
+        _, _, offset, size = self.section(name, PICKLE)
+        return pickle.loads(self.map[offset:offset + size])
+
+    def pool(self, name):
+        return Pool(self, name)
+
+    def strings(self, name):
+        kinds = self.array(name + ".kinds")
+        pool = self.pool(name)
+        result = []
+        for i, kind in enumerate(kinds):
+            if kind == NONE:
+                result.append(None)
+            elif kind == UNICODE:
+                result.append(pool[i].decode("utf-8"))
+            else:
+                result.append(pool[i])
+        return result
+
+class Pool(object):
+    """The items of a pool section, sliced out of the mapped file on
+    access."""
+
+    def __init__(self, tablefile, name):
+        self.offsets = tablefile.array(name + ".offsets")
+        _, _, self.start, size = tablefile.section(name, BYTES)
+        if len(self.offsets) == 0 or self.offsets[-1] > size:
+            raise FormatError("section %s: offsets out of range" % (name,))
+        self.map = tablefile.map
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.map[self.start + self.offsets[i]:self.start + self.offsets[i + 1]]
+
+class LazyProductions(object):
+    """The productions of a syntax table read from a table file. A production
+    is only built (and its annotation unpickled) when it is first used."""
+
+    def __init__(self, symbols, left, right_offsets, right, extras):
+        self.symbols = symbols
+        self.left = left
+        self.right_offsets = right_offsets
+        self.right = right
+        self.extras = extras
+        self.productions = [None] * len(left)
+
+    def __len__(self):
+        return len(self.productions)
+
+    def __getitem__(self, i):
+        production = self.productions[i]
+        if production is None:
+            right = [self.symbols[s] for s in self.right[self.right_offsets[i]:self.right_offsets[i + 1]]]
+            annotation, prec, inserts = pickle.loads(self.extras[i])
+            production = Production(self.symbols[self.left[i]], right, annotation, prec)
+            production.inserts = inserts
+            self.productions[i] = production
+        return production
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+def symbol_key(symbol):
+    return (type(symbol), symbol.name, getattr(symbol, "folding", None))
+
+def write_symbols(writer, name, symbols):
+    kinds = []
+    for symbol in symbols:
+        try:
+            kinds.append(symbol_kinds.index(type(symbol)))
+        except ValueError:
+            raise TypeError("can't store symbol %r" % (symbol,))
+    writer.add_array(name + ".kinds", array("b", kinds))
+    writer.add_strings(name + ".names", [symbol.name for symbol in symbols])
+    writer.add_strings(name + ".folding", [getattr(symbol, "folding", None) for symbol in symbols])
+
+def read_symbols(tablefile, name):
+    kinds = tablefile.array(name + ".kinds")
+    names = tablefile.strings(name + ".names")
+    folding = tablefile.strings(name + ".folding")
+    symbols = []
+    for kind, symbol_name, fold in zip(kinds, names, folding):
+        cls = symbol_kinds[kind]
+        if cls is FinishSymbol:
+            symbol = FinishSymbol()
+        else:
+            symbol = cls(symbol_name, fold)
+        symbols.append(symbol)
+    return symbols
+
+def write_combvector(writer, name, vector):
+    for part in ("rows", "base", "check", "value"):
+        writer.add_array("%s.%s" % (name, part), getattr(vector, part))
+
+def read_combvector(tablefile, name):
+    vector = CombVector.__new__(CombVector)
+    for part in ("rows", "base", "check", "value"):
+        setattr(vector, part, tablefile.array("%s.%s" % (name, part)))
+    return vector
+
+def write_syntaxtable(writer, table, name="syntaxtable"):
+    # the symbols of the productions can differ from the table's symbols
+    # (e.g. in their folding), so they are stored after the table's symbols
+    symbols = list(table.symbols)
+    symbol_ids = {}
+    for symbol_id, symbol in enumerate(symbols):
+        symbol_ids.setdefault(symbol_key(symbol), symbol_id)
+    def intern(symbol):
+        key = symbol_key(symbol)
+        if key not in symbol_ids:
+            symbol_ids[key] = len(symbols)
+            symbols.append(symbol)
+        return symbol_ids[key]
+
+    left = []
+    right_offsets = [0]
+    right = []
+    extras = []
+    for production in table.productions:
+        left.append(intern(production.left))
+        right.extend([intern(symbol) for symbol in production.right])
+        right_offsets.append(len(right))
+        extras.append(pickle.dumps((production.annotation, production.prec, production.inserts), pickle.HIGHEST_PROTOCOL))
+
+    has_hints = table.hints is not None
+    writer.add_ints(name + ".meta", [table.lr_type, table.num_states, len(table.symbols), table.num_terminals, has_hints])
+    write_symbols(writer, name + ".symbols", symbols)
+    writer.add_ints(name + ".left", left)
+    writer.add_ints(name + ".right.offsets", right_offsets)
+    writer.add_ints(name + ".right", right)
+    writer.add_pool(name + ".extras", extras)
+    writer.add_array(name + ".reduce_amount", table.reduce_amount)
+    writer.add_array(name + ".reduce_left", table.reduce_left)
+    write_combvector(writer, name + ".action", table.action)
+    write_combvector(writer, name + ".goto", table.goto)
+    if has_hints:
+        write_combvector(writer, name + ".hints", table.hints)
+        writer.add_array(name + ".hint_defaults", table.hint_defaults)
+
+def read_syntaxtable(tablefile, name="syntaxtable"):
+    lr_type, num_states, num_symbols, num_terminals, has_hints = tablefile.array(name + ".meta")
+    symbols = read_symbols(tablefile, name + ".symbols")
+    table = SyntaxTable(lr_type)
+    table._table = None # decompiled on demand
+    table.num_states = num_states
+    table.set_symbols(symbols[:num_symbols], num_terminals)
+    table.productions = LazyProductions(symbols,
+                                        tablefile.array(name + ".left"),
+                                        tablefile.array(name + ".right.offsets"),
+                                        tablefile.array(name + ".right"),
+                                        tablefile.pool(name + ".extras"))
+    table.reduce_amount = tablefile.array(name + ".reduce_amount")
+    table.reduce_left = tablefile.array(name + ".reduce_left")
+    table.action = read_combvector(tablefile, name + ".action")
+    table.goto = read_combvector(tablefile, name + ".goto")
+    if has_hints:
+        table.hints = read_combvector(tablefile, name + ".hints")
+        table.hint_defaults = tablefile.array(name + ".hint_defaults")
+    return table
+
+def write_dfa(writer, dfa, name="dfa"):
+    transitions = sorted(dfa.transitions.iteritems())
+    writer.add_ints(name + ".meta", [dfa.num_states])
+    writer.add_ints(name + ".from", [state for (state, _), _ in transitions])
+    writer.add_bytes(name + ".chars", u"".join([unicode(char, "latin-1") if isinstance(char, str) else char
+                                                for (_, char), _ in transitions]).encode("utf-32-le"))
+    writer.add_array(name + ".unicode", array("b", [isinstance(char, unicode) for (_, char), _ in transitions]))
+    writer.add_ints(name + ".to", [nextstate for _, nextstate in transitions])
+    writer.add_ints(name + ".final", sorted(dfa.final_states))
+    writer.add_ints(name + ".unmergeable", sorted(dfa.unmergeable_states))
+    writer.add_strings(name + ".names", dfa.names)
+    keywords = sorted([(state, text, keyword) for state, texts in dfa.keywords.iteritems()
+                                              for text, keyword in texts.iteritems()])
+    writer.add_ints(name + ".keywords.from", [state for state, _, _ in keywords])
+    writer.add_strings(name + ".keywords.texts", [text for _, text, _ in keywords])
+    writer.add_ints(name + ".keywords.to", [keyword for _, _, keyword in keywords])
+
+def read_dfa(tablefile, name="dfa"):
+    chars = tablefile.bytes(name + ".chars").decode("utf-32-le")
+    # characters are restored with the type they were built with, which is
+    # usually str for all of them
+    is_unicode = tablefile.array(name + ".unicode")
+    if is_unicode.count(1) == 0:
+        chars = list(chars.encode("latin-1"))
+    else:
+        chars = [c if u else c.encode("latin-1") for c, u in izip(chars, is_unicode)]
+    transitions = dict(izip(izip(tablefile.array(name + ".from"), chars),
+                            tablefile.array(name + ".to")))
+    dfa = DFA(transitions=transitions,
+              final_states=set(tablefile.array(name + ".final")),
+              unmergeable_states=set(tablefile.array(name + ".unmergeable")),
+              names=tablefile.strings(name + ".names"))
+    dfa.num_states = tablefile.array(name + ".meta")[0]
+    for state, text, keyword in izip(tablefile.array(name + ".keywords.from"),
+                                     tablefile.strings(name + ".keywords.texts"),
+                                     tablefile.array(name + ".keywords.to")):
+        dfa.keywords.setdefault(state, {})[text] = keyword
+    return dfa
+
+def write_transition_table(writer, table, name="transitions"):
+    writer.add_ints(name + ".meta", [table.num_states, table.num_classes])
+    if isinstance(table.classes, bytearray):
+        writer.add_bytes(name + ".classes", str(table.classes))
+    else:
+        writer.add_array(name + ".classes", table.classes)
+    other_classes = sorted(table.other_classes.iteritems())
+    writer.add_ints(name + ".other_chars", [code for code, _ in other_classes])
+    writer.add_ints(name + ".other_classes", [cls for _, cls in other_classes])
+    writer.add_ints(name + ".table", table.table)
+    writer.add_bytes(name + ".final", str(table.final))
+    writer.add_bytes(name + ".dead", str(table.dead))
+
+def read_transition_table(tablefile, name="transitions"):
+    from cflexer.deterministic import TransitionTable
+    table = TransitionTable()
+    table.num_states, table.num_classes = tablefile.array(name + ".meta")
+    if tablefile.sections[name + ".classes"][0] == BYTES:
+        table.classes = bytearray(tablefile.bytes(name + ".classes"))
+    else:
+        table.classes = tablefile.array(name + ".classes")
+    table.other_classes = dict(izip(tablefile.array(name + ".other_chars"),
+                                    tablefile.array(name + ".other_classes")))
+    table.table = tablefile.array(name + ".table")
+    table.final = bytearray(tablefile.bytes(name + ".final"))
+    table.dead = bytearray(tablefile.bytes(name + ".dead"))
+    return table
+
+def write_lexer(writer, inclexer, name="lexer"):
+    lexer = inclexer.lexer
+    writer.add_object(name + ".regexs", lexer.token_regexs)
+    writer.add_strings(name + ".names", lexer.names)
+    writer.add_strings(name + ".ignore", sorted(lexer.ignore))
+    writer.add_object(name + ".options", (inclexer.indentation_based, inclexer.lookup_ids, lexer.table,
+                                          lexer.keywords))
+    write_dfa(writer, lexer.automaton, name + ".dfa")
+    # store what the matcher is made from, so loading doesn't rebuild it
+    if lexer.transition_table is not None:
+        write_transition_table(writer, lexer.transition_table, name + ".transitions")
+    if lexer.code is not None:
+        # bytecode only loads into the interpreter version that wrote it
+        writer.add_bytes(name + ".code.magic", imp.get_magic())
+        writer.add_bytes(name + ".code", marshal.dumps(lexer.code))
+
+def read_lexer(tablefile, name="lexer"):
+    from cflexer.lexer import Lexer
+    from inclexer.inclexer import IncrementalLexerCF
+    indentation_based, lookup_ids, table, keywords = tablefile.object(name + ".options")
+    transition_table = code = None
+    if name + ".transitions.meta" in tablefile.sections:
+        transition_table = read_transition_table(tablefile, name + ".transitions")
+    if name + ".code" in tablefile.sections and \
+            tablefile.bytes(name + ".code.magic") == imp.get_magic():
+        code = marshal.loads(tablefile.bytes(name + ".code"))
+    inclexer = IncrementalLexerCF()
+    inclexer.lexer = Lexer(tablefile.object(name + ".regexs"),
+                           tablefile.strings(name + ".names"),
+                           tablefile.strings(name + ".ignore"),
+                           read_dfa(tablefile, name + ".dfa"),
+                           table,
+                           transition_table=transition_table,
+                           code=code,
+                           keywords=keywords)
+    inclexer.indentation_based = indentation_based
+    inclexer.lookup_ids = lookup_ids
+    return inclexer
+
+# readers and writers for the grammar cache (see `GrammarCache.get`)
+
+def dump_syntaxtable(table, f):
+    writer = TableWriter()
+    write_syntaxtable(writer, table)
+    writer.write(f)
+
+def load_syntaxtable(f):
+    return read_syntaxtable(TableFile(f))
+
+def dump_dfa(dfa, f):
+    writer = TableWriter()
+    write_dfa(writer, dfa)
+    writer.write(f)
+
+def load_dfa(f):
+    return read_dfa(TableFile(f))
+
+def dump_grammar(entry, f):
+    """Write the syntax table, lexer and whitespace option of a language, as
+    returned by `EcoFile.build`."""
+    writer = TableWriter()
+    writer.add_ints("whitespaces", [entry["whitespaces"]])
+    write_syntaxtable(writer, entry["syntaxtable"])
+    write_lexer(writer, entry["lexer"])
+    writer.write(f)
+
+def load_grammar(f):
+    tablefile = TableFile(f)
+    return {"syntaxtable": read_syntaxtable(tablefile),
+            "whitespaces": bool(tablefile.array("whitespaces")[0]),
+            "lexer": read_lexer(tablefile)}
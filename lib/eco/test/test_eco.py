@@ -22,8 +22,9 @@
 from grammars.grammars import calc, java, python, Language, sql, pythonprolog, lang_dict
 from treemanager import TreeManager
 from incparser.incparser import IncParser
-from inclexer.inclexer import IncrementalLexer
-from incparser.astree import BOS, EOS
+from inclexer.inclexer import IncrementalLexer, StringWrapper
+from incparser.astree import AST, BOS, EOS, TextNode
+from grammar_parser.gparser import MagicTerminal, Terminal
 
 from PyQt4 import QtCore
 
@@ -586,6 +587,415 @@ class Test_Bugs(Test_Python):
         self.treemanager.key_normal("c")
         self.treemanager.key_backspace() # shouldn't throw IndexError in repair_indentations
 
+class Test_LookupIds(Test_Python):
+
+    def check_lookup_ids(self):
+        terminal_ids = self.parser.syntaxtable.terminal_ids
+        node = self.parser.previous_version.parent.children[0].next_term
+        while not isinstance(node, EOS):
+            if node.lookup != "":
+                assert node.lookup_id == terminal_ids.get(node.lookup)
+            node = node.next_term
+
+    def test_import(self):
+        self.reset()
+        self.treemanager.import_file("class X:\r    def f(self, a):\r        return a + 1\r")
+        assert self.parser.last_status == True
+        self.check_lookup_ids()
+
+    def test_typing(self):
+        self.reset()
+        for c in "x = 12":
+            self.treemanager.key_normal(c)
+        self.treemanager.key_backspace()
+        self.treemanager.key_normal("a")
+        self.check_lookup_ids()
+
+class Test_StateStack(Test_Python):
+
+    def test_node_states_not_needed(self):
+        # the parser keeps its states on a stack, so reused nodes are neither
+        # read nor updated
+        self.reset()
+        self.treemanager.import_file("class X:\r    def f(self):\r        return 1\r\rx = 2")
+        assert self.parser.last_status == True
+        todo = [self.parser.previous_version.parent]
+        while todo:
+            node = todo.pop()
+            node.state = -1
+            todo.extend(node.children)
+        self.move('down', 4)
+        self.treemanager.key_end()
+        self.treemanager.key_normal("3")
+        assert self.parser.last_status == True
+        classdef = self.parser.previous_version.parent.children[1].children[0]
+        assert classdef.state == -1
+        self.treemanager.key_normal("+")
+        assert self.parser.last_status == False
+        self.treemanager.key_backspace()
+        assert self.parser.last_status == True
+        assert len(self.parser.stack) == len(self.parser.state_stack)
+
+class Test_UndoJournal(Test_Python):
+
+    def check_links(self, node):
+        last = None
+        for c in node.children:
+            assert c.parent is node
+            assert c.left is last
+            if last is not None:
+                assert last.right is c
+            last = c
+            self.check_links(c)
+
+    def test_restore(self):
+        self.reset()
+        self.treemanager.import_file("".join(["def f%s(a):\r    b = a\r    return b\r\r" % i for i in range(20)]))
+        assert self.parser.last_status == True
+        tokens = 0
+        node = self.parser.previous_version.parent.children[0]
+        while not isinstance(node, EOS):
+            tokens += 1
+            node = node.next_term
+        self.move('down', 1)
+        self.treemanager.key_end()
+        self.treemanager.key_normal("=")
+        assert self.parser.last_status == False
+        # every node is recorded at most once
+        assert 0 < self.parser.journal_sizes[-1] < tokens
+        self.check_links(self.parser.previous_version.parent)
+        self.treemanager.key_backspace()
+        assert self.parser.last_status == True
+        self.check_links(self.parser.previous_version.parent)
+
+class Test_Import(Test_Python):
+
+    def get_nodes(self, root):
+        todo = [root]
+        while todo:
+            node = todo.pop()
+            yield node
+            todo.extend(node.children)
+
+    def test_balanced_tree(self):
+        from inclexer.inclexer import IMPORT_GROUP_SIZE
+        self.reset()
+        text = "".join(["def f%s(a):\r    return a\r\r" % i for i in range(100)])
+        # a syntax error leaves the imported tree in place
+        self.treemanager.import_file(text + "x = (")
+        assert self.parser.last_status == False
+        root = self.parser.previous_version.parent
+        assert len(root.children) <= IMPORT_GROUP_SIZE + 2
+        for node in self.get_nodes(root):
+            # plus the indentation tokens inserted after the import
+            assert len(node.children) < 2 * IMPORT_GROUP_SIZE
+        exported = self.treemanager.export_as_text("/dev/null")
+        assert exported == (text + "x = (").replace("\r", "\n")
+
+        self.move('down', 300)
+        self.treemanager.key_end()
+        self.treemanager.key_normal(")")
+        assert self.parser.last_status == True
+        for node in self.get_nodes(root):
+            assert node.symbol.name != "~IMPORT~"
+
+class Test_LexerCheckpoints(Test_Python):
+
+    def check_tokens(self):
+        # the relexed tokens are the same as when lexing the text again
+        tokens = []
+        node = self.parser.previous_version.parent.children[0].next_term
+        while not isinstance(node, EOS):
+            if node.lookup != "":
+                tokens.append((node.symbol.name, node.lookup))
+            node = node.next_term
+        text = "".join(name for name, _ in tokens)
+        assert tokens == self.lexer.lex(text)
+
+    def test_edit_long_string(self):
+        self.reset()
+        self.treemanager.import_file("x = '" + "abcdefgh" * 50 + "'\ry = 1")
+        assert self.parser.last_status == True
+        self.move('right', 100)
+        for c in "XYZ":
+            self.treemanager.key_normal(c)
+            node = self.treemanager.cursor.node
+            assert node.lookup == "STRING"
+            assert node.checkpoints is not None
+            assert node.checkpoints.text == node.symbol.name
+            self.check_tokens()
+        assert self.parser.last_status == True
+        for c in "' '":
+            self.treemanager.key_normal(c)
+            self.check_tokens()
+        for i in range(5):
+            self.treemanager.key_backspace()
+            self.check_tokens()
+        assert self.parser.last_status == True
+
+class Test_StringWrapper(object):
+
+    def test_stringwrapper_cursor(self):
+        ast = AST()
+        ast.init()
+        bos = ast.parent.children[0]
+        last = bos
+        for name in ["ab", "c", "de", "\r", "fg"]:
+            node = TextNode(Terminal(name))
+            last.insert_after(node)
+            last = node
+
+        wrapper = StringWrapper(bos.next_term)
+        # read forwards, backwards and forwards again
+        assert [wrapper[i] for i in range(5)] == list("abcde")
+        assert wrapper.current.symbol.name == "de"
+        assert len(wrapper) == 5
+        assert [wrapper[i] for i in range(4, -1, -1)] == list("edcba")
+        assert wrapper.current.symbol.name == "ab"
+        assert wrapper[5] == "\r"
+        assert wrapper[6] == "f"
+
+        # slices end at the first line boundary
+        assert wrapper[3:20] == "de"
+        assert wrapper[5:7] == ""
+        assert wrapper[0:] == "abcde"
+
+def check_text_length(node):
+    # the cached lengths are the same as when counting them again
+    if node.children:
+        textlen = sum(check_text_length(c)[0] for c in node.children)
+        newlines = sum(c.newlines for c in node.children)
+    elif isinstance(node.symbol, MagicTerminal):
+        textlen, newlines = check_text_length(node.symbol.ast)
+    else:
+        textlen, newlines = node.get_length()
+    assert (node.textlen, node.newlines) == (textlen, newlines)
+    return textlen, newlines
+
+class Test_TextLength(Test_Python):
+
+    def check_offsets(self):
+        root = self.parser.previous_version.parent
+        check_text_length(root)
+        exported = self.treemanager.export_as_text("/dev/null")
+        text = exported.replace("\n", "\r")
+        assert root.textlen == len(text)
+        assert root.newlines == len(self.treemanager.lines) - 1
+        for offset in range(len(text)):
+            node, start = root.find_offset(offset)
+            assert node.symbol.name[offset - start] == text[offset]
+            assert node.get_offset() == (start, exported[:start].count("\n"))
+        assert root.find_offset(len(text)) == (None, len(text))
+        for i, line in enumerate(self.treemanager.lines):
+            assert root.find_line(i) == line.node.get_offset()[0] + line.node.textlen
+
+    def test_edit(self):
+        self.reset()
+        self.treemanager.import_file("class X:\r    def f(self):\r        return 1\r\rx = X()\r")
+        self.check_offsets()
+        self.move("down", 2)
+        self.treemanager.key_end()
+        for c in " + 23\r        pass":
+            self.treemanager.key_normal(c)
+            self.check_offsets()
+        for i in range(10):
+            self.treemanager.key_backspace()
+            self.check_offsets()
+        self.treemanager.key_home()
+        self.treemanager.key_shift()
+        self.treemanager.key_cursors("up", mod_shift=True)
+        self.treemanager.deleteSelection()
+        self.check_offsets()
+
+    def test_get_nodes_at_position(self):
+        self.reset()
+        self.treemanager.import_file("x = 12\ry = 3")
+        ast = self.parser.previous_version
+        node, other = ast.get_nodes_at_position(5)
+        assert node.symbol.name == "12" and node.position == 4
+        assert other is None
+        node, other = ast.get_nodes_at_position(4)
+        assert (node.symbol.name, other.symbol.name) == (" ", "12")
+        assert ast.find_node_at_pos(7).symbol.name == "y"
+
+    def test_multiline_string(self):
+        # linebreaks inside of tokens don't start new lines in the editor
+        self.reset()
+        self.treemanager.import_file("x = '''a\rb'''\ry = 1\r")
+        self.check_offsets()
+        assert self.parser.previous_version.parent.newlines == 2
+
+    def test_jump_to_error(self):
+        self.reset()
+        self.treemanager.import_file("x = 1\ry = 2\rz = (\r")
+        assert self.parser.last_status == False
+        self.treemanager.jump_to_error(self.parser)
+        assert self.treemanager.cursor.line == 3
+
+class Test_Transactions(Test_Python):
+
+    def count_parses(self):
+        calls = []
+        inc_parse = self.parser.inc_parse
+        def counting(*args, **kwargs):
+            calls.append(1)
+            return inc_parse(*args, **kwargs)
+        self.parser.inc_parse = counting
+        return calls
+
+    def teardown_method(self, method):
+        if "inc_parse" in self.parser.__dict__:
+            del self.parser.inc_parse
+
+    def text(self):
+        return self.treemanager.export_as_text("/dev/null")
+
+    def test_transaction(self):
+        self.reset()
+        self.treemanager.import_file("x = 1\r")
+        calls = self.count_parses()
+        self.treemanager.begin_transaction()
+        for c in "y = 23":
+            self.treemanager.key_normal(c)
+        self.treemanager.key_backspace()
+        self.treemanager.key_normal("\r")
+        assert calls == []
+        self.treemanager.commit_transaction()
+        assert len(calls) == 1
+        assert self.parser.last_status == True
+        assert self.text() == "y = 2\nx = 1\n"
+
+    def test_nested_transaction(self):
+        self.reset()
+        self.treemanager.import_file("x = 1\r")
+        calls = self.count_parses()
+        self.treemanager.begin_transaction()
+        self.treemanager.insert_text(6, "y = 2\r")
+        self.treemanager.delete_text(0, 6)
+        assert calls == []
+        self.treemanager.commit_transaction()
+        assert len(calls) == 1
+        assert self.text() == "y = 2\n"
+
+    def test_offsets(self):
+        self.reset()
+        self.treemanager.import_file("class X:\r    pass\r")
+        for offset in range(len("class X:\r    pass\r") + 1):
+            cursor = self.treemanager.cursor_at_offset(offset)
+            assert self.treemanager.get_cursor_offset(cursor) == offset
+        assert self.treemanager.cursor_at_offset(9).line == 1
+
+    def test_undo_redo(self):
+        self.reset()
+        self.treemanager.import_file("class X:\r    def f(a):\r        return a\r\rx = 1\r")
+        before = self.text()
+        self.move("down", 2)
+        self.treemanager.key_end()
+        for c in " + 42\r        b = a\rreturn b":
+            self.treemanager.key_normal(c)
+        for i in range(4):
+            self.treemanager.key_backspace()
+        self.treemanager.key_cursors("up")
+        self.treemanager.key_delete()
+        after = self.text()
+        while self.treemanager.undomanager.pos > -1:
+            self.treemanager.key_ctrl_z()
+        assert self.text() == before
+        assert self.parser.last_status == True
+        for i in range(len(self.treemanager.undomanager.stack)):
+            self.treemanager.key_shift_ctrl_z()
+        assert self.text() == after
+
+    def test_undo_doesnt_reparse(self):
+        self.reset()
+        self.treemanager.import_file("x = 1\r")
+        self.treemanager.key_end()
+        for c in "a" * 50:
+            self.treemanager.key_normal(c)
+        calls = self.count_parses()
+        self.treemanager.key_ctrl_z()
+        assert self.text() == "x = 1\n"
+        self.treemanager.key_shift_ctrl_z()
+        assert self.text() == "x = 1" + "a" * 50 + "\n"
+        assert calls == []
+
+    def test_undo_restores_tree(self):
+        self.reset()
+        self.treemanager.import_file("class X:\r    def f(a):\r        return a\r\rx = 1\r")
+        root = self.parser.previous_version.parent
+        def dump(node):
+            return (node, node.symbol.name, [dump(c) for c in node.children])
+        before = dump(root)
+        lines = [l.node for l in self.treemanager.lines]
+        self.move("down", 2)
+        self.treemanager.key_end()
+        for c in "\rdef g():\r    pass":
+            self.treemanager.key_normal(c)
+        assert self.parser.last_status == True
+        while self.treemanager.undomanager.pos > -1:
+            self.treemanager.key_ctrl_z()
+        # the old nodes are back, without parsing again
+        assert dump(root) == before
+        assert [l.node for l in self.treemanager.lines] == lines
+        assert self.parser.last_status == True
+        check_text_length(root)
+        # and can be edited again
+        self.treemanager.key_normal("y")
+        assert self.text() == "class X:\n    def f(a):\n        return ay\n\nx = 1\n"
+        assert self.parser.last_status == True
+
+    def test_history_limit(self):
+        self.reset()
+        self.treemanager.import_file("x = 1\r")
+        self.treemanager.key_end()
+        for i in range(150):
+            self.treemanager.key_normal(" ")
+        assert len(self.treemanager.undomanager.stack) == 100
+        for i in range(150):
+            self.treemanager.key_ctrl_z()
+        assert self.text() == "x = 1" + " " * 50 + "\n"
+
+    def test_edit_without_undo(self):
+        self.reset()
+        self.treemanager.import_file("x = 1\r")
+        self.treemanager.key_end()
+        self.treemanager.key_normal(" ")
+        self.treemanager.key_normal("+", undo_mode=False)
+        self.treemanager.insert_text(7, " 2", undo_mode=False)
+        assert self.text() == "x = 1 + 2\n"
+        assert len(self.treemanager.undomanager.stack) == 1
+        # the changes are undone together with the previous edit
+        self.treemanager.key_ctrl_z()
+        assert self.text() == "x = 1\n"
+        self.treemanager.key_shift_ctrl_z()
+        assert self.text() == "x = 1 + 2\n"
+        self.treemanager.key_ctrl_z()
+        self.treemanager.key_backspace(undo_mode=False)
+        assert self.text() == "x = \n"
+        assert self.treemanager.undomanager.stack == []
+        self.treemanager.key_ctrl_z()
+        assert self.text() == "x = \n"
+
+    def test_undo_paste_and_delete_selection(self):
+        self.reset()
+        self.treemanager.import_file("x = 1\ry = 2\r")
+        self.treemanager.key_end()
+        self.treemanager.pasteText("\rz = 3\rw = 4")
+        assert self.text() == "x = 1\nz = 3\nw = 4\ny = 2\n"
+        self.treemanager.key_shift()
+        self.treemanager.key_cursors("up", mod_shift=True)
+        self.treemanager.deleteSelection()
+        assert self.text() == "x = 1\nz = 3\ny = 2\n"
+        self.treemanager.key_ctrl_z()
+        assert self.text() == "x = 1\nz = 3\nw = 4\ny = 2\n"
+        self.treemanager.key_ctrl_z()
+        assert self.text() == "x = 1\ny = 2\n"
+        assert len(self.treemanager.lines) == 3
+        self.treemanager.key_shift_ctrl_z()
+        self.treemanager.key_shift_ctrl_z()
+        assert self.text() == "x = 1\nz = 3\ny = 2\n"
+        assert self.parser.last_status == True
+
 class Test_Indentation(Test_Python):
 
     def test_indentation(self):
@@ -1011,6 +1421,50 @@ class Test_Languageboxes(Test_Python):
         self.treemanager.deleteSelection()
         assert lbox.symbol.name == "<Prolog>"
 
+    def test_undo_languagebox(self):
+        self.reset()
+        for c in "a = 1\r":
+            self.treemanager.key_normal(c)
+        self.treemanager.add_languagebox(lang_dict["Prolog"])
+        for c in "x.":
+            self.treemanager.key_normal(c)
+        text = self.treemanager.export_as_text("/dev/null")
+        assert len(self.treemanager.parsers) == 2
+        self.treemanager.key_ctrl_z()
+        self.treemanager.key_ctrl_z()
+        assert self.treemanager.export_as_text("/dev/null") == "a = 1\n"
+        assert len(self.treemanager.parsers) == 1
+        assert self.parser.last_status == True
+        self.treemanager.key_shift_ctrl_z()
+        self.treemanager.key_shift_ctrl_z()
+        assert self.treemanager.export_as_text("/dev/null") == text
+        assert len(self.treemanager.parsers) == 2
+        assert self.treemanager.parsers[1][0].last_status == True
+        check_text_length(self.parser.previous_version.parent)
+
+    def test_text_length(self):
+        self.reset()
+        for c in "a = 1\r":
+            self.treemanager.key_normal(c)
+        self.treemanager.add_languagebox(lang_dict["Prolog"])
+        lbox = self.treemanager.cursor.node.get_root().get_magicterminal()
+        for c in "x.\ry.":
+            self.treemanager.key_normal(c)
+        root = self.parser.previous_version.parent
+        check_text_length(root)
+        assert lbox.textlen == 5
+        assert root.textlen == len("a = 1\rx.\ry.")
+        assert root.newlines == 2
+        node, start = root.find_offset(9)
+        assert node.symbol.name == "y" and start == 9
+        assert node.get_offset() == (9, 2)
+        self.treemanager.key_backspace()
+        self.treemanager.key_backspace()
+        check_text_length(root)
+        assert root.textlen == len("a = 1\rx.\r")
+        lbox.parent.remove_child(lbox)
+        assert root.textlen == len("a = 1\r")
+
 class Test_Backslash(Test_Python):
 
     def test_parse(self):
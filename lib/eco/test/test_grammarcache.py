@@ -0,0 +1,71 @@
+# Copyright (c) 2013--2014 King's College London
+# Created by the Software Development Team <http://soft-dev.org/>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import os, time
+
+from grammarcache import GrammarCache, digest
+
+def test_digest():
+    assert digest("a", "b") == digest("a", "b")
+    assert digest("ab", "") != digest("a", "b")
+    assert digest(u"\xe4") == digest(u"\xe4".encode("utf-8"))
+    assert digest([("atom", ["<Prolog>"])]) != digest([("atom", ["<SQL>"])])
+
+def test_put_get(tmpdir):
+    cache = GrammarCache(str(tmpdir))
+    key = digest("test")
+    assert cache.get(key) is None
+    cache.put(key, {"table": [1, 2, 3]})
+    assert cache.get(key) == {"table": [1, 2, 3]}
+    # only the entry itself, no temporary files
+    assert os.listdir(str(tmpdir)) == [key + ".pcl"]
+
+def test_broken_entry(tmpdir):
+    cache = GrammarCache(str(tmpdir))
+    key = digest("broken")
+    with open(cache.filename(key), "wb") as f:
+        f.write("not a pickle")
+    assert cache.get(key) is None
+    assert not os.path.exists(cache.filename(key))
+
+def test_evict_least_recently_used(tmpdir):
+    cache = GrammarCache(str(tmpdir), max_size=3500)
+    keys = [digest(i) for i in range(3)]
+    for i, key in enumerate(keys):
+        cache.put(key, "x" * 1000)
+        os.utime(cache.filename(key), (time.time() - 100 + i, time.time() - 100 + i))
+    # using the oldest entry makes it the most recently used
+    assert cache.get(keys[0]) is not None
+    cache.put(digest("new"), "x" * 1000)
+    assert cache.get(keys[0]) is not None
+    assert cache.get(keys[1]) is None
+    assert cache.get(digest("new")) is not None
+
+def test_file_digest(tmpdir):
+    from grammarcache import file_digest
+    filename = str(tmpdir.join("grammar.eco"))
+    with open(filename, "w") as f:
+        f.write("a")
+    first = file_digest(filename)
+    assert file_digest(filename) == first
+    with open(filename, "w") as f:
+        f.write("bc")
+    assert file_digest(filename) != first
@@ -0,0 +1,88 @@
+# Copyright (c) 2013--2014 King's College London
+# Created by the Software Development Team <http://soft-dev.org/>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import os
+
+from grammars import grammars
+from grammars.grammars import calc, java, preload, EcoFile, missing_grammars
+import grammarcache, tablefile
+
+def test_hash_is_stable():
+    assert hash(calc) == hash(calc)
+    assert calc.digest() != java.digest()
+
+def preload_calc(tmpdir, monkeypatch, processes):
+    monkeypatch.setattr(grammarcache.cache, "directory", str(tmpdir))
+    monkeypatch.setattr(grammars, "_cache", {})
+    loaded = []
+    thread = preload([calc, calc, grammars.eco_grammar], loaded.append, processes)
+    thread.join()
+    assert loaded == [[calc]]
+    assert calc.is_loaded()
+    assert not java.is_loaded()
+    assert os.path.exists(grammarcache.cache.filename(calc.digest(), tablefile.suffix))
+
+def test_preload_thread(tmpdir, monkeypatch):
+    preload_calc(tmpdir, monkeypatch, 0)
+
+def test_preload_processes(tmpdir, monkeypatch):
+    preload_calc(tmpdir, monkeypatch, 2)
+
+def test_dependencies():
+    assert set(grammars.phppython.dependencies()) == \
+        set([grammars.pythonphp, grammars.python_expr])
+    assert set(grammars.javasqlchemical.dependencies()) == \
+        set([grammars.sql_ref_java, grammars.java_expr, grammars.chemical])
+    assert calc.dependencies() == []
+
+def composed_calc(monkeypatch):
+    outer = EcoFile("Calc + Calc", "grammars/basiccalc.eco", "Calc")
+    inner = EcoFile("Calc in Calc", "grammars/basiccalc.eco", "Calc")
+    inner.change_start("T")
+    outer.add_alternative("P", inner)
+    monkeypatch.setitem(grammars.lang_dict, outer.name, outer)
+    monkeypatch.setitem(grammars.lang_dict, inner.name, inner)
+    return outer, inner
+
+def test_missing_grammars(tmpdir, monkeypatch):
+    monkeypatch.setattr(grammarcache.cache, "directory", str(tmpdir))
+    monkeypatch.setattr(grammars, "_cache", {})
+    outer, inner = composed_calc(monkeypatch)
+    assert missing_grammars([outer]) == [outer.name, inner.name]
+    # same tables
+    assert missing_grammars([grammars.python, grammars.ipython]) == [grammars.python.name]
+
+def test_load_in_process(tmpdir, monkeypatch):
+    monkeypatch.setattr(grammarcache.cache, "directory", str(tmpdir))
+    monkeypatch.setattr(grammars, "_cache", {})
+    outer, inner = composed_calc(monkeypatch)
+    outer.load()
+    assert outer.is_loaded() and outer.is_cached()
+    assert not inner.is_cached()
+
+def test_load_builds_dependencies(tmpdir, monkeypatch):
+    monkeypatch.setattr(grammarcache.cache, "directory", str(tmpdir))
+    monkeypatch.setattr(grammars, "_cache", {})
+    monkeypatch.setattr(EcoFile, "processes", 2)
+    outer, inner = composed_calc(monkeypatch)
+    outer.load()
+    assert outer.is_loaded() and outer.is_cached()
+    assert not inner.is_loaded() and inner.is_cached()
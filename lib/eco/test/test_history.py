@@ -0,0 +1,136 @@
+# Copyright (c) 2013--2014 King's College London
+# Created by the Software Development Team <http://soft-dev.org/>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+import history
+import threading
+
+class Item(object):
+    __slots__ = ["value", "other"]
+    def __init__(self, value):
+        history.created(self)
+        self.value = value
+
+    def set(self, name, value):
+        history.save(self)
+        setattr(self, name, value)
+
+class Parser(object):
+    def __init__(self):
+        self.status = False
+
+def record(f):
+    journal = history.Journal()
+    journal.start()
+    try:
+        f()
+    finally:
+        journal.stop()
+    return journal
+
+def test_attributes():
+    item = Item(1)
+    parser = Parser()
+    def edit():
+        item.set("value", 2)
+        item.set("value", 3)
+        item.set("other", "x")
+        history.save(parser)
+        parser.status = True
+        parser.error = "y"
+    journal = record(edit)
+    assert (item.value, item.other) == (3, "x")
+    journal.restore()
+    assert item.value == 1
+    assert not hasattr(item, "other")
+    assert parser.__dict__ == {"status": False}
+    journal.restore()
+    assert (item.value, item.other) == (3, "x")
+    assert parser.__dict__ == {"status": True, "error": "y"}
+
+def test_new_objects():
+    items = []
+    def edit():
+        items.append(Item(1))
+        items[0].set("value", 2)
+    journal = record(edit)
+    assert len(journal) == 0
+    assert items[0].value == 2
+
+def test_other_threads():
+    item = Item(1)
+    def edit():
+        t = threading.Thread(target=item.set, args=("value", 2))
+        t.start()
+        t.join()
+    journal = record(edit)
+    assert len(journal) == 0
+    assert item.value == 2
+
+def test_containers():
+    d = {"a": 1}
+    l = [1, 2, 3]
+    def edit():
+        history.save_item(d, "a")
+        d["a"] = 2
+        history.save_item(d, "b")
+        d["b"] = 3
+        history.save_list(l)
+        l.pop(0)
+    journal = record(edit)
+    journal.restore()
+    assert d == {"a": 1}
+    assert l == [1, 2, 3]
+    journal.restore()
+    assert d == {"a": 2, "b": 3}
+    assert l == [2, 3]
+
+def test_merge():
+    item = Item(1)
+    def first():
+        item.set("value", 2)
+    def second():
+        item.set("value", 3)
+        item.set("other", 4)
+    journal = record(first)
+    journal.merge(record(second))
+    journal.restore()
+    assert item.value == 1
+    assert not hasattr(item, "other")
+
+def test_merge_attributes():
+    item = Item(1)
+    other = Item(1)
+    def first():
+        other.set("value", 2)
+    def second():
+        history.save(item, "value")
+        item.value = 2
+        item.set("other", 3)
+        history.save(other, "value")
+        other.value = 3
+    journal = record(first)
+    journal.merge(record(second))
+    journal.restore()
+    assert (item.value, other.value) == (1, 1)
+    assert not hasattr(item, "other")
+    journal.restore()
+    assert (item.value, item.other, other.value) == (2, 3, 3)
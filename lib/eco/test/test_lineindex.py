@@ -0,0 +1,99 @@
+# Copyright (c) 2013--2014 King's College London
+# Created by the Software Development Team <http://soft-dev.org/>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import random
+
+import pytest
+
+from lineindex import Line, LineIndex
+
+class Newline(object):
+    def __init__(self, nr):
+        self.nr = nr
+
+def check(index, lines):
+    assert len(index) == len(lines)
+    assert list(index) == lines
+    for i, line in enumerate(lines):
+        assert index[i] is line
+        assert index.index(line) == i
+        assert index.find(line.node) == i
+    assert index.total_height() == sum(l.height for l in lines)
+    assert index.max_width() == max([l.width for l in lines] or [0])
+
+def test_list_operations():
+    random.seed(3)
+    index = LineIndex()
+    lines = []
+    for step in range(600):
+        op = random.random()
+        if op < 0.5 or not lines:
+            i = random.randint(0, len(lines))
+            line = Line(Newline(step))
+            lines.insert(i, line)
+            index.insert(i, line)
+        elif op < 0.7:
+            i = random.randrange(len(lines))
+            del lines[i]
+            del index[i]
+        elif op < 0.8:
+            i = random.randrange(len(lines))
+            j = random.randint(i, len(lines))
+            del lines[i:j]
+            del index[i:j]
+        else:
+            line = random.choice(lines)
+            line.height = random.randint(1, 4)
+            line.width = random.randint(0, 80)
+        if step % 20 == 0:
+            check(index, lines)
+    check(index, lines)
+    assert index[-1] is lines[-1]
+    assert index[2:5] == lines[2:5]
+    with pytest.raises(IndexError):
+        index[len(lines)]
+
+def test_find_missing_node():
+    index = LineIndex([Line(Newline(0))])
+    assert index.find(Newline(1)) == -1
+    with pytest.raises(ValueError):
+        index.index(Line(Newline(2)))
+
+def test_global_random_state():
+    state = random.getstate()
+    LineIndex([Line(Newline(i)) for i in range(10)])
+    assert random.getstate() == state
+
+def test_heights():
+    heights = [1, 3, 1, 2, 1]
+    lines = [Line(Newline(i), h) for i, h in enumerate(heights)]
+    index = LineIndex(lines)
+    rows = []
+    for i, h in enumerate(heights):
+        rows.extend([(i, sum(heights[:i]))] * h)
+    for i in range(len(heights) + 1):
+        assert index.height_before(i) == sum(heights[:i])
+    for y, row in enumerate(rows):
+        assert index.line_at_height(y) == row
+    assert index.line_at_height(100) == (4, 7)
+    lines[1].height = 1
+    assert index.line_at_height(2) == (2, 2)
+    assert index.total_height() == 6
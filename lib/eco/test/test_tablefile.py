@@ -0,0 +1,152 @@
+# Copyright (c) 2013--2014 King's College London
+# Created by the Software Development Team <http://soft-dev.org/>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import os
+import pytest
+
+from grammars.grammars import calc
+from cflexer.deterministic import DFA
+from cflexer.lexer import Lexer
+import tablefile
+
+def roundtrip(tmpdir, obj, dump, load):
+    filename = str(tmpdir.join("table" + tablefile.suffix))
+    with open(filename, "wb") as f:
+        dump(obj, f)
+    with open(filename, "rb") as f:
+        return load(f)
+
+def test_sections(tmpdir):
+    writer = tablefile.TableWriter()
+    writer.add_ints("small", [1, -2, 3])
+    writer.add_ints("large", [1, 2 ** 20])
+    writer.add_bytes("bytes", "abc")
+    writer.add_object("object", {"a": [1]})
+    writer.add_strings("strings", ["a", u"\xe4", None, ""])
+    filename = str(tmpdir.join("table" + tablefile.suffix))
+    with open(filename, "wb") as f:
+        writer.write(f)
+    with open(filename, "rb") as f:
+        table = tablefile.TableFile(f)
+    assert table.array("small").tolist() == [1, -2, 3]
+    assert table.array("small").typecode == "b"
+    assert table.array("large").tolist() == [1, 2 ** 20]
+    assert table.bytes("bytes") == "abc"
+    assert table.object("object") == {"a": [1]}
+    strings = table.strings("strings")
+    assert strings == ["a", u"\xe4", None, ""]
+    assert type(strings[0]) is str and type(strings[1]) is unicode
+    with pytest.raises(tablefile.FormatError):
+        table.array("bytes")
+    with pytest.raises(tablefile.FormatError):
+        table.bytes("missing")
+
+def test_syntaxtable(tmpdir):
+    entry = calc.build()
+    table = entry["syntaxtable"]
+    loaded = roundtrip(tmpdir, table, tablefile.dump_syntaxtable, tablefile.load_syntaxtable)
+    assert loaded.symbols == table.symbols
+    assert loaded.symbol_ids == table.symbol_ids
+    assert loaded.terminal_ids == table.terminal_ids
+    assert len(loaded.productions) == len(table.productions)
+    for p1, p2 in zip(loaded.productions, table.productions):
+        assert p1 == p2
+        assert repr(p1.annotation) == repr(p2.annotation)
+        assert [s.folding for s in p1.right] == [s.folding for s in p2.right]
+    for state in range(table.num_states):
+        for symbol_id in range(len(table.symbols)):
+            assert loaded.lookup_id(state, symbol_id) == table.lookup_id(state, symbol_id)
+            if symbol_id >= table.num_terminals:
+                assert loaded.lookup_hint(state, symbol_id) == table.lookup_hint(state, symbol_id)
+    assert loaded.table == table.table
+
+def test_dfa(tmpdir):
+    dfa = DFA()
+    dfa.add_state("start")
+    dfa.add_state("a", final=True)
+    dfa.add_state(u"\xe4", final=True, unmergeable=True)
+    dfa[0, "a"] = 1
+    dfa[0, u"\xe4"] = 2
+    dfa[1, "\xff"] = 1
+    dfa.add_state("keyword", final=True, unmergeable=True)
+    dfa.keywords[1] = {"a": 3}
+    loaded = roundtrip(tmpdir, dfa, tablefile.dump_dfa, tablefile.load_dfa)
+    assert loaded.num_states == 4
+    assert loaded.transitions == dfa.transitions
+    assert set(type(c) for (_, c) in loaded.transitions) == set([str, unicode])
+    assert loaded.final_states == set([1, 2, 3])
+    assert loaded.unmergeable_states == set([2, 3])
+    assert loaded.names == ["start", "a", u"\xe4", "keyword"]
+    assert loaded.keywords == {1: {"a": 3}}
+
+def test_grammar(tmpdir):
+    entry = calc.build()
+    loaded = roundtrip(tmpdir, entry, tablefile.dump_grammar, tablefile.load_grammar)
+    assert loaded["whitespaces"] == entry["whitespaces"]
+    text = "1 + 2*3"
+    assert loaded["lexer"].lex(text) == entry["lexer"].lex(text)
+
+def dump_lexer(inclexer, f):
+    writer = tablefile.TableWriter()
+    tablefile.write_lexer(writer, inclexer)
+    writer.write(f)
+
+def load_lexer(f):
+    return tablefile.read_lexer(tablefile.TableFile(f))
+
+@pytest.mark.parametrize("table", [True, False])
+def test_lexer(tmpdir, table):
+    inclexer = calc.build()["lexer"]
+    old = inclexer.lexer
+    inclexer.lexer = Lexer(old.token_regexs, old.names, old.ignore, old.automaton, table)
+    loaded = roundtrip(tmpdir, inclexer, dump_lexer, load_lexer).lexer
+    assert loaded.table == table
+    if table:
+        stored = loaded.transition_table
+        built = inclexer.lexer.transition_table
+        assert stored.num_classes == built.num_classes
+        assert stored.classes == built.classes
+        assert stored.other_classes == built.other_classes
+        assert list(stored.table) == list(built.table)
+        assert stored.final == built.final
+        assert stored.dead == built.dead
+    else:
+        assert loaded.code.co_code == inclexer.lexer.code.co_code
+    text = "1 + 2*3 + 45"
+    assert loaded.tokenize(text) == inclexer.lexer.tokenize(text)
+
+def test_broken_file(tmpdir):
+    filename = str(tmpdir.join("broken" + tablefile.suffix))
+    for content in ["", "not a table", tablefile.MAGIC]:
+        with open(filename, "wb") as f:
+            f.write(content)
+        with open(filename, "rb") as f:
+            with pytest.raises(tablefile.FormatError):
+                tablefile.TableFile(f)
+
+def test_broken_cache_entry(tmpdir):
+    from grammarcache import GrammarCache, digest
+    cache = GrammarCache(str(tmpdir))
+    key = digest("broken")
+    with open(cache.filename(key, tablefile.suffix), "wb") as f:
+        f.write(tablefile.MAGIC)
+    assert cache.get(key, tablefile.load_grammar, tablefile.suffix) is None
+    assert os.listdir(str(tmpdir)) == []
@@ -27,6 +27,8 @@ from PyQt4.QtGui import QApplication
 from grammars.grammars import lang_dict, Language, EcoFile
 from indentmanager import IndentationManager
 from export import HTMLPythonSQL, PHPPython, ATerms
+from lineindex import Line, LineIndex
+import history
 
 import math
 
@@ -42,17 +44,6 @@ class NodeSize(object):
         self.w = w
         self.h = h
 
-class Line(object):
-    def __init__(self, node, height=1):
-        self.node = node        # this lines newline node
-        self.height = height    # line height
-        self.width = 0          # line width
-        self.indent = 0         # line indentation
-        self.ws = 0
-
-    def __repr__(self):
-        return "Line(%s, width=%s, height=%s)" % (self.node, self.width, self.height)
-
 class Cursor(object):
     def __init__(self, node, pos, line):
         self.node = node
@@ -258,87 +249,139 @@ class Cursor(object):
     def __repr__(self):
         return "Cursor(%s, %s)" % (self.node, self.pos)
 
+def transaction(f):
+    """Run the decorated TreeManager method as one edit transaction, so that
+    all edits it makes are reparsed together when it returns."""
+    def wrapper(self, *args, **kwargs):
+        self.begin_transaction()
+        try:
+            return f(self, *args, **kwargs)
+        finally:
+            self.commit_transaction()
+    wrapper.__name__ = f.__name__
+    wrapper.__doc__ = f.__doc__
+    return wrapper
+
 class UndoObject(object):
-    def __init__(self, cmd, text, x, line):
-        self.cmd = cmd
-        self.text = text
-        self.x1 = x
-        self.line1 = line
-        self.x2 = len(text)
-        self.line2 = line
+    def __init__(self, before):
+        self.journal = history.Journal() # changes made by the edit
+        self.before = before    # cursor offset before the edit
+        self.after = before     # and after it
+        self.cmd = None         # last keystroke of the edit
+        self.text = ""
+        self.offset = 0
 
     def __repr__(self):
-        return "UndoObject(cmd=%s, text=%s, x1=%s, line1=%s, x2=%s, line2=%s)" % (self.cmd, repr(self.text), self.x1, self.line1, self.x2, self.line2)
+        return "UndoObject(cmd=%s, text=%s, offset=%s, changes=%s)" % (self.cmd, repr(self.text), self.offset, len(self.journal))
 
 class UndoManager(object):
+    """Keeps the journals of past edits. Undoing or redoing an edit restores
+    the document directly from its journal."""
+
     def __init__(self):
         self.stack = []
         self.pos = -1
         self.mode = "new"
-
-    def add(self, cmd, text, cursor):
-        if text == " " or str(text).startswith("\r"):
-            self.mode = "new"
-        if self.mode != cmd:
+        self.current = None # edit that is being recorded
+        self.merge = False  # if the current edit continues the last one
+        self.excluded = False # if the current edit is kept out of the history
+
+    def begin(self, tm):
+        self.current = UndoObject(tm.get_cursor_offset())
+        self.merge = False
+        self.excluded = False
+        self.current.journal.start()
+
+    def end(self, tm):
+        uo = self.current
+        self.current = None
+        uo.journal.stop()
+        if len(uo.journal) == 0:
+            return
+        uo.after = tm.get_cursor_offset()
+        if self.excluded and uo.cmd is None:
+            # later steps are recorded against the excluded changes, so they
+            # can't be dropped: undo them together with the previous step
             del self.stack[self.pos+1:]
-            if cmd == "insert":
-                x = cursor.get_x() - len(text)
-            elif cmd == "delete":
-                x = cursor.get_x() + len(text)
-            self.stack.append(UndoObject(cmd, text, x, cursor.line))
-            self.pos += 1
-            self.mode = cmd
+            if self.stack:
+                last = self.stack[-1]
+                last.journal.merge(uo.journal)
+                last.after = uo.after
+        elif self.merge:
+            last = self.stack[-1]
+            last.journal.merge(uo.journal)
+            last.after = uo.after
+            last.text = uo.text
+            last.offset = uo.offset
         else:
-            uo = self.stack[-1]
-            uo.text += text
-            uo.x2 = cursor.get_x()
-            uo.line2 = cursor.line
-        if len(self.stack) > 100: # keep stack small
-            del self.stack[0]
-            self.pos -= 1
+            del self.stack[self.pos+1:]
+            self.stack.append(uo)
+            self.pos += 1
+            if len(self.stack) > 100: # keep stack small
+                del self.stack[0]
+                self.pos -= 1
+
+    def add(self, cmd, text, offset):
+        """Describe the current edit, so that the next keystrokes of a word
+        can be merged into one undo step."""
+        if not text:
+            return
+        if text == " " or text.startswith("\r"):
+            self.mode = "new"
+        uo = self.current
+        extended = None
+        if self.mode == cmd and uo.cmd is None and self.pos == len(self.stack) - 1:
+            extended = self.extend(self.stack[-1], cmd, text, offset)
+        self.merge = extended is not None
+        uo.cmd = cmd
+        uo.text, uo.offset = extended or (text, offset)
+        self.mode = cmd
+
+    def exclude(self):
+        """Keep the current edit out of the undo history (unless other
+        changes of the same transaction were added)."""
+        self.excluded = True
+
+    def extend(self, uo, cmd, text, offset):
+        if cmd != uo.cmd:
+            return None
+        if cmd == "insert" and offset == uo.offset + len(uo.text):
+            return uo.text + text, uo.offset
+        if cmd == "delete" and offset == uo.offset: # delete key
+            return uo.text + text, offset
+        if cmd == "delete" and offset + len(text) == uo.offset: # backspace
+            return text + uo.text, offset
+        return None
 
     def finish(self):
         self.mode = "new"
 
+    def clear(self):
+        self.stack = []
+        self.pos = -1
+        self.mode = "new"
+
     def undo(self, tm):
-        if len(self.stack) > 0 and self.pos > -1:
+        if self.pos > -1:
             uo = self.stack[self.pos]
-            f = self.__getattribute__("undo_" + uo.cmd)
-            tm.cursor.line = uo.line2
-            tm.cursor.move_to_x(uo.x2, tm.lines)
-            f(tm, uo.text)
+            uo.journal.restore()
             self.pos -= 1
+            tm.cursor = tm.cursor_at_offset(uo.before)
+            tm.unselect()
         self.mode = "new"
 
     def redo(self, tm):
-        if len(self.stack) > 0 and self.pos+1 < len(self.stack):
+        if self.pos+1 < len(self.stack):
             self.pos += 1
             uo = self.stack[self.pos]
-            f = self.__getattribute__("redo_" + uo.cmd)
-            f(tm, uo)
-
-    def undo_insert(self, tm, text):
-        for i in text:
-            tm.key_backspace(False)
-
-    def redo_insert(self, tm, uo):
-        tm.cursor.line = uo.line1
-        tm.cursor.move_to_x(uo.x1, tm.lines)
-        for c in uo.text:
-            tm.key_normal(c, False)
-
-    def undo_delete(self, tm, text):
-        for c in text[::-1]:
-            tm.key_normal(c, False)
-
-    def redo_delete(self, tm, uo):
-        tm.cursor.line = uo.line1
-        tm.cursor.move_to_x(uo.x1, tm.lines)
-        self.undo_insert(tm, uo.text)
+            uo.journal.restore()
+            tm.cursor = tm.cursor_at_offset(uo.after)
+            tm.unselect()
+        self.mode = "new"
 
 class TreeManager(object):
     def __init__(self):
-        self.lines = []             # storage for line objects
+        self.lines = LineIndex()    # storage for line objects
         self.mainroot = None        # root node (main language)
         #self.cursor = Cursor(0,0)
         #self.selection_start = Cursor(0,0)
@@ -346,6 +389,8 @@ class TreeManager(object):
         self.parsers = []           # stores all currently used parsers
         self.edit_rightnode = False # changes which node to select when inbetween two nodes
         self.undomanager = UndoManager()
+        self.transaction = 0        # nesting depth of edit transactions
+        self.pending = []           # roots to reparse when the transaction ends
         self.changed = False
         self.last_search = ""
 
@@ -371,6 +416,7 @@ class TreeManager(object):
     def delete_parser(self, root):
         for p in self.parsers:
             if p[0].previous_version.parent is root:
+                history.save_list(self.parsers)
                 self.parsers.remove(p)
 
     def get_parser(self, root):
@@ -399,7 +445,9 @@ class TreeManager(object):
             im = IndentationManager(parser.previous_version.parent)
         else:
             im = None
+        history.save_list(self.parsers)
         self.parsers.append((parser, lexer, language, analyser, im))
+        lexer.set_lookup_ids(parser.syntaxtable.terminal_ids)
         parser.inc_parse()
         if len(self.parsers) == 1:
             self.lines.append(Line(parser.previous_version.parent.children[0]))
@@ -615,32 +663,15 @@ class TreeManager(object):
         self.last_search = text
 
     def jump_to_error(self, parser):
-        bos = parser.previous_version.parent.children[0]
-        eos = parser.previous_version.parent.children[-1]
-        node = bos
-        while node is not eos:
-            if node is parser.error_node:
-                break
-            node = node.next_term
-
-        # get linenode
-        linenode = node
-        while True:
-            if linenode is None:
-                break
-            if linenode.symbol.name == "\r":
-                break
-            linenode = self.cursor.find_previous_visible(linenode)
-
-        # get line number
-        linenr = 0
-        for line in self.lines:
-            if linenode is None:
-                break
-            if line.node is linenode:
-                break
-            linenr += 1
+        root = parser.previous_version.parent
+        eos = root.children[-1]
+        node = parser.error_node
+        if node is None or isinstance(node.symbol, Nonterminal) or node.deleted or node.get_root() is not root:
+            node = eos
 
+        _, linenr = node.get_offset()
+        if node.symbol.name == "\r":
+            linenr += 1 # the line starting with this linebreak
         self.cursor.line = linenr
         self.cursor.node = node
         self.cursor.pos = 0
@@ -677,6 +708,7 @@ class TreeManager(object):
         if shift:
             self.selection_end = self.cursor.copy()
 
+    @transaction
     def key_normal(self, text, undo_mode = True):
         indentation = 0
 
@@ -745,10 +777,13 @@ class TreeManager(object):
         self.cursor.node = temp
         self.reparse(node, need_reparse)
         if undo_mode:
-            self.undomanager.add('insert', text, self.cursor.copy())
+            self.undomanager.add('insert', text, self.get_cursor_offset() - len(text))
+        else:
+            self.undomanager.exclude()
         self.changed = True
         return indentation
 
+    @transaction
     def key_backspace(self, undo_mode = True):
         node = self.get_selected_node()
         if node is self.mainroot.children[0] and not self.hasSelection():
@@ -763,6 +798,7 @@ class TreeManager(object):
             self.cursor.left()
         self.key_delete(undo_mode)
 
+    @transaction
     def key_delete(self, undo_mode = True):
         node = self.get_node_from_cursor()
 
@@ -816,7 +852,9 @@ class TreeManager(object):
         self.cursor.fix()
         self.reparse(repairnode, need_reparse)
         if undo_mode:
-            self.undomanager.add("delete", self.last_delchar, self.cursor.copy())
+            self.undomanager.add("delete", self.last_delchar, self.get_cursor_offset())
+        else:
+            self.undomanager.exclude()
         self.changed = True
 
     def key_shift(self):
@@ -847,6 +885,7 @@ class TreeManager(object):
             self.selection_start = self.cursor.copy()
             self.selection_end = self.cursor.copy()
 
+    @transaction
     def add_languagebox(self, language):
         node = self.get_node_from_cursor()
         newnode = self.create_languagebox(language)
@@ -859,7 +898,7 @@ class TreeManager(object):
             internal_position = self.cursor.pos
             text1 = node.symbol.name[:internal_position]
             text2 = node.symbol.name[internal_position:]
-            node.symbol.name = text1
+            node.set_text(text1)
             node.insert_after(newnode)
 
             node2 = TextNode(Terminal(text2))
@@ -894,9 +933,11 @@ class TreeManager(object):
 
         lbox.symbol.parser = root
         lbox.symbol.ast = root
+        lbox.update_length()
         lbox.plain_mode = True
         return lbox
 
+    @transaction
     def surround_with_languagebox(self, language):
         #XXX if partly selected node, need to split it
         nodes, _, _ = self.get_nodes_from_selection()
@@ -958,40 +999,43 @@ class TreeManager(object):
         if len(nodes) == 1:
             text = nodes[0].symbol.name[diff_start:diff_end]
             return text
-        new_nodes = []
-        for node in nodes:
-            if not isinstance(node.symbol, IndentationTerminal):
-                new_nodes.append(node)
-        nodes = new_nodes
 
         text = []
-        start = nodes.pop(0)
-        end = nodes.pop(-1)
-
-        text.append(start.symbol.name[diff_start:])
-        for node in nodes:
-            text.append(node.symbol.name)
-        text.append(end.symbol.name[:diff_end])
+        for i in range(len(nodes)):
+            node = nodes[i]
+            if isinstance(node.symbol, IndentationTerminal):
+                continue
+            name = node.symbol.name
+            if i == 0:
+                name = name[diff_start:]
+            elif i == len(nodes) - 1:
+                name = name[:diff_end]
+            text.append(name)
         return "".join(text)
 
+    @transaction
     def pasteCompletion(self, text):
         node = self.cursor.node
         if text.startswith(node.symbol.name):
-            node.symbol.name = text
+            node.set_text(text)
             self.cursor.pos = len(text)
         else:
             self.pasteText(text)
 
-    def pasteText(self, text):
-        oldpos = self.cursor.get_x()
-        node = self.get_node_from_cursor()
-        next_node = node.next_term
-
+    @transaction
+    def pasteText(self, text, undo_mode = True):
         if self.hasSelection():
-            self.deleteSelection()
+            self.deleteSelection(undo_mode)
+        node = self.get_node_from_cursor()
 
         text = text.replace("\r\n","\r")
         text = text.replace("\n","\r")
+        if undo_mode:
+            self.undomanager.finish()
+            self.undomanager.add("insert", text, self.get_cursor_offset())
+            self.undomanager.finish()
+        else:
+            self.undomanager.exclude()
 
         if self.cursor.inside():
             internal_position = self.cursor.pos
@@ -1020,6 +1064,7 @@ class TreeManager(object):
         self.cursor.line += text.count("\r")
         self.changed = True
 
+    @transaction
     def cutSelection(self):
         if self.hasSelection():
             text = self.copySelection()
@@ -1027,23 +1072,31 @@ class TreeManager(object):
             self.changed = True
             return text
 
-    def deleteSelection(self):
+    @transaction
+    def deleteSelection(self, undo_mode = True):
         #XXX simple version: later we might want to modify the nodes directly
         nodes, diff_start, diff_end = self.get_nodes_from_selection()
         if nodes == []:
             return
+        if undo_mode:
+            self.undomanager.finish()
+            cur_start = min(self.selection_start, self.selection_end)
+            self.undomanager.add("delete", self.copySelection(), self.get_cursor_offset(cur_start))
+            self.undomanager.finish()
+        else:
+            self.undomanager.exclude()
         if isinstance(nodes[0], BOS):
             del nodes[0]
         repair_node = self.cursor.find_previous_visible(nodes[0])
         if len(nodes) == 1:
             s = nodes[0].symbol.name
             s = s[:diff_start] + s[diff_end:]
-            nodes[0].symbol.name = s
+            nodes[0].set_text(s)
             self.delete_if_empty(nodes[0])
             self.clean_empty_lbox(nodes[0])
         else:
-            nodes[0].symbol.name = nodes[0].symbol.name[:diff_start]
-            nodes[-1].symbol.name = nodes[-1].symbol.name[diff_end:]
+            nodes[0].set_text(nodes[0].symbol.name[:diff_start])
+            nodes[-1].set_text(nodes[-1].symbol.name[diff_end:])
             self.delete_if_empty(nodes[0])
             self.delete_if_empty(nodes[-1])
             self.clean_empty_lbox(nodes[0])
@@ -1055,6 +1108,8 @@ class TreeManager(object):
             self.clean_empty_lbox(node)
         if not isinstance(repair_node.next_term, EOS):
             repair_node = repair_node.next_term # in case first node was deleted
+        while isinstance(repair_node.symbol, IndentationTerminal):
+            repair_node = repair_node.next_term
         self.relex(repair_node)
         cur_start = min(self.selection_start, self.selection_end)
         cur_end = max(self.selection_start, self.selection_end)
@@ -1063,6 +1118,8 @@ class TreeManager(object):
         del self.lines[cur_start.line+1:cur_end.line+1]
         self.selection_start = self.cursor.copy()
         self.selection_end = self.cursor.copy()
+        self.post_keypress("")
+        self.reparse(repair_node)
         self.changed = True
 
     def delete_if_empty(self, node):
@@ -1158,6 +1215,7 @@ class TreeManager(object):
         if im:
             im.repair_full()
         self.reparse(bos)
+        self.undomanager.clear()
         self.changed = True
         return
 
@@ -1338,9 +1396,76 @@ class TreeManager(object):
     def reparse(self, node, changed=True):
         if changed:
             root = node.get_root()
+            if self.transaction > 0:
+                # defer until the transaction is committed
+                for r in self.pending:
+                    if r is root:
+                        return
+                self.pending.append(root)
+                return
             parser = self.get_parser(root)
             parser.inc_parse()
 
+    def begin_transaction(self):
+        """Start an edit transaction. Edits made until the matching
+        commit_transaction are reparsed once, when it is called, and are
+        undone as one step."""
+        if self.transaction == 0:
+            self.undomanager.begin(self)
+        self.transaction += 1
+
+    def commit_transaction(self):
+        self.transaction -= 1
+        if self.transaction > 0:
+            return
+        pending = self.pending
+        self.pending = []
+        try:
+            for root in pending:
+                parser = self.get_parser(root)
+                if parser is not None: # language box may have been removed
+                    parser.inc_parse()
+        finally:
+            self.undomanager.end(self)
+
+    def get_cursor_offset(self, cursor=None):
+        """Return the position of `cursor` (default: the current cursor) in
+        the text of the document."""
+        if cursor is None:
+            cursor = self.cursor
+        node = cursor.node
+        offset = node.get_offset()[0]
+        if isinstance(node.symbol, MagicTerminal):
+            return offset + node.textlen # cursor is behind the language box
+        return offset + min(cursor.pos, node.textlen)
+
+    def cursor_at_offset(self, offset):
+        """Return a cursor placed behind the `offset`th character of the
+        document."""
+        offset = min(offset, self.mainroot.textlen)
+        if offset <= 0:
+            return Cursor(self.get_bos(), 0, 0)
+        node, start = self.mainroot.find_offset(offset - 1)
+        line = node.get_offset()[1]
+        if node.symbol.name == "\r":
+            line += 1
+        return Cursor(node, offset - start, line)
+
+    @transaction
+    def insert_text(self, offset, text, undo_mode = True):
+        self.cursor = self.cursor_at_offset(offset)
+        self.unselect()
+        self.pasteText(text, undo_mode)
+
+    @transaction
+    def delete_text(self, offset, length, undo_mode = True):
+        self.selection_start = self.cursor_at_offset(offset)
+        self.selection_end = self.cursor_at_offset(offset + length)
+        self.cursor = self.selection_end.copy()
+        self.deleteSelection(undo_mode)
+        self.changed = True
+
     def full_reparse(self):
         for p in self.parsers:
             p[0].reparse()
+        self.undomanager.clear()